@@ -1,121 +1,1350 @@
 import os
+import re
 import shutil
 import logging
 import sqlite3
+import stat
+import time
+import queue
+import threading
+import itertools
+from collections import Counter
+from contextlib import closing
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+from typing import Any, Callable, Dict, Iterable, Iterator, List, NamedTuple, Optional, Tuple
 
-from file_utils import calculate_sha256, create_hard_link
-from database import create_connection, insert_file_data, get_file_data, get_excluded_directories
+from file_utils import DEFAULT_HASH_ALGORITHM, COPY_REFLINK, COPY_BUFFERED, RateLimiter, new_hasher, calculate_hash, \
+    calculate_sample_hash, copy_with_hash, copy_file, create_hard_link
+from database import create_connection, create_table, insert_file_data, get_file_data, get_cached_file_data, \
+    get_exclusion_rules, insert_file_chunks, get_file_chunks, has_sample_match, resolve_hash_algorithm, \
+    get_dir_index, save_dir_index, get_backup_entries, get_setting, save_snapshot, get_snapshot, get_manifest, \
+    get_latest_snapshot, insert_pack_object, get_pack_object
+from exclusions import ExclusionRules
+from metrics import METRICS, diff_metrics, write_report
+from chunk_store import CHUNK_DIR_NAME, CHUNK_FILE_THRESHOLD, POINTER_MAX_SIZE, store_file, write_pointer, read_pointer, \
+    assemble_file
+from pack_store import PACK_DIR_NAME, PACK_FILE_THRESHOLD, PACK_CODEC_ZLIB, PackEntry, PackWriter, stream_object
+from throttle import Throttle, load_throttle
 
 logging.basicConfig(filename='backup_log.log', level=logging.INFO,
                     format='%(asctime)s:%(levelname)s:%(message)s')
 
+# Файлы такого размера и больше сравниваются поэтапно: размер, хеш образцов, полный хеш
+LARGE_FILE_SIZE = 500 * 1024 * 1024
+# Количество потоков конвейерного режима по умолчанию
+DEFAULT_HASH_WORKERS = min(8, os.cpu_count() or 1)
+DEFAULT_COPY_WORKERS = 4
+# Сколько файлов на один поток может одновременно находиться в конвейере
+PIPELINE_QUEUE_FACTOR = 16
+# Как часто обходчик, ожидая места в конвейере, проверяет, не остановился ли поток базы данных
+PIPELINE_POLL_SECONDS = 0.5
+# Количество файлов в одной транзакции базы данных (0 - одна транзакция на снимок)
+DB_BATCH_SIZE = 1000
+# Транзакция фиксируется и раньше, если открыта дольше этого количества секунд: другие
+# запуски с тем же каталогом не ждут блокировку записи дольше, чем обработку одного файла
+DB_BATCH_SECONDS = 2.0
+# Способы хранения: жесткие ссылки на целые файлы, хранилище фрагментов для больших файлов
+# или сжатые пак-файлы для небольших
+BACKEND_LINK = 'link'
+BACKEND_CHUNK = 'chunk'
+BACKEND_PACK = 'pack'
+# Способы сохранения файла в снимке, кроме способов копирования из file_utils.COPY_STRATEGIES
+TRANSFER_LINK = 'link'
+TRANSFER_CHUNK = 'chunk'
+# Содержимое дописано в пак-файл или уже было упаковано раньше
+TRANSFER_PACK = 'pack'
+TRANSFER_PACK_REF = 'pack_ref'
+# Файлы инкрементного снимка, перенесенные из предыдущего снимка без обращения к источнику
+TRANSFER_CARRIED = 'carried'
+# Директории, измененные менее чем за столько наносекунд до начала обхода, не попадают в индекс
+DIR_INDEX_RACY_NS = 2 * 10 ** 9
+# Как часто отправляются события хода копирования, в секундах
+PROGRESS_INTERVAL = 0.5
+# Количество потоков восстановления по умолчанию
+DEFAULT_RESTORE_WORKERS = 4
+# Действия плана восстановления
+RESTORE_WRITE = 'write'
+RESTORE_CHECK = 'check'
+RESTORE_DELETE = 'deleted'
+RESTORE_UNCHANGED = 'unchanged'
+RESTORE_MKDIR = 'mkdir'
 
-def backup_files(source: str, destination: str, db_file: str) -> None:
+
+class FileInfo(NamedTuple):
+    """ Сведения об исходном файле, собранные перед копированием. """
+    size: int
+    last_modified: float
+    mtime_ns: int
+    inode: int
+    ctime_ns: int
+    hash: Optional[str]
+    # Путь к копии из предыдущего снимка, если файл не менялся (см. get_cached_file_data)
+    cached_path: Optional[str] = None
+    # Хеш образцов начала, середины и конца - только для больших файлов
+    sample_hash: Optional[str] = None
+
+
+class Progress:
+    """
+    Ход копирования: обработанные файлы и байты, скорость и оценка оставшегося времени.
+
+    Ожидаемый объем берется из последнего завершенного снимка того же источника. События
+    отправляются не чаще PROGRESS_INTERVAL; update вызывается из одного потока.
+    """
+
+    def __init__(self, callback: Callable[[Dict], None], snapshot: str, expected_files: int = 0,
+                 expected_bytes: int = 0):
+        """
+        :param callback: Получатель событий хода копирования
+        :param snapshot: Имя создаваемого снимка
+        :param expected_files: Ожидаемое количество файлов или 0, если неизвестно
+        :param expected_bytes: Ожидаемый объем в байтах или 0, если неизвестно
+        """
+        self.callback = callback
+        self.snapshot = snapshot
+        self.expected_files = expected_files
+        self.expected_bytes = expected_bytes
+        self.files = 0
+        self.bytes = 0
+        self.started = time.monotonic()
+        self.last_report = self.started
+
+    def update(self, size: int) -> None:
+        """
+        Учитывает обработанный файл.
+
+        :param size: Размер файла
+        """
+        self.files += 1
+        self.bytes += size
+        now = time.monotonic()
+        if now - self.last_report >= PROGRESS_INTERVAL:
+            self.last_report = now
+            self.report('running')
+
+    def report(self, state: str) -> None:
+        """
+        Отправляет событие хода копирования.
+
+        :param state: Состояние: running, finished или cancelled
+        """
+        elapsed = time.monotonic() - self.started
+        rate = self.bytes / elapsed if elapsed > 0 else 0.0
+        eta = None
+        if state == 'running' and rate > 0 and self.expected_bytes:
+            eta = max(0.0, (self.expected_bytes - self.bytes) / rate)
+        self.callback(dict(state=state, snapshot=self.snapshot, files=self.files, bytes=self.bytes,
+                           expected_files=self.expected_files, expected_bytes=self.expected_bytes,
+                           elapsed=elapsed, rate=rate, files_rate=self.files / elapsed if elapsed > 0 else 0.0,
+                           eta=eta))
+
+
+def open_packs(destination: str, db_file: str, codec: str = PACK_CODEC_ZLIB) -> PackWriter:
+    """
+    Открывает пак-файлы пункта назначения для запуска копирования.
+
+    Уже упакованное содержимое ищется в индексе отдельным соединением: потоки копирования
+    обращаются к нему по очереди, под блокировкой PackWriter.
+
+    :param destination: Путь назначения резервных копий
+    :param db_file: Путь к файлу базы данных
+    :param codec: Способ сжатия из pack_store.PACK_CODECS
+    :return: Открытый PackWriter; его нужно закрыть после копирования
+    """
+    reader = create_connection(db_file, check_same_thread=False)
+    return PackWriter(os.path.join(destination, PACK_DIR_NAME), codec,
+                      lambda file_hash: get_pack_object(reader, file_hash), reader.close)
+
+
+def commit_batch(db_conn: sqlite3.Connection, packs: Optional[PackWriter]) -> None:
+    """
+    Фиксирует пачку записей каталога.
+
+    Пак-файл, на который ссылаются записи пачки, сбрасывается на диск до фиксации.
+
+    :param db_conn: Соединение с базой данных
+    :param packs: Пак-файлы запуска или None
+    """
+    if packs is not None:
+        with METRICS.timer('pack.sync'):
+            packs.sync()
+    with METRICS.timer('db.commit'):
+        db_conn.commit()
+
+
+def start_progress(db_conn: sqlite3.Connection, source: str, snapshot: str,
+                   callback: Optional[Callable[[Dict], None]], backup_set: Optional[str] = None) -> Optional[Progress]:
+    """
+    Создает счетчик хода копирования с ожидаемым объемом по последнему завершенному снимку.
+
+    :param db_conn: Соединение с базой данных
+    :param source: Исходный путь
+    :param snapshot: Имя создаваемого снимка
+    :param callback: Получатель событий или None
+    :param backup_set: Набор резервного копирования или None
+    :return: Счетчик или None, если получателя нет
+    """
+    if callback is None:
+        return None
+    previous = get_latest_snapshot(db_conn, source, finished=True, backup_set=backup_set)
+    return Progress(callback, snapshot, *(previous[7:9] if previous else (0, 0)))
+
+
+def new_snapshot_dir(destination: str, source: str, backup_set: Optional[str] = None) -> Tuple[str, str]:
+    """
+    Создает директорию нового снимка с уникальным именем.
+
+    Имя - время создания; у снимков набора к нему добавляются имя набора и имя источника.
+    Директория создается атомарно: если такая уже есть (другой запуск в ту же секунду),
+    к имени добавляется порядковый номер, поэтому одновременные запуски в один пункт
+    назначения не попадут в одну директорию.
+
+    :param destination: Путь назначения резервных копий
+    :param source: Исходный путь
+    :param backup_set: Имя набора резервного копирования или None
+    :return: Кортеж (имя снимка, директория снимка)
+    """
+    base = datetime.now().strftime("%Y%m%d-%H%M%S")
+    if backup_set:
+        label = f"{backup_set}-{os.path.basename(os.path.normpath(source))}"
+        base += '-' + re.sub(r'[^\w.-]+', '_', label)
+    os.makedirs(destination, exist_ok=True)
+    for n in itertools.count(1):
+        name = base if n == 1 else f"{base}-{n}"
+        path = os.path.join(destination, name)
+        try:
+            os.mkdir(path)
+            return name, path
+        except FileExistsError:
+            continue
+
+
+def backup_files(source: str, destination: str, db_file: str,
+                 hash_workers: int = 0, copy_workers: int = 0, paranoid: bool = False,
+                 batch_size: int = DB_BATCH_SIZE, backend: str = BACKEND_LINK,
+                 hash_algorithm: Optional[str] = None, progress: Optional[Callable[[Dict], None]] = None,
+                 cancel: Optional[threading.Event] = None, resume: bool = False,
+                 report_file: Optional[str] = None, pack_codec: str = PACK_CODEC_ZLIB,
+                 backup_set: Optional[str] = None, throttle: Optional[Throttle] = None) -> Dict[str, int]:
     """
     Выполняет процесс резервного копирования файлов из исходного пути в пункт назначения.
 
+    Если задано число потоков хеширования или копирования, используется конвейерный режим
+    (см. pipelined_copy), иначе файлы обрабатываются последовательно.
+
+    Отмененное копирование регистрирует снимок как незавершенный (без времени окончания).
+    С resume=True копирование продолжается в последний снимок источника, если он незавершен:
+    уже сохраненные файлы находятся по кэшу метаданных и не копируются повторно.
+
+    В один пункт назначения с одним каталогом могут одновременно копировать несколько
+    источников (см. jobs.JobManager.submit_set): одинаковые файлы разных источников
+    сохраняются один раз.
+
+    Нагрузку на источник ограничивает throttle, а если он не передан - ограничение,
+    сохраненное в каталоге (см. throttle.save_throttle): так оно действует и на запуски
+    по расписанию.
+
+    Ошибки отдельных файлов записываются в журнал, и копирование продолжается. Ошибка,
+    из-за которой снимок создать нельзя (недоступный пункт назначения или каталог),
+    записывается в журнал и передается вызывающему.
+
     :param source: Исходный путь для копирования
     :param destination: Путь назначения для сохранения копий
     :param db_file: Путь к файлу базы данных
+    :param hash_workers: Количество потоков хеширования (0 - последовательный режим)
+    :param copy_workers: Количество потоков копирования (0 - последовательный режим)
+    :param paranoid: Заново хешировать все файлы, не доверяя совпадению метаданных
+    :param batch_size: Количество файлов в одной транзакции базы данных (0 - одна на снимок)
+    :param backend: Способ хранения (BACKEND_LINK, BACKEND_CHUNK или BACKEND_PACK)
+    :param hash_algorithm: Алгоритм хеширования для нового репозитория (у существующего - сохраненный)
+    :param progress: Получатель событий хода копирования (см. Progress.report)
+    :param cancel: Событие отмены
+    :param resume: Продолжить незавершенный снимок источника
+    :param report_file: Путь к файлу отчета JSON со статистикой и метриками запуска (см. save_run_report)
+    :param pack_codec: Способ сжатия пак-файлов для BACKEND_PACK
+    :param backup_set: Имя набора резервного копирования, в который входит снимок, или None
+    :param throttle: Ограничение скорости и приоритета ввода-вывода или None - из каталога
+    :return: Количество файлов по способу сохранения (ссылка, фрагменты, способ копирования)
     """
+    stats = Counter()
     logging.info(f"Начало копирования из {source} в {destination}")
+    started = time.time()
+    metrics_before = METRICS.snapshot()
+    previous_io = None
     try:
         db_conn = create_connection(db_file)
-        excluded_dirs = get_excluded_directories(db_conn)
-        timestamp = datetime.now().strftime("%Y%m%d-%H%M%S")
-        version_path = os.path.join(destination, timestamp)
-        recursive_copy(source, version_path, db_conn, excluded_dirs)
-        db_conn.close()
-        logging.info(f"Копирование завершено")
+        create_table(db_conn)
+        # В новом репозитории алгоритм проверяется до того, как он будет сохранен в базе;
+        # в существующем запрошенный алгоритм игнорируется, и проверяется только сохраненный
+        if get_setting(db_conn, 'hash_algorithm') is None:
+            new_hasher(hash_algorithm or DEFAULT_HASH_ALGORITHM)
+        algorithm = resolve_hash_algorithm(db_conn, hash_algorithm, DEFAULT_HASH_ALGORITHM)
+        new_hasher(algorithm)
+        exclusions = ExclusionRules(get_exclusion_rules(db_conn))
+        if throttle is None:
+            throttle = load_throttle(db_conn)
+        if throttle is not None:
+            previous_io = throttle.lower_priority()
+        version_path = None
+        if resume:
+            previous = get_latest_snapshot(db_conn, source, backup_set=backup_set)
+            if previous is not None and previous[6] is None and os.path.isdir(previous[2]):
+                timestamp, version_path = previous[1], previous[2]
+                logging.info(f"Продолжение незавершенного снимка {timestamp}")
+        if version_path is None:
+            timestamp, version_path = new_snapshot_dir(destination, source, backup_set)
+        chunk_root = os.path.join(destination, CHUNK_DIR_NAME) if backend == BACKEND_CHUNK else None
+        tracker = start_progress(db_conn, source, timestamp, progress, backup_set)
+        packs = open_packs(destination, db_file, pack_codec) if backend == BACKEND_PACK else None
+        try:
+            if hash_workers > 0 or copy_workers > 0:
+                db_conn.close()
+                stats = pipelined_copy(source, version_path, db_file, exclusions,
+                                       hash_workers or DEFAULT_HASH_WORKERS, copy_workers or DEFAULT_COPY_WORKERS,
+                                       paranoid, batch_size, chunk_root, algorithm, tracker, cancel, packs, throttle,
+                                       destination)
+            else:
+                stats = recursive_copy(source, version_path, db_conn, exclusions, paranoid, batch_size, chunk_root,
+                                       algorithm, tracker, cancel, packs, throttle, destination)
+                db_conn.close()
+        finally:
+            if packs is not None:
+                packs.close()
+        cancelled = cancel is not None and cancel.is_set()
+        with closing(create_connection(db_file)) as db_conn, METRICS.timer('db.snapshot'):
+            save_snapshot(db_conn, timestamp, version_path, source, backend, started,
+                          None if cancelled else time.time(), backup_set=backup_set)
+        if tracker is not None:
+            tracker.report('cancelled' if cancelled else 'finished')
+        logging.info(f"Копирование {'отменено' if cancelled else 'завершено'}: {format_stats(stats)}")
+        if report_file:
+            save_run_report(report_file, source, destination, timestamp, started, cancelled, stats, metrics_before)
     except Exception as e:
         logging.error(f"Ошибка при копировании: {e}")
+        raise
+    finally:
+        # Поток задания переиспользуется следующими заданиями (jobs.JobManager)
+        Throttle.restore_priority(previous_io)
+    return dict(stats)
+
+
+def incremental_backup(source: str, destination: str, db_file: str, dirty_paths: Iterable[str],
+                       paranoid: bool = False, batch_size: int = DB_BATCH_SIZE, backend: str = BACKEND_LINK,
+                       hash_algorithm: Optional[str] = None, progress: Optional[Callable[[Dict], None]] = None,
+                       cancel: Optional[threading.Event] = None,
+                       report_file: Optional[str] = None, pack_codec: str = PACK_CODEC_ZLIB,
+                       backup_set: Optional[str] = None, throttle: Optional[Throttle] = None) -> Dict[str, int]:
+    """
+    Создает снимок, обходя только измененные пути.
+
+    Файлы вне измененных путей переносятся из последнего снимка источника жесткими ссылками
+    по его манифесту, без обращения к источнику; упакованным файлам достаточно строки манифеста,
+    пустые директории переносятся по директории предыдущего снимка. Измененные пути копируются обычным образом
+    (см. recursive_copy); удаленные просто не попадают в новый снимок. Если снимков источника
+    еще нет или изменен сам источник, выполняется полное копирование. Отмененный снимок
+    регистрируется как незавершенный, а ошибка передается вызывающему, как и в backup_files.
+
+    :param source: Исходный путь для копирования
+    :param destination: Путь назначения для сохранения копий
+    :param db_file: Путь к файлу базы данных
+    :param dirty_paths: Измененные пути внутри источника (файлы и директории)
+    :param paranoid: Заново хешировать все измененные файлы, не доверяя совпадению метаданных
+    :param batch_size: Количество файлов в одной транзакции базы данных (0 - одна на снимок)
+    :param backend: Способ хранения (BACKEND_LINK, BACKEND_CHUNK или BACKEND_PACK)
+    :param hash_algorithm: Алгоритм хеширования для нового репозитория (у существующего - сохраненный)
+    :param progress: Получатель событий хода копирования (см. Progress.report)
+    :param cancel: Событие отмены
+    :param report_file: Путь к файлу отчета JSON со статистикой и метриками запуска
+    :param pack_codec: Способ сжатия пак-файлов для BACKEND_PACK
+    :param backup_set: Имя набора резервного копирования, в который входит снимок, или None
+    :param throttle: Ограничение скорости и приоритета ввода-вывода или None - из каталога
+    :return: Количество файлов по способу сохранения; перенесенные файлы - под ключом TRANSFER_CARRIED
+    """
+    dirty = set()
+    for path in dirty_paths:
+        rel_path = os.path.relpath(path, source)
+        if rel_path == os.curdir:
+            return backup_files(source, destination, db_file, paranoid=paranoid, batch_size=batch_size,
+                                backend=backend, hash_algorithm=hash_algorithm, progress=progress, cancel=cancel,
+                                report_file=report_file, pack_codec=pack_codec, backup_set=backup_set,
+                                throttle=throttle)
+        if rel_path != os.pardir and not rel_path.startswith(os.pardir + os.sep):
+            dirty.add(tuple(rel_path.split(os.sep)))
+    # Путь внутри измененной директории обходится вместе с ней
+    dirty = {parts for parts in dirty if not any(parts[:i] in dirty for i in range(1, len(parts)))}
+
+    def is_dirty(rel_path):
+        parts = tuple(rel_path.split(os.sep))
+        return any(parts[:i] in dirty for i in range(1, len(parts) + 1))
+
+    stats = Counter()
+    started = time.time()
+    metrics_before = METRICS.snapshot()
+    previous_io = None
+    try:
+        db_conn = create_connection(db_file)
+        create_table(db_conn)
+        previous = get_latest_snapshot(db_conn, source, finished=True, backup_set=backup_set)
+        if previous is None or not os.path.isdir(previous[2]):
+            db_conn.close()
+            return backup_files(source, destination, db_file, paranoid=paranoid, batch_size=batch_size,
+                                backend=backend, hash_algorithm=hash_algorithm, progress=progress, cancel=cancel,
+                                report_file=report_file, pack_codec=pack_codec, backup_set=backup_set,
+                                throttle=throttle)
+        logging.info(f"Начало инкрементного копирования из {source} в {destination}: измененных путей {len(dirty)}")
+        algorithm = resolve_hash_algorithm(db_conn, hash_algorithm, DEFAULT_HASH_ALGORITHM)
+        new_hasher(algorithm)
+        exclusions = ExclusionRules(get_exclusion_rules(db_conn))
+        if throttle is None:
+            throttle = load_throttle(db_conn)
+        if throttle is not None:
+            previous_io = throttle.lower_priority()
+        timestamp, version_path = new_snapshot_dir(destination, source, backup_set)
+        chunk_root = os.path.join(destination, CHUNK_DIR_NAME) if backend == BACKEND_CHUNK else None
+        tracker = start_progress(db_conn, source, timestamp, progress, backup_set)
+
+        # Перенос неизмененных файлов: манифест читается отдельным соединением
+        failed = set()
+        created_dirs = set()
+        previous_packs = os.path.isdir(os.path.join(destination, PACK_DIR_NAME))
+        with closing(create_connection(db_file)) as reader:
+            for rel_path, _, size, _ in get_manifest(reader, previous[0]):
+                if cancel is not None and cancel.is_set():
+                    break
+                if is_dirty(rel_path):
+                    continue
+                file_src = os.path.join(previous[2], rel_path)
+                file_dst = os.path.join(version_path, rel_path)
+                parent = os.path.dirname(file_dst)
+                if parent not in created_dirs:
+                    os.makedirs(parent, exist_ok=True)
+                    created_dirs.add(parent)
+                try:
+                    if previous_packs and size < PACK_FILE_THRESHOLD and not os.path.lexists(file_src):
+                        # Упакованный файл: в снимке его нет, содержимое найдется по индексу пак-файлов
+                        pass
+                    else:
+                        try:
+                            os.link(file_src, file_dst)
+                        except OSError:
+                            # Например, достигнут предел количества ссылок на inode
+                            copy_file(file_src, file_dst)
+                    stats[TRANSFER_CARRIED] += 1
+                    METRICS.add('bytes_carried', size)
+                    if tracker is not None:
+                        tracker.update(size)
+                except OSError as e:
+                    failed.add(rel_path)
+                    logging.error(f"Ошибка при переносе {file_src}: {e}")
+        # Директорий без файлов нет в манифесте: они переносятся по директории предыдущего снимка
+        for dir_path, dir_names, file_names in os.walk(previous[2]):
+            if cancel is not None and cancel.is_set():
+                break
+            rel_dir = os.path.relpath(dir_path, previous[2])
+            dir_names[:] = [name for name in dir_names
+                            if not is_dirty(os.path.normpath(os.path.join(rel_dir, name)))]
+            if not dir_names and not file_names:
+                os.makedirs(os.path.normpath(os.path.join(version_path, rel_dir)), exist_ok=True)
+
+        os.makedirs(version_path, exist_ok=True)
+        packs = open_packs(destination, db_file, pack_codec) if backend == BACKEND_PACK else None
+        try:
+            for parts in sorted(dirty):
+                if cancel is not None and cancel.is_set():
+                    break
+                dirty_src = os.path.join(source, *parts)
+                dirty_dst = os.path.join(version_path, *parts)
+                if os.path.isdir(os.path.dirname(dirty_src)):
+                    # Директория удаленного пути могла остаться пустой, но она есть в источнике
+                    os.makedirs(os.path.dirname(dirty_dst), exist_ok=True)
+                if not os.path.lexists(dirty_src):
+                    continue
+                stats.update(recursive_copy(dirty_src, dirty_dst, db_conn, exclusions, paranoid, batch_size,
+                                            chunk_root, algorithm, tracker, cancel, packs, throttle, destination))
+        finally:
+            if packs is not None:
+                packs.close()
+        db_conn.close()
+
+        cancelled = cancel is not None and cancel.is_set()
+        with closing(create_connection(db_file)) as db_conn, closing(create_connection(db_file)) as reader:
+            # При отмене перенос мог остановиться на середине: в манифест попадают только перенесенные файлы
+            carried = (row for row in get_manifest(reader, previous[0])
+                       if not is_dirty(row[0]) and row[0] not in failed
+                       and (not cancelled or os.path.exists(os.path.join(version_path, row[0]))))
+            with METRICS.timer('db.snapshot'):
+                save_snapshot(db_conn, timestamp, version_path, source, backend, started,
+                              None if cancelled else time.time(), carried, backup_set)
+        if tracker is not None:
+            tracker.report('cancelled' if cancelled else 'finished')
+        logging.info(f"Инкрементное копирование {'отменено' if cancelled else 'завершено'}: {format_stats(stats)}")
+        if report_file:
+            save_run_report(report_file, source, destination, timestamp, started, cancelled, stats, metrics_before)
+    except Exception as e:
+        logging.error(f"Ошибка при инкрементном копировании: {e}")
+        raise
+    finally:
+        # Поток задания переиспользуется следующими заданиями (jobs.JobManager)
+        Throttle.restore_priority(previous_io)
+    return dict(stats)
 
 
-def recursive_copy(src: str, dst: str, db_conn: sqlite3.Connection, excluded_dirs: list) -> None:
+def save_run_report(report_file: str, source: str, destination: str, snapshot: str, started: float,
+                    cancelled: bool, stats: Dict[str, int], metrics_before: Dict) -> None:
     """
-    Рекурсивно копирует файлы и директории.
+    Сохраняет отчет запуска копирования в файл JSON.
+
+    В отчет входят количество файлов по способу сохранения и приращение метрик за запуск:
+    счетчики байтов (bytes_hashed, bytes_copied, bytes_cloned, bytes_linked, bytes_chunked,
+    bytes_carried) и гистограммы длительностей этапов (inspect, hash, transfer.*) и работы
+    с базой данных (db.*).
+
+    :param report_file: Путь к файлу отчета
+    :param source: Исходный путь
+    :param destination: Путь назначения
+    :param snapshot: Имя снимка
+    :param started: Время начала запуска
+    :param cancelled: Запуск был отменен
+    :param stats: Количество файлов по способу сохранения
+    :param metrics_before: Снимок METRICS в начале запуска
+    """
+    finished = time.time()
+    write_report(report_file, dict(source=source, destination=destination, snapshot=snapshot, started=started,
+                                   finished=finished, elapsed=finished - started, cancelled=cancelled,
+                                   files=dict(stats), metrics=diff_metrics(metrics_before, METRICS.snapshot())))
+
+
+def format_stats(stats: Dict[str, int]) -> str:
+    """
+    Форматирует статистику способов сохранения файлов для журнала.
+
+    :param stats: Количество файлов по способу сохранения
+    :return: Строка вида "link=10, reflink=2"
+    """
+    return ", ".join(f"{method}={count}" for method, count in sorted(stats.items())) or "нет файлов"
+
+
+def walk_tree(src: str, dst: str, exclusions: ExclusionRules, db_conn: Optional[sqlite3.Connection] = None,
+              on_dir: Optional[Callable[[str, int, List[str]], None]] = None
+              ) -> Iterator[Tuple[str, str, Optional[os.stat_result]]]:
+    """
+    Обходит дерево каталогов, создает директории в пункте назначения и возвращает пути файлов.
+
+    Обход итеративный, через os.scandir; stat из DirEntry передается дальше, чтобы файл
+    не опрашивался повторно. Если время изменения директории совпадает с сохраненным
+    в индексе директорий, список дочерних имен берется из индекса без чтения директории.
 
     :param src: Исходный путь файла или директории
     :param dst: Путь назначения
-    :param db_conn: Соединение с базой данных
-    :param excluded_dirs: Список директорий, которые следует исключить
+    :param exclusions: Скомпилированные правила исключения
+    :param db_conn: Соединение для чтения индекса директорий или None
+    :param on_dir: Вызывается для каждой прочитанной директории: (путь, mtime_ns, дочерние имена)
+    :return: Итератор (исходный путь файла, путь назначения файла, stat файла или None)
     """
-    # Проверяем, не находится ли директория в списке исключенных
-    if any(os.path.abspath(src).startswith(os.path.abspath(ex_dir)) for ex_dir in excluded_dirs):
+    scan_started_ns = time.time_ns()
+    node, excluded = exclusions.resolve(src)
+    if excluded:
         logging.info(f"Директория {src} пропущена (находится в списке исключенных)")
         return
+    stack = [(src, dst, None, node)]
+    while stack:
+        src, dst, st, node = stack.pop()
+        try:
+            if st is None:
+                st = os.stat(src)
+            if not stat.S_ISDIR(st.st_mode):
+                yield src, dst, st
+                continue
+            os.makedirs(dst, exist_ok=True)
+            indexed = get_dir_index(db_conn, src) if db_conn is not None else None
+            if indexed and indexed[0] == st.st_mtime_ns:
+                children = [(name, None) for name in indexed[1]]
+            else:
+                with os.scandir(src) as it:
+                    children = [(entry.name, entry) for entry in it]
+                # Директорию, измененную прямо во время обхода, не запоминаем: следующее изменение
+                # может попасть в тот же квант времени и не изменить mtime
+                if on_dir is not None and scan_started_ns - st.st_mtime_ns > DIR_INDEX_RACY_NS:
+                    on_dir(src, st.st_mtime_ns, [name for name, _ in children])
+            for name, entry in reversed(children):
+                child_src = os.path.join(src, name)
+                # Исключенное поддерево отсекается до того, как его запись будет опрошена
+                child_node, excluded = exclusions.descend(node, child_src, name)
+                if excluded:
+                    logging.info(f"Директория {child_src} пропущена (находится в списке исключенных)")
+                    continue
+                child_st = None
+                if entry is not None:
+                    try:
+                        child_st = entry.stat()
+                    except OSError:
+                        pass
+                stack.append((child_src, os.path.join(dst, name), child_st, child_node))
+        except Exception as e:
+            logging.error(f"Ошибка при обработке {src}: {e}")
+
+
+def recursive_copy(src: str, dst: str, db_conn: sqlite3.Connection, exclusions: ExclusionRules,
+                   paranoid: bool = False, batch_size: int = DB_BATCH_SIZE,
+                   chunk_root: Optional[str] = None, algorithm: str = DEFAULT_HASH_ALGORITHM,
+                   tracker: Optional[Progress] = None, cancel: Optional[threading.Event] = None,
+                   packs: Optional[PackWriter] = None, throttle: Optional[Throttle] = None,
+                   destination: Optional[str] = None) -> Counter:
+    """
+    Последовательно копирует файлы и директории.
 
+    :param src: Исходный путь файла или директории
+    :param dst: Путь назначения
+    :param db_conn: Соединение с базой данных
+    :param exclusions: Скомпилированные правила исключения
+    :param paranoid: Заново хешировать все файлы, не доверяя совпадению метаданных
+    :param batch_size: Количество файлов в одной транзакции базы данных (0 - одна на снимок);
+                       транзакция фиксируется и по истечении DB_BATCH_SECONDS
+    :param chunk_root: Корень хранилища фрагментов или None для хранения целыми файлами
+    :param algorithm: Алгоритм хеширования репозитория
+    :param tracker: Счетчик хода копирования или None
+    :param cancel: Событие отмены: обход останавливается, обработанные файлы фиксируются
+    :param packs: Пак-файлы для небольших файлов или None
+    :param throttle: Ограничение скорости и приоритета ввода-вывода или None
+    :param destination: Пункт назначения: жесткие ссылки создаются только на копии в нем
+    :return: Количество файлов по способу сохранения
+    """
+    stats = Counter()
+    count = 0
+    batch_started = time.monotonic()
     try:
-        if os.path.isdir(src):
-            if not os.path.exists(dst):
-                os.makedirs(dst)
-            for file in os.listdir(src):
-                recursive_copy(os.path.join(src, file), os.path.join(dst, file), db_conn, excluded_dirs)
+        def on_dir(dir_path, mtime_ns, children):
+            save_dir_index(db_conn, dir_path, mtime_ns, children, commit=False)
+
+        for file_src, file_dst, file_st in walk_tree(src, dst, exclusions, db_conn, on_dir):
+            if cancel is not None and cancel.is_set():
+                logging.info(f"Копирование {src} отменено")
+                break
+            if throttle is not None:
+                throttle.consume_files()
+            try:
+                if file_st is None:
+                    file_st = os.stat(file_src)
+                stats[process_file(file_src, file_dst, db_conn, paranoid, commit=False, chunk_root=chunk_root,
+                                   algorithm=algorithm, st=file_st, packs=packs, throttle=throttle,
+                                   destination=destination)] += 1
+                if tracker is not None:
+                    tracker.update(file_st.st_size)
+            except Exception as e:
+                logging.error(f"Ошибка при обработке {file_src}: {e}")
+            count += 1
+            if batch_size and (count % batch_size == 0 or time.monotonic() - batch_started >= DB_BATCH_SECONDS):
+                commit_batch(db_conn, packs)
+                batch_started = time.monotonic()
+    finally:
+        commit_batch(db_conn, packs)
+    return stats
+
+
+def inspect_file(src: str, db_conn: Optional[sqlite3.Connection] = None, paranoid: bool = False,
+                 algorithm: str = DEFAULT_HASH_ALGORITHM, st: Optional[os.stat_result] = None,
+                 limiter: Optional[RateLimiter] = None) -> FileInfo:
+    """
+    Собирает метаданные и хеш файла.
+
+    Если путь, размер, mtime, inode и ctime совпадают с записью предыдущего снимка,
+    хеш берется из базы данных и файл не читается. Для файлов от LARGE_FILE_SIZE сначала
+    считается хеш образцов, а полный хеш - только если в базе есть файл того же размера
+    с теми же образцами; иначе хеш вычисляется при копировании.
+
+    :param src: Исходный путь файла
+    :param db_conn: Соединение с базой данных для поиска в кэше метаданных и по образцам
+    :param paranoid: Не использовать кэш метаданных
+    :param algorithm: Алгоритм хеширования репозитория
+    :param st: Результат stat, уже полученный при обходе
+    :param limiter: Ограничение скорости чтения в байтах в секунду или None
+    :return: Сведения о файле
+    """
+    if st is None:
+        st = os.stat(src)
+    if db_conn is not None and not paranoid:
+        with METRICS.timer('db.cache'):
+            cached = get_cached_file_data(db_conn, src, st.st_size, st.st_mtime_ns, st.st_ino, st.st_ctime_ns)
+        if cached:
+            return FileInfo(st.st_size, st.st_mtime, st.st_mtime_ns, st.st_ino, st.st_ctime_ns,
+                            cached[0], cached[1])
+    if st.st_size < LARGE_FILE_SIZE:
+        return FileInfo(st.st_size, st.st_mtime, st.st_mtime_ns, st.st_ino, st.st_ctime_ns,
+                        calculate_hash(src, algorithm, limiter=limiter))
+    sample_hash = calculate_sample_hash(src, algorithm=algorithm, limiter=limiter)
+    file_hash = None
+    if db_conn is not None and sample_hash and has_sample_match(db_conn, st.st_size, sample_hash):
+        file_hash = calculate_hash(src, algorithm, limiter=limiter)
+    return FileInfo(st.st_size, st.st_mtime, st.st_mtime_ns, st.st_ino, st.st_ctime_ns, file_hash,
+                    sample_hash=sample_hash)
+
+
+def find_existing_copy(db_conn: sqlite3.Connection, info: FileInfo,
+                       destination: Optional[str] = None) -> Tuple[Optional[str], Optional[str]]:
+    """
+    Ищет в базе данных уже сохраненную копию файла.
+
+    Каталог может быть общим для нескольких пунктов назначения (наборы с --db), а жесткая
+    ссылка возможна только в пределах одной файловой системы, поэтому копии ищутся внутри
+    пункта назначения.
+
+    :param db_conn: Соединение с базой данных
+    :param info: Сведения о файле
+    :param destination: Пункт назначения или None - искать во всем каталоге
+    :return: Кортеж (хеш, путь к существующей копии); путь равен None, если копия не найдена
+    """
+    if info.cached_path and (destination is None or info.cached_path.startswith(os.path.join(destination, ''))):
+        return info.hash, info.cached_path
+    if info.hash is None:
+        # Большой файл без совпадений по образцам: копии заведомо нет
+        return None, None
+    with METRICS.timer('db.lookup'):
+        existing_data = get_file_data(db_conn, file_hash=info.hash, backup_dir=destination)
+    if not existing_data:
+        return info.hash, None
+    return info.hash, existing_data[3]
+
+
+def transfer_file(src: str, dst: str, file_size: int, file_hash: Optional[str], backup_path: Optional[str],
+                  chunk_root: Optional[str] = None, algorithm: str = DEFAULT_HASH_ALGORITHM,
+                  packs: Optional[PackWriter] = None,
+                  limiter: Optional[RateLimiter] = None) -> Tuple[str, Optional[Any], str]:
+    """
+    Создает жесткую ссылку на существующую копию, копирует файл или разбивает его на фрагменты.
+
+    С пак-файлами небольшой файл не появляется в снимке: его содержимое дописывается в пак-файл
+    (если его там еще нет), а место в пак-файле записывается в каталог (см. record_file).
+
+    :param src: Исходный путь файла
+    :param dst: Путь назначения файла
+    :param file_size: Размер файла
+    :param file_hash: Хеш файла или None - тогда он вычисляется при копировании
+    :param backup_path: Путь к существующей копии или None
+    :param chunk_root: Корень хранилища фрагментов или None для хранения целыми файлами
+    :param algorithm: Алгоритм хеширования репозитория
+    :param packs: Пак-файлы для небольших файлов или None
+    :param limiter: Ограничение скорости чтения в байтах в секунду или None
+    :return: Кортеж (хеш файла, список фрагментов или место в пак-файле (PackEntry) или None, способ сохранения)
+    """
+    if os.path.lexists(dst):
+        # Файл уже есть в продолжаемом снимке. Если это другая версия, ее нельзя перезаписывать
+        # на месте: она может быть жесткой ссылкой на файл предыдущих снимков
+        if backup_path == dst:
+            return file_hash, None, TRANSFER_LINK
+        os.unlink(dst)
+    # Сообщения о каждом файле - на уровне DEBUG и без f-строк: при выключенном уровне
+    # строка не форматируется, а итог запуска пишется в журнал одной строкой
+    started = time.perf_counter()
+    if packs is not None and file_size < PACK_FILE_THRESHOLD:
+        entry = packs.find(file_hash) if file_hash else None
+        method = TRANSFER_PACK_REF
+        if entry is None:
+            if limiter is not None:
+                limiter.consume(file_size)
+            with open(src, 'rb') as f:
+                data = f.read()
+            if file_hash is None:
+                hasher = new_hasher(algorithm)
+                hasher.update(data)
+                file_hash = hasher.hexdigest()
+            entry, added = packs.add(file_hash, data)
+            if added:
+                method = TRANSFER_PACK
+                METRICS.add('bytes_packed', entry.length)
+        METRICS.observe('transfer.pack', time.perf_counter() - started)
+        logging.debug("Файл упакован: %s (%s)", src, method)
+        return file_hash, entry, method
+    # Если ссылку создать не удалось (например, достигнут предел количества ссылок на inode),
+    # файл сохраняется обычным образом
+    if backup_path and os.path.exists(backup_path) and create_hard_link(backup_path, dst):
+        METRICS.add('bytes_linked', file_size)
+        METRICS.observe('transfer.link', time.perf_counter() - started)
+        logging.debug("Создана жесткая ссылка для файла: %s -> %s", src, dst)
+        return file_hash, None, TRANSFER_LINK
+    if chunk_root and file_size >= CHUNK_FILE_THRESHOLD:
+        file_hash, chunks = store_file(src, chunk_root, algorithm, limiter)
+        write_pointer(dst, file_hash, file_size)
+        METRICS.add('bytes_chunked', file_size)
+        METRICS.observe('transfer.chunk', time.perf_counter() - started)
+        logging.debug("Файл сохранен фрагментами: %s (%d фрагм.)", src, len(chunks))
+        return file_hash, chunks, TRANSFER_CHUNK
+    if file_hash is None:
+        # Клон экстентов почти бесплатен, и тогда хеш дешевле посчитать отдельно;
+        # иначе копируем и хешируем за один проход чтения
+        method = copy_file(src, dst, strategies=(COPY_REFLINK,))
+        if method:
+            file_hash = calculate_hash(src, algorithm, limiter=limiter)
         else:
-            process_file(src, dst, db_conn)
-    except Exception as e:
-        logging.error(f"Ошибка при обработке {src}: {e}")
+            file_hash = copy_with_hash(src, dst, algorithm=algorithm, limiter=limiter)
+            method = COPY_BUFFERED
+    else:
+        method = copy_file(src, dst, limiter=limiter)
+    METRICS.observe('transfer.copy', time.perf_counter() - started)
+    logging.debug("Скопирован файл: %s", src)
+    return file_hash, None, method
 
 
-def process_file(src: str, dst: str, db_conn: sqlite3.Connection) -> None:
+def record_file(db_conn: sqlite3.Connection, src: str, dst: str, info: FileInfo, file_hash: str,
+                chunks: Optional[Any] = None, commit: bool = True) -> None:
+    """
+    Сохраняет в базе данных сведения о скопированном файле.
+
+    :param db_conn: Соединение с базой данных
+    :param src: Исходный путь файла
+    :param dst: Путь назначения файла
+    :param info: Сведения о файле
+    :param file_hash: Хеш файла
+    :param chunks: Список фрагментов файла, если он сохранен фрагментами, или место в пак-файле (PackEntry)
+    :param commit: Зафиксировать транзакцию сразу
+    """
+    with METRICS.timer('db.record'):
+        if isinstance(chunks, PackEntry):
+            insert_pack_object(db_conn, file_hash, *chunks, commit=False)
+        elif chunks:
+            insert_file_chunks(db_conn, file_hash, chunks, commit=False)
+        insert_file_data(db_conn, src, info.size, info.last_modified, file_hash, dst,
+                         info.mtime_ns, info.inode, info.ctime_ns, info.sample_hash, commit)
+
+
+def process_file(src: str, dst: str, db_conn: sqlite3.Connection, paranoid: bool = False,
+                 commit: bool = True, chunk_root: Optional[str] = None,
+                 algorithm: str = DEFAULT_HASH_ALGORITHM, st: Optional[os.stat_result] = None,
+                 packs: Optional[PackWriter] = None, throttle: Optional[Throttle] = None,
+                 destination: Optional[str] = None) -> str:
     """
     Обрабатывает отдельный файл: копирование или создание жесткой ссылки.
 
     :param src: Исходный путь файла
     :param dst: Путь назначения файла
     :param db_conn: Соединение с базой данных
+    :param paranoid: Заново хешировать файл, не доверяя совпадению метаданных
+    :param commit: Зафиксировать транзакцию сразу
+    :param chunk_root: Корень хранилища фрагментов или None для хранения целыми файлами
+    :param algorithm: Алгоритм хеширования репозитория
+    :param st: Результат stat, уже полученный при обходе
+    :param packs: Пак-файлы для небольших файлов или None
+    :param throttle: Ограничение скорости и приоритета ввода-вывода или None
+    :param destination: Пункт назначения: жесткие ссылки создаются только на копии в нем
+    :return: Способ сохранения файла
     """
-    file_size = os.path.getsize(src)
-    last_modified = os.path.getmtime(src)
-    file_hash = calculate_sha256(src) if file_size < 500 * 1024 * 1024 else None
+    with METRICS.timer('inspect'):
+        info = inspect_file(src, db_conn, paranoid, algorithm, st, throttle)
+    file_hash, backup_path = find_existing_copy(db_conn, info, destination)
+    file_hash, chunks, method = transfer_file(src, dst, info.size, file_hash, backup_path, chunk_root, algorithm,
+                                              packs, throttle)
+    if throttle is not None and info.cached_path is None:
+        # Файл из кэша метаданных не читался: его страницы в кэше принадлежат не нам
+        throttle.release(src)
+    record_file(db_conn, src, dst, info, file_hash, chunks, commit)
+    return method
 
-    existing_data = get_file_data(db_conn, file_hash=file_hash, size=file_size, last_modified=last_modified)
 
-    if not existing_data:
-        shutil.copy(src, dst)
-        file_hash = calculate_sha256(src) if file_hash is None else file_hash
-        insert_file_data(db_conn, src, file_size, last_modified, file_hash, dst)
-        logging.info(f"Скопирован файл: {src}")
-    else:
-        file_hash = existing_data[1] if file_size >= 500 * 1024 * 1024 else file_hash
-        backup_path = existing_data[2] if file_size >= 500 * 1024 * 1024 else existing_data[3]
-        if os.path.exists(backup_path):
-            create_hard_link(backup_path, dst)
-            logging.info(f"Создана жесткая ссылка для файла: {src} -> {dst}")
-        else:
-            shutil.copy(src, dst)
-            logging.info(f"Скопирован файл: {src}")
+def pipelined_copy(src: str, dst: str, db_file: str, exclusions: ExclusionRules,
+                   hash_workers: int = DEFAULT_HASH_WORKERS, copy_workers: int = DEFAULT_COPY_WORKERS,
+                   paranoid: bool = False, batch_size: int = DB_BATCH_SIZE,
+                   chunk_root: Optional[str] = None, algorithm: str = DEFAULT_HASH_ALGORITHM,
+                   tracker: Optional[Progress] = None, cancel: Optional[threading.Event] = None,
+                   packs: Optional[PackWriter] = None, throttle: Optional[Throttle] = None,
+                   destination: Optional[str] = None) -> Counter:
+    """
+    Копирует дерево конвейером: обход -> пул хеширования -> пул копирования/ссылок.
+
+    Все записи в базу данных и поиск копий выполняет один поток, владеющий соединением;
+    потоки хеширования только читают кэш метаданных и хеши образцов через собственные соединения.
+    Одинаковые файлы внутри одного запуска связываются жесткими ссылками так же, как в
+    последовательном режиме: повторный файл ждет завершения копирования первого экземпляра.
+    Ошибка потока базы данных (например, при фиксации пачки) останавливает обход и передается
+    вызывающему.
+
+    :param src: Исходный путь
+    :param dst: Путь назначения (директория версии)
+    :param db_file: Путь к файлу базы данных
+    :param exclusions: Скомпилированные правила исключения
+    :param hash_workers: Количество потоков хеширования
+    :param copy_workers: Количество потоков копирования
+    :param paranoid: Заново хешировать все файлы, не доверяя совпадению метаданных
+    :param batch_size: Количество файлов в одной транзакции базы данных (0 - одна на снимок);
+                       транзакция фиксируется и по истечении DB_BATCH_SECONDS
+    :param chunk_root: Корень хранилища фрагментов или None для хранения целыми файлами
+    :param algorithm: Алгоритм хеширования репозитория
+    :param tracker: Счетчик хода копирования или None (обновляется потоком базы данных)
+    :param cancel: Событие отмены: обход останавливается, файлы в конвейере дообрабатываются
+    :param packs: Пак-файлы для небольших файлов или None
+    :param throttle: Ограничение скорости и приоритета ввода-вывода или None; корзина байтов общая
+                     для потоков хеширования и копирования
+    :param destination: Пункт назначения: жесткие ссылки создаются только на копии в нем
+    :return: Количество файлов по способу сохранения
+    """
+    stats = Counter()
+    events = queue.Queue()
+    pending = threading.BoundedSemaphore(PIPELINE_QUEUE_FACTOR * (hash_workers + copy_workers))
+    # Ошибка потока базы данных: после нее места в конвейере не освобождаются, и обход прекращается
+    failed = threading.Event()
+    errors = []
+    hash_pool = ThreadPoolExecutor(max_workers=hash_workers, thread_name_prefix="capsule-hash")
+    copy_pool = ThreadPoolExecutor(max_workers=copy_workers, thread_name_prefix="capsule-copy")
+    local = threading.local()
+    readers = []
+
+    def inspect(file_src, file_st):
+        if not hasattr(local, "conn"):
+            local.conn = create_connection(db_file, check_same_thread=False)
+            readers.append(local.conn)
+        with METRICS.timer('inspect'):
+            return inspect_file(file_src, local.conn, paranoid, algorithm, file_st, throttle)
 
-        insert_file_data(db_conn, src, file_size, last_modified, file_hash, dst)
+    def on_hashed(future, file_src, file_dst):
+        try:
+            events.put(("hashed", file_src, file_dst, future.result()))
+        except Exception as e:
+            events.put(("failed", file_src, file_dst, e))
 
+    def on_transferred(future, file_src, file_dst, info):
+        try:
+            events.put(("done", file_src, file_dst, (info, future.result())))
+        except Exception as e:
+            events.put(("failed", file_src, file_dst, e))
 
-def restore_backup(backup_path, orig_path):
+    def transfer(file_src, file_dst, info, file_hash, backup_path):
+        result = transfer_file(file_src, file_dst, info.size, file_hash, backup_path, chunk_root, algorithm, packs,
+                               throttle)
+        if throttle is not None and info.cached_path is None:
+            throttle.release(file_src)
+        return result
+
+    def submit_transfer(file_src, file_dst, info, file_hash, backup_path):
+        future = copy_pool.submit(transfer, file_src, file_dst, info, file_hash, backup_path)
+        future.add_done_callback(lambda f: on_transferred(f, file_src, file_dst, info))
+        return future
+
+    def rehash(file_src, info):
+        file_hash = calculate_hash(file_src, algorithm, limiter=throttle)
+        if file_hash is None:
+            raise OSError(f"Не удалось вычислить хеш файла {file_src}")
+        return info._replace(hash=file_hash)
+
+    def submit_after(first, file_src, file_dst, info, first_dst):
+        # Повторный файл обрабатывается только после завершения копирования первого экземпляра
+        def resubmit(_):
+            if failed.is_set():
+                return
+            if info.hash is None:
+                # Большой файл совпал с первым лишь по образцам: считаем полный хеш и ищем копию заново
+                future = hash_pool.submit(rehash, file_src, info)
+                future.add_done_callback(lambda f: on_hashed(f, file_src, file_dst))
+            else:
+                submit_transfer(file_src, file_dst, info, info.hash, first_dst)
+        first.add_done_callback(resubmit)
+
+    def db_worker():
+        db_conn = create_connection(db_file)
+        in_flight = {}
+        in_flight_keys = {}
+        total = None
+        finished = 0
+        batch_started = time.monotonic()
+        try:
+            while total is None or finished < total:
+                try:
+                    # Пока поток ждет событий, незафиксированные изменения не держат блокировку записи
+                    kind, file_src, file_dst, payload = events.get(
+                        timeout=DB_BATCH_SECONDS if batch_size and db_conn.in_transaction else None)
+                except queue.Empty:
+                    commit_batch(db_conn, packs)
+                    batch_started = time.monotonic()
+                    continue
+                if kind == "walked":
+                    total = payload
+                elif kind == "dir":
+                    save_dir_index(db_conn, file_src, *payload, commit=False)
+                elif kind == "hashed":
+                    info = payload
+                    key = info.hash or (info.size, info.sample_hash)
+                    if key in in_flight:
+                        first, first_dst = in_flight[key]
+                        submit_after(first, file_src, file_dst, info, first_dst)
+                        continue
+                    try:
+                        file_hash, backup_path = find_existing_copy(db_conn, info, destination)
+                    except Exception as e:
+                        events.put(("failed", file_src, file_dst, e))
+                        continue
+                    in_flight[key] = (submit_transfer(file_src, file_dst, info, file_hash, backup_path), file_dst)
+                    in_flight_keys[file_dst] = key
+                else:
+                    finished += 1
+                    pending.release()
+                    # После записи в базу следующие копии найдутся обычным поиском по хешу. Большие
+                    # файлы без полного хеша остаются в in_flight до конца запуска: потоки хеширования
+                    # не видят незафиксированных записей и не найдут их по образцам.
+                    key = in_flight_keys.pop(file_dst, None)
+                    if isinstance(key, str):
+                        del in_flight[key]
+                    if kind == "done":
+                        info, (file_hash, chunks, method) = payload
+                        stats[method] += 1
+                        record_file(db_conn, file_src, file_dst, info, file_hash, chunks, commit=False)
+                        if tracker is not None:
+                            tracker.update(info.size)
+                    else:
+                        logging.error(f"Ошибка при обработке {file_src}: {payload}")
+                    if batch_size and (finished % batch_size == 0
+                                       or time.monotonic() - batch_started >= DB_BATCH_SECONDS):
+                        commit_batch(db_conn, packs)
+                        batch_started = time.monotonic()
+            commit_batch(db_conn, packs)
+        except Exception as e:
+            logging.error(f"Ошибка потока базы данных при копировании {src}: {e}")
+            errors.append(e)
+            failed.set()
+        finally:
+            db_conn.close()
+
+    db_thread = threading.Thread(target=db_worker, name="capsule-db")
+    db_thread.start()
+    count = 0
+    # Обходчик читает индекс директорий своим соединением, а изменения отдает потоку базы данных
+    walker_conn = create_connection(db_file)
+    try:
+        def on_dir(dir_path, mtime_ns, children):
+            events.put(("dir", dir_path, None, (mtime_ns, children)))
+
+        for file_src, file_dst, file_st in walk_tree(src, dst, exclusions, walker_conn, on_dir):
+            if cancel is not None and cancel.is_set():
+                logging.info(f"Копирование {src} отменено")
+                break
+            if throttle is not None:
+                throttle.consume_files()
+            while not failed.is_set() and not pending.acquire(timeout=PIPELINE_POLL_SECONDS):
+                pass
+            if failed.is_set():
+                break
+            future = hash_pool.submit(inspect, file_src, file_st)
+            future.add_done_callback(lambda f, s=file_src, d=file_dst: on_hashed(f, s, d))
+            count += 1
+    finally:
+        walker_conn.close()
+        events.put(("walked", None, None, count))
+        db_thread.join()
+        hash_pool.shutdown(cancel_futures=failed.is_set())
+        copy_pool.shutdown(cancel_futures=failed.is_set())
+        for reader in readers:
+            reader.close()
+    if errors:
+        raise errors[0]
+    return stats
+
+
+class RestoreItem(NamedTuple):
+    """ Файл снимка, который нужно записать в целевую директорию или проверить по хешу. """
+    src: str
+    dst: str
+    action: str
+    size: int
+    # Хеш содержимого из каталога или файла-указателя, если известен
+    hash: Optional[str]
+    # Время изменения исходного файла из каталога: совпадение вместе с размером значит, что файл не менялся
+    mtime_ns: Optional[int]
+    pointer: bool
+    # Файла нет в директории снимка: содержимое лежит в пак-файле
+    packed: bool = False
+
+
+class RestorePlan(NamedTuple):
+    """ План восстановления: что записать, что проверить, что удалить и какие директории создать. """
+    items: List[RestoreItem]
+    extras: List[str]
+    unchanged: int
+    # Директории снимка, которых нет в целевой директории, родительские раньше дочерних
+    dirs: List[str]
+
+
+def plan_restore(backup_path: str, restore_path: str, entries: Dict[str, Tuple[str, int, Optional[int]]],
+                 exclusions: ExclusionRules, use_pointers: bool = False, use_packs: bool = False) -> RestorePlan:
+    """
+    Сравнивает снимок с целевой директорией, не изменяя ее.
+
+    Файл с тем же размером и временем изменения, что записаны в каталоге, считается
+    неизменным. Файл того же размера, но с другим временем, проверяется по хешу при
+    восстановлении. Остальные файлы записываются заново. Записи целевой директории,
+    которых нет в снимке, удаляются, кроме попадающих под правила исключения: они не
+    копировались и поэтому не могли попасть в снимок. Упакованные файлы, которых нет
+    в директории снимка, берутся из записей манифеста. Каждая директория снимка, которой
+    нет в целевой директории, попадает в план, в том числе пустая.
+
+    :param backup_path: Путь до папки резервной копии
+    :param restore_path: Путь до целевой папки
+    :param entries: Записи манифеста для файлов снимка: путь в снимке -> (хеш, размер, mtime_ns)
+    :param exclusions: Скомпилированные правила исключения
+    :param use_pointers: Распознавать файлы-указатели хранилища фрагментов
+    :param use_packs: Искать в манифесте упакованные файлы
+    :return: План восстановления
+    """
+    items, extras, dirs = [], [], []
+    unchanged = 0
+    manifest_dirs = {}
+    if use_packs:
+        for path, entry in entries.items():
+            manifest_dirs.setdefault(os.path.dirname(path), {})[os.path.basename(path)] = entry
+    stack = [(backup_path, restore_path, os.path.isdir(restore_path) and not os.path.islink(restore_path))]
+    if os.path.lexists(restore_path) and not stack[0][2]:
+        extras.append(restore_path)
+    while stack:
+        snap_dir, target_dir, target_exists = stack.pop()
+        if not target_exists:
+            dirs.append(target_dir)
+        try:
+            with os.scandir(snap_dir) as it:
+                snap_entries = {entry.name: entry for entry in it}
+            target_entries = {}
+            if target_exists:
+                with os.scandir(target_dir) as it:
+                    target_entries = {entry.name: entry for entry in it}
+        except OSError as e:
+            logging.error(f"Ошибка при чтении {snap_dir}: {e}")
+            continue
+        packed = {name: entry for name, entry in manifest_dirs.get(snap_dir, {}).items() if name not in snap_entries}
+        for name, target_entry in target_entries.items():
+            if name not in snap_entries and name not in packed and not exclusions.is_excluded(target_entry.path):
+                extras.append(target_entry.path)
+        for name, (file_hash, size, mtime_ns) in packed.items():
+            dst = os.path.join(target_dir, name)
+            target_entry = target_entries.get(name)
+            try:
+                target_st = target_entry.stat(follow_symlinks=False) if target_entry is not None else None
+            except OSError:
+                target_st = None
+            if target_st is None or not stat.S_ISREG(target_st.st_mode):
+                if target_st is not None:
+                    extras.append(dst)
+                action = RESTORE_WRITE
+            elif target_st.st_size != size:
+                action = RESTORE_WRITE
+            elif mtime_ns is not None and target_st.st_mtime_ns == mtime_ns:
+                unchanged += 1
+                continue
+            else:
+                action = RESTORE_CHECK
+            items.append(RestoreItem(os.path.join(snap_dir, name), dst, action, size, file_hash, mtime_ns, False,
+                                     packed=True))
+        for name, snap_entry in snap_entries.items():
+            dst = os.path.join(target_dir, name)
+            target_entry = target_entries.get(name)
+            try:
+                target_st = target_entry.stat(follow_symlinks=False) if target_entry is not None else None
+                if snap_entry.is_dir():
+                    is_dir = target_st is not None and stat.S_ISDIR(target_st.st_mode)
+                    if target_st is not None and not is_dir:
+                        extras.append(dst)
+                    stack.append((snap_entry.path, dst, is_dir))
+                    continue
+                snap_st = snap_entry.stat()
+                pointer = None
+                if use_pointers and snap_st.st_size <= POINTER_MAX_SIZE:
+                    pointer = read_pointer(snap_entry.path)
+                catalog = entries.get(snap_entry.path)
+                if pointer:
+                    file_hash, size = pointer
+                else:
+                    file_hash, size = (catalog[0] if catalog else None), snap_st.st_size
+                mtime_ns = catalog[2] if catalog and catalog[1] == size else None
+                if target_st is None or not stat.S_ISREG(target_st.st_mode):
+                    if target_st is not None:
+                        extras.append(dst)
+                    action = RESTORE_WRITE
+                elif target_st.st_size != size:
+                    action = RESTORE_WRITE
+                elif mtime_ns is not None and target_st.st_mtime_ns == mtime_ns:
+                    unchanged += 1
+                    continue
+                else:
+                    action = RESTORE_CHECK
+                items.append(RestoreItem(snap_entry.path, dst, action, size, file_hash, mtime_ns, bool(pointer)))
+            except OSError as e:
+                logging.error(f"Ошибка при сравнении {snap_entry.path}: {e}")
+    return RestorePlan(items, extras, unchanged, dirs)
+
+
+def format_plan(plan: RestorePlan) -> Dict[str, int]:
+    """
+    Сводка плана восстановления для пробного запуска.
+
+    :param plan: План восстановления
+    :return: Количество файлов и байт по действиям, количество удаляемых и неизменных записей
+             и создаваемых директорий
+    """
+    stats = Counter()
+    for item in plan.items:
+        stats[item.action] += 1
+        stats[f"{item.action}_bytes"] += item.size
+    stats[RESTORE_DELETE] = len(plan.extras)
+    stats[RESTORE_UNCHANGED] = plan.unchanged
+    stats[RESTORE_MKDIR] = len(plan.dirs)
+    return dict(stats)
+
+
+def write_restored_file(src: str, dst: str, file_hash: Optional[str], mtime_ns: Optional[int],
+                        reader: Callable[[], sqlite3.Connection], chunk_root: str, pack_root: str,
+                        pointer: bool = False, packed: bool = False) -> str:
+    """
+    Записывает файл снимка в целевой путь.
+
+    Существующий файл перед записью удаляется, а не перезаписывается: он может быть
+    жесткой ссылкой. Упакованное содержимое и фрагменты читаются через mmap и пишутся
+    по частям (см. pack_store.stream_object, chunk_store.assemble_file), обычный файл
+    снимка копируется вместе с правами доступа.
+
+    :param src: Путь файла в снимке
+    :param dst: Целевой путь
+    :param file_hash: Хеш содержимого из каталога или файла-указателя
+    :param mtime_ns: Время изменения исходного файла из каталога или None
+    :param reader: Возвращает соединение с базой данных текущего потока (нужно для фрагментов и пак-файлов)
+    :param chunk_root: Корень хранилища фрагментов
+    :param pack_root: Директория пак-файлов
+    :param pointer: В снимке лежит файл-указатель хранилища фрагментов
+    :param packed: Файла нет в директории снимка, содержимое лежит в пак-файле
+    :return: Способ восстановления (TRANSFER_PACK, TRANSFER_CHUNK или способ копирования)
+    """
+    os.makedirs(os.path.dirname(dst), exist_ok=True)
+    if os.path.lexists(dst):
+        os.unlink(dst)
+    method = None
+    if packed:
+        entry = get_pack_object(reader(), file_hash)
+        if entry is None:
+            raise FileNotFoundError(f"Содержимое {file_hash} не найдено в индексе пак-файлов")
+        with open(dst, 'wb') as f:
+            stream_object(pack_root, PackEntry(*entry), f)
+        method = TRANSFER_PACK
+    elif pointer:
+        chunk_hashes = get_file_chunks(reader(), file_hash)
+        if chunk_hashes:
+            assemble_file(chunk_root, chunk_hashes, dst)
+            method = TRANSFER_CHUNK
+    if method is None:
+        method = copy_file(src, dst)
+        shutil.copystat(src, dst)
+    if mtime_ns is not None:
+        os.utime(dst, ns=(mtime_ns, mtime_ns))
+    return method
+
+
+def restore_backup(backup_path, orig_path, db_file=None, workers=DEFAULT_RESTORE_WORKERS, dry_run=False):
     """
         Восстанавливает выбранную резервную копию.
 
+        Восстановление разностное: целевая директория сравнивается со снимком (см. plan_restore),
+        переписываются только отличающиеся файлы и удаляются только лишние записи. Файлы
+        записываются пулом потоков (см. write_restored_file). Существующий файл перед записью
+        удаляется, а не перезаписывается: он может быть жесткой ссылкой, и запись через него
+        изменила бы другие файлы. Отдельные файлы и поддиректории восстанавливает
+        browse.restore_files. Файлы-указатели хранилища фрагментов собираются обратно из фрагментов,
+        упакованные файлы читаются из пак-файлов по индексу; права доступа упакованных файлов
+        не сохраняются, они создаются с правами по умолчанию.
+
         :param backup_path: Путь до папки резервной копии
         :param orig_path: Путь до оригинальной папки
+        :param db_file: Путь к файлу базы данных (по умолчанию - рядом с резервными копиями)
+        :param workers: Количество потоков восстановления
+        :param dry_run: Только составить план и вернуть его сводку, ничего не изменяя
+        :return: Количество файлов по способу восстановления или сводка плана при dry_run
     """
-    print(backup_path, orig_path)
+    backup_path = os.path.normpath(backup_path)
     restore_path = orig_path
+    destination = os.path.dirname(backup_path)
+    db_file = db_file or os.path.join(destination, 'backup_db.sqlite')
+    chunk_root = os.path.join(destination, CHUNK_DIR_NAME)
+    use_pointers = os.path.isdir(chunk_root)
+    pack_root = os.path.join(destination, PACK_DIR_NAME)
+    use_packs = os.path.isdir(pack_root)
+    entries, rules, algorithm = {}, [], DEFAULT_HASH_ALGORITHM
+    if os.path.exists(db_file):
+        db_conn = create_connection(db_file)
+        if db_conn is not None:
+            try:
+                snapshot = get_snapshot(db_conn, os.path.basename(backup_path))
+                if snapshot is not None:
+                    entries = {os.path.join(backup_path, rel_path): (file_hash, size, mtime_ns)
+                               for rel_path, file_hash, size, mtime_ns in get_manifest(db_conn, snapshot[0])}
+                else:
+                    # Снимки, созданные до появления манифестов: ищем по последнему пути копии в каталоге
+                    entries = get_backup_entries(db_conn, backup_path)
+                rules = get_exclusion_rules(db_conn)
+                algorithm = get_setting(db_conn, 'hash_algorithm', DEFAULT_HASH_ALGORITHM)
+            finally:
+                db_conn.close()
 
-    if os.path.exists(restore_path):
-        # Очистка целевой директории перед восстановлением
-        for filename in os.listdir(restore_path):
-            file_path = os.path.join(restore_path, filename)
-            if os.path.isfile(file_path) or os.path.islink(file_path):
-                os.unlink(file_path)
-            elif os.path.isdir(file_path):
-                shutil.rmtree(file_path)
-
-    # Копирование файлов из резервной копии
-    for filename in os.listdir(backup_path):
-        src_path = os.path.join(backup_path, filename)
-        dst_path = os.path.join(restore_path, filename)
-        if os.path.isdir(src_path):
-            shutil.copytree(src_path, dst_path)
-        else:
-            shutil.copy2(src_path, dst_path)
+    plan = plan_restore(backup_path, restore_path, entries, ExclusionRules(rules), use_pointers, use_packs)
+    summary = format_plan(plan)
+    if dry_run:
+        logging.info(f"План восстановления из {backup_path} в {restore_path}: {format_stats(summary)}")
+        return summary
+
+    stats = Counter({RESTORE_UNCHANGED: plan.unchanged})
+    for path in plan.extras:
+        try:
+            if os.path.isdir(path) and not os.path.islink(path):
+                shutil.rmtree(path)
+            else:
+                os.unlink(path)
+            stats[RESTORE_DELETE] += 1
+        except OSError as e:
+            logging.error(f"Ошибка при удалении {path}: {e}")
+    # Директории создаются заранее: пустые директории снимка иначе не появились бы вовсе
+    os.makedirs(restore_path, exist_ok=True)
+    for path in plan.dirs:
+        try:
+            os.makedirs(path, exist_ok=True)
+            stats[RESTORE_MKDIR] += 1
+        except OSError as e:
+            logging.error(f"Ошибка при создании директории {path}: {e}")
+
+    local = threading.local()
+    readers = []
+    snapshot_hashes = {}
+    hashes_lock = threading.Lock()
+
+    def snapshot_hash(path):
+        # Файлы снимков - жесткие ссылки друг на друга, поэтому хеш считается один раз на inode
+        st = os.stat(path)
+        key = (st.st_dev, st.st_ino)
+        with hashes_lock:
+            if key in snapshot_hashes:
+                return snapshot_hashes[key]
+        file_hash = calculate_hash(path, algorithm)
+        with hashes_lock:
+            snapshot_hashes[key] = file_hash
+        return file_hash
+
+    def reader():
+        if not hasattr(local, "conn"):
+            local.conn = create_connection(db_file, check_same_thread=False)
+            readers.append(local.conn)
+        return local.conn
+
+    def restore_item(item):
+        if item.action == RESTORE_CHECK:
+            expected = item.hash or snapshot_hash(item.src)
+            if expected is not None and calculate_hash(item.dst, algorithm) == expected:
+                if item.mtime_ns is not None:
+                    os.utime(item.dst, ns=(item.mtime_ns, item.mtime_ns))
+                return RESTORE_UNCHANGED
+        return write_restored_file(item.src, item.dst, item.hash, item.mtime_ns, reader, chunk_root, pack_root,
+                                   item.pointer, item.packed)
+
+    try:
+        with ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix="capsule-restore") as pool:
+            futures = [(item, pool.submit(restore_item, item)) for item in plan.items]
+            for item, future in futures:
+                try:
+                    stats[future.result()] += 1
+                except Exception as e:
+                    logging.error(f"Ошибка при восстановлении {item.dst}: {e}")
+    finally:
+        for conn in readers:
+            conn.close()
+
+    logging.info(f"Восстановление из {backup_path} в {restore_path} завершено: {format_stats(stats)}")
+    return dict(stats)
 
-    logging.info(f"Восстановление из {backup_path} в {restore_path} завершено.")
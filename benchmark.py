@@ -0,0 +1,305 @@
+import os
+import json
+import time
+import random
+import shutil
+import logging
+import platform
+import tempfile
+import subprocess
+from contextlib import closing
+from typing import Callable, Dict, List, Optional, Tuple
+
+try:
+    import resource
+except ImportError:  # resource есть только в Unix: пиковая память не измеряется
+    resource = None
+
+from database import create_connection, create_table, list_snapshots, get_manifest, get_path_versions, \
+    get_backup_entries
+from backup_manager import backup_files, incremental_backup, restore_backup
+from metrics import METRICS, diff_metrics
+
+logging.basicConfig(filename='backup_log.log', level=logging.INFO,
+                    format='%(asctime)s:%(levelname)s:%(message)s')
+
+# Зерно генератора наборов данных: одинаковое дерево при каждом запуске
+DEFAULT_SEED = 1
+# Доля файлов, изменяемых между снимками (см. mutate_tree)
+EDIT_FRACTION = 0.01
+# Сколько путей запрашивает шаг catalog в истории версий
+VERSION_QUERIES = 100
+# Допустимое замедление шага при сравнении результатов (0.1 - на 10%)
+REGRESSION_THRESHOLD = 0.1
+
+
+def write_file(path: str, data: bytes) -> None:
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as f:
+        f.write(data)
+
+
+def make_small_files(root: str, rng: random.Random, scale: float) -> None:
+    """ Много мелких файлов (0.5-16 КБ) по сотне в директории. """
+    for i in range(int(5000 * scale)):
+        write_file(os.path.join(root, f"d{i // 100:03d}", f"f{i:05d}.dat"), rng.randbytes(rng.randint(512, 16384)))
+
+
+def make_large_files(root: str, rng: random.Random, scale: float) -> None:
+    """ Несколько больших файлов по 64 МБ. """
+    block = rng.randbytes(1024 * 1024)
+    os.makedirs(root, exist_ok=True)
+    for i in range(max(1, int(3 * scale))):
+        with open(os.path.join(root, f"large{i}.bin"), 'wb') as f:
+            for j in range(64):
+                # Блоки различаются первыми байтами: файлы не совпадают и не сжимаются в один фрагмент
+                f.write(i.to_bytes(4, 'little') + j.to_bytes(4, 'little') + block[8:])
+
+
+def make_deep_tree(root: str, rng: random.Random, scale: float) -> None:
+    """ Глубокая вложенность: несколько цепочек по 40 уровней с файлами на каждом уровне. """
+    for chain in range(max(1, int(10 * scale))):
+        path = os.path.join(root, f"chain{chain}")
+        for level in range(40):
+            path = os.path.join(path, f"level{level}")
+            for i in range(5):
+                write_file(os.path.join(path, f"f{i}.txt"), rng.randbytes(rng.randint(64, 4096)))
+
+
+def make_duplicates(root: str, rng: random.Random, scale: float) -> None:
+    """ Высокая доля дубликатов: файлы берутся из пула в 50 вариантов содержимого. """
+    pool = [rng.randbytes(rng.randint(1024, 65536)) for _ in range(50)]
+    for i in range(int(2000 * scale)):
+        write_file(os.path.join(root, f"d{i // 200:02d}", f"copy{i:05d}.dat"), rng.choice(pool))
+
+
+# Наборы данных: имя -> функция, создающая дерево (корень, генератор, масштаб)
+DATASETS: Dict[str, Callable[[str, random.Random, float], None]] = {
+    'small_files': make_small_files,
+    'large_files': make_large_files,
+    'deep_tree': make_deep_tree,
+    'duplicates': make_duplicates,
+}
+
+
+def tree_size(root: str) -> Tuple[int, int]:
+    """
+    Считает файлы дерева.
+
+    :param root: Корень дерева
+    :return: Кортеж (количество файлов, общий размер в байтах)
+    """
+    files = total = 0
+    for dirpath, _, filenames in os.walk(root):
+        for name in filenames:
+            files += 1
+            total += os.path.getsize(os.path.join(dirpath, name))
+    return files, total
+
+
+def mutate_tree(root: str, rng: random.Random, fraction: float = EDIT_FRACTION) -> List[str]:
+    """
+    Вносит небольшие правки между снимками: изменяет, добавляет и удаляет часть файлов.
+
+    :param root: Корень дерева
+    :param rng: Генератор случайных чисел
+    :param fraction: Доля изменяемых файлов; добавляется и удаляется вдвое меньше
+    :return: Измененные пути (для удаленных файлов - их директории)
+    """
+    paths = sorted(os.path.join(dirpath, name) for dirpath, _, filenames in os.walk(root) for name in filenames)
+    count = max(1, int(len(paths) * fraction))
+    changed = []
+    for path in rng.sample(paths, min(count, len(paths))):
+        with open(path, 'r+b') as f:
+            f.write(rng.randbytes(16))
+        changed.append(path)
+    for i in range(max(1, count // 2)):
+        path = os.path.join(os.path.dirname(rng.choice(paths)), f"added-{rng.getrandbits(32):08x}-{i}.dat")
+        write_file(path, rng.randbytes(rng.randint(512, 8192)))
+        changed.append(path)
+    for path in rng.sample(paths, min(max(1, count // 2), len(paths))):
+        if os.path.exists(path) and path not in changed:
+            os.unlink(path)
+            changed.append(os.path.dirname(path))
+    return changed
+
+
+def read_io_counters() -> Dict[str, int]:
+    """
+    Счетчики ввода-вывода процесса из /proc/self/io (только Linux).
+
+    :return: Словарь: syscr и syscw - количество системных вызовов чтения и записи,
+             rchar и wchar - переданные ими байты, read_bytes и write_bytes - обращения к диску
+    """
+    try:
+        with open('/proc/self/io') as f:
+            return {key: int(value) for key, value in (line.split(':') for line in f if ':' in line)}
+    except OSError:
+        return {}
+
+
+def wait_next_second() -> None:
+    """ Ждет начала следующей секунды: имя снимка содержит время с точностью до секунды. """
+    time.sleep(1.01 - time.time() % 1)
+
+
+def measure(dataset: str, step: str, files: int, size: int, func: Callable[[], object]) -> Dict:
+    """
+    Выполняет шаг бенчмарка и собирает его показатели.
+
+    Пиковая память (maxrss_kb) - максимум процесса с момента запуска, а не только этого шага:
+    чтобы сравнивать ее по шагам, запускайте наборы данных отдельными процессами.
+
+    :param dataset: Имя набора данных
+    :param step: Имя шага
+    :param files: Количество обрабатываемых файлов
+    :param size: Объем обрабатываемых данных в байтах
+    :param func: Выполняемая функция
+    :return: Запись результата
+    """
+    io_before = read_io_counters()
+    usage_before = resource.getrusage(resource.RUSAGE_SELF) if resource else None
+    metrics_before = METRICS.snapshot()
+    started = time.perf_counter()
+    result = func()
+    seconds = time.perf_counter() - started
+    record = dict(dataset=dataset, step=step, files=files, bytes=size, seconds=seconds,
+                  files_per_s=files / seconds if seconds > 0 else 0.0,
+                  mb_per_s=size / 1024 ** 2 / seconds if seconds > 0 else 0.0,
+                  result=result if isinstance(result, dict) else None,
+                  metrics=diff_metrics(metrics_before, METRICS.snapshot()))
+    io_after = read_io_counters()
+    if io_after:
+        record['io'] = {key: io_after[key] - io_before.get(key, 0) for key in io_after}
+        record['syscalls'] = record['io'].get('syscr', 0) + record['io'].get('syscw', 0)
+    if usage_before is not None:
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+        record['cpu_user'] = usage.ru_utime - usage_before.ru_utime
+        record['cpu_system'] = usage.ru_stime - usage_before.ru_stime
+        record['maxrss_kb'] = usage.ru_maxrss
+    logging.info(f"Бенчмарк {dataset}/{step}: {seconds:.3f} с, {record['files_per_s']:.0f} файлов/с, "
+                 f"{record['mb_per_s']:.1f} МБ/с")
+    return record
+
+
+def run_dataset(name: str, workdir: str, scale: float = 1.0, seed: int = DEFAULT_SEED,
+                **options) -> List[Dict]:
+    """
+    Прогоняет шаги бенчмарка на одном наборе данных.
+
+    Шаги: first - первый снимок, unchanged - снимок без изменений (кэш метаданных),
+    edited - полный снимок после небольших правок, incremental - инкрементный снимок
+    следующих правок, restore - восстановление в пустую директорию, restore_unchanged -
+    повторное восстановление в ту же директорию, catalog - запросы к каталогу.
+
+    :param name: Имя набора данных из DATASETS
+    :param workdir: Рабочая директория (создается внутри нее поддиректория набора)
+    :param scale: Масштаб набора данных
+    :param seed: Зерно генератора
+    :param options: Параметры backup_files (hash_workers, copy_workers, backend и т. д.)
+    :return: Записи результатов по шагам
+    """
+    rng = random.Random(seed)
+    root = os.path.join(workdir, name)
+    source = os.path.join(root, 'source')
+    destination = os.path.join(root, 'backup')
+    target = os.path.join(root, 'restore')
+    db_file = os.path.join(destination, 'backup_db.sqlite')
+    os.makedirs(destination)
+    DATASETS[name](source, rng, scale)
+    records = []
+
+    def snapshot(step, func):
+        wait_next_second()
+        records.append(measure(name, step, *tree_size(source), func))
+
+    snapshot('first', lambda: backup_files(source, destination, db_file, **options))
+    snapshot('unchanged', lambda: backup_files(source, destination, db_file, **options))
+    mutate_tree(source, rng)
+    snapshot('edited', lambda: backup_files(source, destination, db_file, **options))
+    dirty = mutate_tree(source, rng)
+    incremental_options = {key: value for key, value in options.items() if key not in ('hash_workers', 'copy_workers')}
+    snapshot('incremental', lambda: incremental_backup(source, destination, db_file, dirty, **incremental_options))
+
+    with closing(create_connection(db_file)) as conn:
+        latest = list_snapshots(conn)[-1]
+    files, size = latest[7], latest[8]
+    records.append(measure(name, 'restore', files, size, lambda: restore_backup(latest[2], target, db_file)))
+    records.append(measure(name, 'restore_unchanged', files, size,
+                           lambda: restore_backup(latest[2], target, db_file)))
+
+    def query_catalog():
+        with closing(create_connection(db_file)) as conn:
+            create_table(conn)
+            snapshots = list_snapshots(conn)
+            rows = [row[0] for row in get_manifest(conn, snapshots[-1][0])]
+            for rel_path in random.Random(seed).sample(rows, min(VERSION_QUERIES, len(rows))):
+                get_path_versions(conn, rel_path)
+            get_backup_entries(conn, snapshots[-1][2])
+            return dict(snapshots=len(snapshots), manifest_rows=len(rows))
+
+    records.append(measure(name, 'catalog', files, 0, query_catalog))
+    return records
+
+
+def git_revision() -> Optional[str]:
+    """ Текущий коммит рабочей копии или None, если это не репозиторий git. """
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)),
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_benchmark(datasets: Optional[List[str]] = None, scale: float = 1.0, seed: int = DEFAULT_SEED,
+                  workdir: Optional[str] = None, output: Optional[str] = None, keep: bool = False,
+                  **options) -> Dict:
+    """
+    Прогоняет бенчмарк на выбранных наборах данных во временной директории.
+
+    :param datasets: Имена наборов данных (по умолчанию - все из DATASETS)
+    :param scale: Масштаб наборов данных
+    :param seed: Зерно генератора
+    :param workdir: Родительская директория для временных файлов (по умолчанию - системная)
+    :param output: Путь к файлу результатов JSON
+    :param keep: Не удалять временные файлы
+    :param options: Параметры backup_files (hash_workers, copy_workers, backend и т. д.)
+    :return: Результаты: окружение и записи по шагам
+    """
+    for name in datasets or ():
+        if name not in DATASETS:
+            raise ValueError(f"Неизвестный набор данных: {name}")
+    root = tempfile.mkdtemp(prefix='capsule-bench-', dir=workdir)
+    report = dict(revision=git_revision(), time=time.time(), python=platform.python_version(),
+                  platform=platform.platform(), cpu_count=os.cpu_count(), scale=scale, seed=seed,
+                  options=options, results=[])
+    try:
+        for name in datasets or DATASETS:
+            report['results'].extend(run_dataset(name, root, scale, seed, **options))
+    finally:
+        if not keep:
+            shutil.rmtree(root, ignore_errors=True)
+    if output:
+        with open(output, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+    return report
+
+
+def compare_results(baseline: Dict, current: Dict,
+                    threshold: float = REGRESSION_THRESHOLD) -> List[Dict]:
+    """
+    Сравнивает два результата бенчмарка по времени шагов.
+
+    :param baseline: Результаты прежнего коммита
+    :param current: Результаты текущего коммита
+    :param threshold: Допустимое замедление (0.1 - на 10%)
+    :return: Шаги, замедлившиеся больше чем на threshold: набор, шаг, прежнее и новое время, отношение
+    """
+    before = {(record['dataset'], record['step']): record['seconds'] for record in baseline['results']}
+    regressions = []
+    for record in current['results']:
+        old = before.get((record['dataset'], record['step']))
+        if old and record['seconds'] > old * (1 + threshold):
+            regressions.append(dict(dataset=record['dataset'], step=record['step'], baseline=old,
+                                    current=record['seconds'], ratio=record['seconds'] / old))
+    return regressions
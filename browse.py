@@ -0,0 +1,151 @@
+import os
+import logging
+import threading
+from collections import Counter, deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import closing
+from itertools import islice
+from typing import Dict, Iterable, List, NamedTuple, Optional, Tuple
+
+from database import create_connection, get_snapshot, get_manifest, get_manifest_entry, get_snapshot_children
+from chunk_store import CHUNK_DIR_NAME, POINTER_MAX_SIZE, read_pointer
+from pack_store import PACK_DIR_NAME
+from backup_manager import DEFAULT_RESTORE_WORKERS, format_stats, write_restored_file
+
+logging.basicConfig(filename='backup_log.log', level=logging.INFO,
+                    format='%(asctime)s:%(levelname)s:%(message)s')
+
+# Количество элементов директории на одной странице просмотра
+BROWSE_PAGE_SIZE = 1000
+# Сколько файлов на поток может ждать восстановления одновременно
+RESTORE_QUEUE_FACTOR = 4
+
+
+class SnapshotEntry(NamedTuple):
+    """ Элемент директории снимка по манифесту. """
+    name: str
+    # Путь относительно корня снимка
+    path: str
+    is_dir: bool
+    # У директорий хеш и время изменения не известны, размер - 0
+    hash: Optional[str]
+    size: int
+    mtime_ns: Optional[int]
+
+
+def browse_snapshot(backup_path: str, dir_path: str = '', cursor: Optional[str] = None,
+                    limit: int = BROWSE_PAGE_SIZE,
+                    db_file: Optional[str] = None) -> Optional[Tuple[List[SnapshotEntry], Optional[str]]]:
+    """
+    Возвращает одну страницу содержимого директории снимка.
+
+    Содержимое берется из манифеста в каталоге, директория снимка не читается; за страницу
+    из базы читается не больше limit элементов (см. database.get_snapshot_children).
+
+    :param backup_path: Путь до папки резервной копии
+    :param dir_path: Путь директории относительно корня снимка ('' - корень)
+    :param cursor: Курсор из предыдущего вызова (путь последнего элемента страницы) или None - первая страница
+    :param limit: Количество элементов на странице
+    :param db_file: Путь к файлу базы данных (по умолчанию - рядом с резервными копиями)
+    :return: Кортеж (элементы страницы, курсор следующей страницы или None, если она последняя);
+             None, если снимка нет в каталоге
+    """
+    backup_path = os.path.normpath(backup_path)
+    db_file = db_file or os.path.join(os.path.dirname(backup_path), 'backup_db.sqlite')
+    dir_path = os.path.normpath(dir_path).strip(os.sep) if dir_path else ''
+    if dir_path == os.curdir:
+        dir_path = ''
+    with closing(create_connection(db_file)) as conn:
+        snapshot = get_snapshot(conn, os.path.basename(backup_path))
+        if snapshot is None:
+            logging.error(f"Снимок {backup_path} не зарегистрирован в каталоге")
+            return None
+        page = list(islice(get_snapshot_children(conn, snapshot[0], dir_path, cursor), limit + 1))
+    entries = [SnapshotEntry(name, os.path.join(dir_path, name), is_dir, file_hash, size, mtime_ns)
+               for name, is_dir, file_hash, size, mtime_ns, _ in page[:limit]]
+    return entries, page[limit - 1][5] if len(page) > limit else None
+
+
+def restore_files(backup_path: str, paths: Iterable[str], target: str, db_file: Optional[str] = None,
+                  workers: int = DEFAULT_RESTORE_WORKERS) -> Optional[Dict[str, int]]:
+    """
+    Восстанавливает из снимка отдельные файлы и поддиректории.
+
+    Каждый путь восстанавливается в целевую директорию под своим именем, как при cp -r:
+    файл docs/a.txt - в target/a.txt, директория docs - в target/docs. Файлы берутся
+    по манифесту снимка, который перебирается потоково, и записываются пулом потоков;
+    упакованное содержимое и фрагменты читаются через mmap по частям, поэтому память
+    не растет с размером файлов. Существующие в целевой директории файлы с теми же
+    именами заменяются, остальное ее содержимое не трогается.
+
+    :param backup_path: Путь до папки резервной копии
+    :param paths: Пути файлов или директорий относительно корня снимка ('' - весь снимок)
+    :param target: Целевая директория
+    :param db_file: Путь к файлу базы данных (по умолчанию - рядом с резервными копиями)
+    :param workers: Количество потоков восстановления
+    :return: Количество файлов по способу восстановления, missing - путей, которых нет в снимке;
+             None, если снимка нет в каталоге
+    """
+    backup_path = os.path.normpath(backup_path)
+    destination = os.path.dirname(backup_path)
+    db_file = db_file or os.path.join(destination, 'backup_db.sqlite')
+    chunk_root = os.path.join(destination, CHUNK_DIR_NAME)
+    pack_root = os.path.join(destination, PACK_DIR_NAME)
+    use_pointers = os.path.isdir(chunk_root)
+    use_packs = os.path.isdir(pack_root)
+    stats = Counter()
+    local = threading.local()
+    readers = []
+
+    def reader():
+        if not hasattr(local, "conn"):
+            local.conn = create_connection(db_file, check_same_thread=False)
+            readers.append(local.conn)
+        return local.conn
+
+    def restore_one(src, dst, file_hash, mtime_ns):
+        packed = use_packs and not os.path.lexists(src)
+        pointer = (not packed and use_pointers and os.path.getsize(src) <= POINTER_MAX_SIZE
+                   and read_pointer(src) is not None)
+        return write_restored_file(src, dst, file_hash, mtime_ns, reader, chunk_root, pack_root, pointer, packed)
+
+    def record(dst, future):
+        try:
+            stats[future.result()] += 1
+        except Exception as e:
+            logging.error(f"Ошибка при восстановлении {dst}: {e}")
+
+    with closing(create_connection(db_file)) as conn:
+        snapshot = get_snapshot(conn, os.path.basename(backup_path))
+        if snapshot is None:
+            logging.error(f"Снимок {backup_path} не зарегистрирован в каталоге")
+            return None
+        pending = deque()
+        try:
+            with ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix="capsule-restore") as pool:
+                for path in paths:
+                    rel = os.path.normpath(path).strip(os.sep) if path else ''
+                    if rel == os.curdir:
+                        rel = ''
+                    base = os.path.dirname(rel)
+                    entry = get_manifest_entry(conn, snapshot[0], rel) if rel else None
+                    rows = [(rel,) + tuple(entry)] if entry else get_manifest(conn, snapshot[0], rel or None)
+                    found = False
+                    for rel_path, file_hash, _, mtime_ns in rows:
+                        found = True
+                        dst = os.path.join(target, os.path.relpath(rel_path, base) if base else rel_path)
+                        pending.append((dst, pool.submit(restore_one, os.path.join(backup_path, rel_path), dst,
+                                                         file_hash, mtime_ns)))
+                        if len(pending) >= max(1, workers) * RESTORE_QUEUE_FACTOR:
+                            record(*pending.popleft())
+                    if not found:
+                        logging.error(f"Пути {path} нет в снимке {backup_path}")
+                        stats['missing'] += 1
+                while pending:
+                    record(*pending.popleft())
+        finally:
+            for reader_conn in readers:
+                reader_conn.close()
+
+    logging.info(f"Выборочное восстановление из {backup_path} в {target} завершено: {format_stats(stats)}")
+    return dict(stats)
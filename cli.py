@@ -0,0 +1,467 @@
+import argparse
+import json
+import logging
+import os
+import signal
+import sys
+import threading
+import time
+from typing import List, Optional
+
+# Модули копирования импортируются внутри команд: запуск CLI не тянет за собой tkinter,
+# pystray и PIL, а каждая команда загружает только то, что ей нужно.
+
+# Справка по --backend: скорость разбиения на фрагменты зависит от пакета fastcdc
+BACKEND_HELP = ("способ хранения; chunk разбивает большие файлы на фрагменты со скоростью около "
+                "500 МБ/с с пакетом fastcdc и около 12 МБ/с без него")
+
+
+class JsonLogHandler(logging.Handler):
+    """ Выводит записи журнала событиями JSON в stdout. """
+
+    def emit(self, record):
+        emit_json("log", level=record.levelname, message=record.getMessage())
+
+
+def emit_json(event: str, **fields) -> None:
+    """
+    Печатает одно событие JSON в отдельной строке.
+
+    :param event: Тип события
+    :param fields: Поля события
+    """
+    print(json.dumps({"event": event, "time": time.time(), **fields}, ensure_ascii=False), flush=True)
+
+
+def default_db(destination: str, db_file: Optional[str]) -> str:
+    """ Путь к базе данных: заданный явно или рядом с резервными копиями. """
+    return db_file or os.path.join(destination, 'backup_db.sqlite')
+
+
+def parse_size(value: str) -> int:
+    """
+    Разбирает размер вида 500M, 2G, 1T или число байт.
+
+    :param value: Строка размера
+    :return: Размер в байтах
+    """
+    units = {'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3, 'T': 1024 ** 4}
+    value = value.strip().upper().rstrip('B')
+    if value and value[-1] in units:
+        return int(float(value[:-1]) * units[value[-1]])
+    return int(value)
+
+
+def parse_profile(value: str):
+    """
+    Разбирает профиль ограничения вида 08:00-19:00=5M или 08:00-19:00=5M/100 (байт/с и файлов/с).
+
+    :param value: Строка профиля
+    :return: Профиль (throttle.ThrottleProfile)
+    """
+    from throttle import ThrottleProfile
+    window, _, limits = value.partition('=')
+    start, end = (int(part[:2]) * 60 + int(part[3:]) for part in window.split('-'))
+    rate, _, files = limits.partition('/')
+    return ThrottleProfile(start, end, parse_size(rate), float(files or 0))
+
+
+def backup_options(args) -> dict:
+    """ Параметры копирования, общие для команд backup и daemon; с --json ход копирования - события progress. """
+    from backup_manager import BACKEND_LINK
+    from pack_store import PACK_CODEC_ZLIB
+    progress = (lambda fields: emit_json("progress", **fields)) if args.json else None
+    return dict(paranoid=args.paranoid, backend=args.backend or BACKEND_LINK, hash_algorithm=args.hash_algorithm,
+                report_file=args.report, pack_codec=args.pack_codec or PACK_CODEC_ZLIB, progress=progress)
+
+
+def cmd_backup(args):
+    from backup_manager import backup_files
+    os.makedirs(args.destination, exist_ok=True)
+    return backup_files(args.source, args.destination, default_db(args.destination, args.db),
+                        hash_workers=args.hash_workers, copy_workers=args.copy_workers, **backup_options(args))
+
+
+def cmd_restore(args):
+    if not os.path.isdir(args.snapshot):
+        raise FileNotFoundError(f"Снимок {args.snapshot} не найден")
+    if args.paths:
+        from browse import restore_files
+        if args.dry_run:
+            raise ValueError("--dry-run не поддерживается вместе с --path")
+        return restore_files(args.snapshot, args.paths, args.target, args.db, workers=args.workers)
+    from backup_manager import restore_backup
+    return restore_backup(args.snapshot, args.target, args.db, workers=args.workers, dry_run=args.dry_run)
+
+
+def cmd_browse(args):
+    """ Показывает одну страницу директории снимка; курсор следующей страницы - в итоге команды. """
+    from browse import browse_snapshot
+    page = browse_snapshot(args.snapshot, args.path, args.cursor, args.limit, args.db)
+    if page is None:
+        raise LookupError(f"Снимок {args.snapshot} не зарегистрирован в каталоге")
+    entries, cursor = page
+    for entry in entries:
+        row = dict(name=entry.name + (os.sep if entry.is_dir else ''), path=entry.path, hash=entry.hash,
+                   size=entry.size, mtime_ns=entry.mtime_ns)
+        if args.json:
+            emit_json("item", **row)
+        else:
+            print("\t".join(str(value) for value in row.values()))
+    return {"items": len(entries), "cursor": cursor}
+
+
+def cmd_list(args):
+    from contextlib import closing
+    from database import create_connection, create_table, list_snapshots, get_snapshot, get_manifest, \
+        get_path_versions
+    with closing(create_connection(default_db(args.destination, args.db))) as conn:
+        create_table(conn)
+        if args.versions:
+            rows = [dict(snapshot=name, hash=file_hash, size=size, mtime_ns=mtime_ns)
+                    for name, file_hash, size, mtime_ns in get_path_versions(conn, args.versions)]
+        elif args.files:
+            snapshot = get_snapshot(conn, args.files)
+            if snapshot is None:
+                raise LookupError(f"Снимок {args.files} не зарегистрирован в каталоге")
+            rows = [dict(path=rel_path, hash=file_hash, size=size, mtime_ns=mtime_ns)
+                    for rel_path, file_hash, size, mtime_ns in get_manifest(conn, snapshot[0], args.prefix)]
+        else:
+            rows = [dict(name=name, path=path, source=source, backend=backend, started=started, finished=finished,
+                         files=file_count, size=total_size, set=backup_set)
+                    for _, name, path, source, backend, started, finished, file_count, total_size, backup_set
+                    in list_snapshots(conn)]
+    for row in rows:
+        if args.json:
+            emit_json("item", **row)
+        else:
+            print("\t".join(str(value) for value in row.values()))
+    return {"items": len(rows)}
+
+
+def cmd_set(args):
+    """ Управляет наборами резервного копирования и запускает их: разные наборы копируют одновременно. """
+    from collections import Counter
+    from contextlib import closing
+    from database import create_connection, create_table, add_set_source, remove_set_source, get_backup_sets
+    os.makedirs(args.destination, exist_ok=True)
+    db_file = default_db(args.destination, args.db)
+    if args.action == 'run':
+        from jobs import JobManager
+        manager = JobManager()
+        stats = Counter()
+
+        def on_event(event):
+            if event['event'] not in ('finished', 'cancelled', 'failed'):
+                return
+            stats[event['event']] += 1
+            stats.update(event.get('stats') or {})
+            if args.json:
+                emit_json("job", job=event)
+
+        manager.subscribe(on_event)
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            signal.signal(signum, lambda *_: manager.cancel())
+        jobs = [job for name in args.names
+                for job in manager.submit_set(name, args.destination, db_file, hash_workers=args.hash_workers,
+                                              copy_workers=args.copy_workers, **backup_options(args))]
+        if not jobs:
+            raise LookupError(f"В каталоге {db_file} нет источников наборов {', '.join(args.names)}")
+        manager.wait()
+        return dict(stats)
+    with closing(create_connection(db_file)) as conn:
+        create_table(conn)
+        if args.action == 'add':
+            for source in args.sources:
+                add_set_source(conn, args.name, source)
+        elif args.action == 'remove':
+            for source in args.sources or [None]:
+                remove_set_source(conn, args.name, source)
+        sets = get_backup_sets(conn)
+    rows = [dict(set=name, source=source) for name, sources in sets.items() for source in sources]
+    for row in rows:
+        if args.json:
+            emit_json("item", **row)
+        elif args.action == 'list':
+            print("\t".join(row.values()))
+    return {"sets": len(sets), "sources": len(rows)}
+
+
+def cmd_prune(args):
+    from retention import prune_backups
+    return prune_backups(args.destination, args.db, keep_last=args.keep_last, keep_hourly=args.keep_hourly,
+                         keep_daily=args.keep_daily, keep_weekly=args.keep_weekly,
+                         max_total_size=parse_size(args.max_size) if args.max_size else 0, dry_run=args.dry_run)
+
+
+def cmd_throttle(args):
+    """ Задает или показывает ограничение нагрузки, которое применяют все запуски копирования в репозиторий. """
+    from contextlib import closing
+    from database import create_connection, create_table
+    from throttle import Throttle, load_throttle, save_throttle
+    os.makedirs(args.destination, exist_ok=True)
+    with closing(create_connection(default_db(args.destination, args.db))) as conn:
+        create_table(conn)
+        if args.off:
+            save_throttle(conn, Throttle())
+        elif args.rate or args.files or args.profiles or args.drop_cache or args.idle_io:
+            save_throttle(conn, Throttle(parse_size(args.rate) if args.rate else 0, args.files,
+                                         args.profiles or (),
+                                         args.drop_cache, args.idle_io))
+        throttle = load_throttle(conn)
+    settings = throttle.to_dict() if throttle is not None else {}
+    if args.json:
+        emit_json("item", **settings)
+    return settings
+
+
+def stop_on_signals() -> threading.Event:
+    """ Событие, которое устанавливается по SIGINT или SIGTERM. """
+    stop_event = threading.Event()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        signal.signal(signum, lambda *_: stop_event.set())
+    return stop_event
+
+
+def cmd_verify(args):
+    from scrub import verify_snapshot
+    stats = verify_snapshot(args.snapshot, args.db, args.workers, parse_size(args.rate) if args.rate else 0,
+                            resume=not args.restart, cancel=stop_on_signals())
+    if stats is None:
+        raise LookupError(f"Снимок {args.snapshot} не зарегистрирован в каталоге")
+    return stats
+
+
+def cmd_scrub(args):
+    """ Проверяет весь репозиторий; по SIGINT или SIGTERM останавливается, сохранив проверенное. """
+    from scrub import scrub_repository
+    return scrub_repository(args.destination, args.db, workers=args.workers,
+                            max_rate=parse_size(args.rate) if args.rate else 0, max_age=args.max_age * 86400,
+                            resume=not args.restart, cancel=stop_on_signals())
+
+
+def cmd_bench(args):
+    from benchmark import DATASETS, run_benchmark, compare_results
+    report = run_benchmark(args.datasets or list(DATASETS), scale=args.scale, workdir=args.workdir,
+                           output=args.output, keep=args.keep, hash_workers=args.hash_workers,
+                           copy_workers=args.copy_workers, **({'backend': args.backend} if args.backend else {}))
+    for record in report['results']:
+        if args.json:
+            emit_json("item", **{key: value for key, value in record.items() if key not in ('metrics', 'result')})
+        else:
+            print(f"{record['dataset']}\t{record['step']}\t{record['seconds']:.3f} с\t"
+                  f"{record['files_per_s']:.0f} файлов/с\t{record['mb_per_s']:.1f} МБ/с")
+    stats = {"steps": len(report['results'])}
+    if args.compare:
+        with open(args.compare, encoding='utf-8') as f:
+            regressions = compare_results(json.load(f), report, args.threshold)
+        for regression in regressions:
+            logging.warning(f"Замедление {regression['dataset']}/{regression['step']}: "
+                            f"{regression['baseline']:.3f} с -> {regression['current']:.3f} с")
+        stats["regressions"] = len(regressions)
+    return stats
+
+
+def cmd_daemon(args):
+    """ Выполняет копирование по расписанию до получения SIGINT или SIGTERM. """
+    stop_event = stop_on_signals()
+    os.makedirs(args.destination, exist_ok=True)
+    db_file = default_db(args.destination, args.db)
+    interval = args.interval * 60
+    options = backup_options(args)
+    if args.watch:
+        from watcher import watch_available, watch_backup
+        if watch_available():
+            watch_backup(args.source, args.destination, db_file, interval, stop_event, **options)
+            return {}
+        logging.warning("Отслеживание изменений недоступно в этой системе, используется полный обход")
+    from backup_manager import backup_files
+    while not stop_event.is_set():
+        try:
+            stats = backup_files(args.source, args.destination, db_file, **options)
+        except Exception as e:
+            # Ошибка уже в журнале; демон продолжает работу и повторит копирование через интервал
+            if args.json:
+                emit_json("error", command=args.command, message=str(e))
+        else:
+            if args.json:
+                emit_json("snapshot", stats=stats)
+        stop_event.wait(interval)
+    return {}
+
+
+def build_parser() -> argparse.ArgumentParser:
+    """ Описание команд и параметров командной строки. """
+    parser = argparse.ArgumentParser(prog='capsule', description="Резервное копирование без графического интерфейса")
+    parser.add_argument('--json', action='store_true', help="события и журнал в формате JSON, по строке на событие")
+    parser.add_argument('--db', type=os.path.abspath, help="путь к базе данных (по умолчанию - в пункте назначения)")
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    def add_backup_arguments(command):
+        command.add_argument('source', type=os.path.abspath, help="исходная директория")
+        command.add_argument('destination', type=os.path.abspath, help="директория резервных копий")
+        command.add_argument('--paranoid', action='store_true', help="хешировать все файлы заново")
+        command.add_argument('--backend', choices=('link', 'chunk', 'pack'), help=BACKEND_HELP)
+        command.add_argument('--pack-codec', choices=('zlib', 'lzma'), help="сжатие пак-файлов (--backend pack)")
+        command.add_argument('--hash-algorithm', help="алгоритм хеширования нового репозитория")
+        command.add_argument('--report', type=os.path.abspath, metavar='FILE',
+                             help="сохранить статистику и метрики запуска в файл JSON")
+
+    backup = commands.add_parser('backup', help="создать снимок")
+    add_backup_arguments(backup)
+    backup.add_argument('--hash-workers', type=int, default=0, help="потоки хеширования (0 - последовательно)")
+    backup.add_argument('--copy-workers', type=int, default=0, help="потоки копирования (0 - последовательно)")
+    backup.set_defaults(handler=cmd_backup)
+
+    restore = commands.add_parser('restore', help="восстановить снимок")
+    restore.add_argument('snapshot', type=os.path.abspath, help="директория снимка")
+    restore.add_argument('target', type=os.path.abspath, help="целевая директория")
+    restore.add_argument('--workers', type=int, default=4, help="потоки восстановления")
+    restore.add_argument('--dry-run', action='store_true', help="только показать план")
+    restore.add_argument('--path', dest='paths', action='append', metavar='PATH',
+                         help="восстановить только этот файл или директорию снимка (можно повторять)")
+    restore.set_defaults(handler=cmd_restore)
+
+    browse = commands.add_parser('browse', help="просмотреть директорию снимка по страницам")
+    browse.add_argument('snapshot', type=os.path.abspath, help="директория снимка")
+    browse.add_argument('path', nargs='?', default='', help="директория относительно корня снимка")
+    browse.add_argument('--cursor', help="курсор следующей страницы из предыдущего вызова")
+    browse.add_argument('--limit', type=int, default=1000, help="элементов на странице")
+    browse.set_defaults(handler=cmd_browse)
+
+    listing = commands.add_parser('list', help="снимки, файлы снимка или версии файла")
+    listing.add_argument('destination', type=os.path.abspath, help="директория резервных копий")
+    listing.add_argument('--files', metavar='SNAPSHOT', help="файлы снимка с указанным именем")
+    listing.add_argument('--prefix', help="только файлы внутри этой относительной директории")
+    listing.add_argument('--versions', metavar='PATH', help="версии файла с этим относительным путем")
+    listing.set_defaults(handler=cmd_list)
+
+    sets = commands.add_parser('set', help="наборы источников с общим каталогом и хранилищем")
+    set_actions = sets.add_subparsers(dest='action', required=True)
+    set_add = set_actions.add_parser('add', help="добавить источники в набор (набор создается)")
+    set_add.add_argument('destination', type=os.path.abspath, help="директория резервных копий")
+    set_add.add_argument('name', help="имя набора")
+    set_add.add_argument('sources', nargs='+', type=os.path.abspath, help="исходные директории")
+    set_remove = set_actions.add_parser('remove', help="удалить источники или весь набор; снимки остаются")
+    set_remove.add_argument('destination', type=os.path.abspath, help="директория резервных копий")
+    set_remove.add_argument('name', help="имя набора")
+    set_remove.add_argument('sources', nargs='*', type=os.path.abspath, help="исходные директории (по умолчанию - все)")
+    set_list = set_actions.add_parser('list', help="наборы и их источники")
+    set_list.add_argument('destination', type=os.path.abspath, help="директория резервных копий")
+    set_run = set_actions.add_parser('run', help="создать снимки источников наборов")
+    set_run.add_argument('destination', type=os.path.abspath, help="директория резервных копий")
+    set_run.add_argument('names', nargs='+', help="имена наборов: разные наборы копируются одновременно")
+    set_run.add_argument('--paranoid', action='store_true', help="хешировать все файлы заново")
+    set_run.add_argument('--backend', choices=('link', 'chunk', 'pack'), help=BACKEND_HELP)
+    set_run.add_argument('--pack-codec', choices=('zlib', 'lzma'), help="сжатие пак-файлов (--backend pack)")
+    set_run.add_argument('--hash-algorithm', help="алгоритм хеширования нового репозитория")
+    set_run.add_argument('--hash-workers', type=int, default=0, help="потоки хеширования (0 - последовательно)")
+    set_run.add_argument('--copy-workers', type=int, default=0, help="потоки копирования (0 - последовательно)")
+    set_run.set_defaults(report=None)
+    sets.set_defaults(handler=cmd_set)
+
+    prune = commands.add_parser('prune', help="удалить устаревшие снимки")
+    prune.add_argument('destination', type=os.path.abspath, help="директория резервных копий")
+    prune.add_argument('--keep-last', type=int, default=0)
+    prune.add_argument('--keep-hourly', type=int, default=0)
+    prune.add_argument('--keep-daily', type=int, default=0)
+    prune.add_argument('--keep-weekly', type=int, default=0)
+    prune.add_argument('--max-size', help="предельный объем снимков, например 500G")
+    prune.add_argument('--dry-run', action='store_true', help="только показать, что будет удалено")
+    prune.set_defaults(handler=cmd_prune)
+
+    throttle = commands.add_parser('throttle', help="ограничить нагрузку копирования на диск (все запуски)")
+    throttle.add_argument('destination', type=os.path.abspath, help="директория резервных копий")
+    throttle.add_argument('--rate', help="предельная скорость чтения в секунду, например 20M")
+    throttle.add_argument('--files', type=float, default=0, help="предельное количество файлов в секунду")
+    throttle.add_argument('--profile', dest='profiles', action='append', type=parse_profile,
+                          metavar='HH:MM-HH:MM=RATE[/FILES]',
+                          help="другие пределы в это время суток (можно повторять)")
+    throttle.add_argument('--drop-cache', action='store_true',
+                          help="вытеснять прочитанные файлы источника из страничного кэша")
+    throttle.add_argument('--idle-io', action='store_true', help="копировать с приоритетом ввода-вывода idle")
+    throttle.add_argument('--off', action='store_true', help="снять ограничения")
+    throttle.set_defaults(handler=cmd_throttle)
+
+    def add_scrub_arguments(command):
+        command.add_argument('--workers', type=int, default=4, help="потоки проверки")
+        command.add_argument('--rate', help="предельная скорость чтения в секунду, например 50M")
+        command.add_argument('--restart', action='store_true', help="начать заново, а не продолжить прерванную проверку")
+
+    verify = commands.add_parser('verify', help="проверить файлы снимка по хешам")
+    verify.add_argument('snapshot', type=os.path.abspath, help="директория снимка")
+    add_scrub_arguments(verify)
+    verify.set_defaults(handler=cmd_verify)
+
+    scrub = commands.add_parser('scrub', help="проверить все снимки, фрагменты и пак-файлы по хешам")
+    scrub.add_argument('destination', type=os.path.abspath, help="директория резервных копий")
+    add_scrub_arguments(scrub)
+    scrub.add_argument('--max-age', type=float, default=0,
+                       help="пропускать объекты, проверенные не раньше этого количества дней назад")
+    scrub.set_defaults(handler=cmd_scrub)
+
+    bench = commands.add_parser('bench', help="замерить скорость на синтетических наборах данных")
+    bench.add_argument('datasets', nargs='*', help="наборы данных: small_files, large_files, deep_tree, duplicates")
+    bench.add_argument('--scale', type=float, default=1.0, help="масштаб наборов данных")
+    bench.add_argument('--workdir', type=os.path.abspath, help="директория для временных файлов")
+    bench.add_argument('--output', type=os.path.abspath, metavar='FILE', help="сохранить результаты в файл JSON")
+    bench.add_argument('--compare', type=os.path.abspath, metavar='FILE',
+                       help="сравнить с результатами прежнего запуска")
+    bench.add_argument('--threshold', type=float, default=0.1, help="допустимое замедление при сравнении")
+    bench.add_argument('--keep', action='store_true', help="не удалять временные файлы")
+    bench.add_argument('--backend', choices=('link', 'chunk', 'pack'), help=BACKEND_HELP)
+    bench.add_argument('--hash-workers', type=int, default=0, help="потоки хеширования (0 - последовательно)")
+    bench.add_argument('--copy-workers', type=int, default=0, help="потоки копирования (0 - последовательно)")
+    bench.set_defaults(handler=cmd_bench)
+
+    daemon = commands.add_parser('daemon', help="копировать по расписанию")
+    add_backup_arguments(daemon)
+    daemon.add_argument('--interval', type=float, default=60, help="интервал в минутах")
+    daemon.add_argument('--watch', action='store_true', help="снимки по изменениям (inotify)")
+    daemon.set_defaults(handler=cmd_daemon)
+    return parser
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    """
+    Точка входа командной строки.
+
+    :param argv: Аргументы без имени программы
+    :return: Код возврата: 0 - успех, 1 - ошибка
+    """
+    args = build_parser().parse_args(argv)
+    logging.basicConfig(filename='backup_log.log', level=logging.INFO,
+                        format='%(asctime)s:%(levelname)s:%(message)s')
+    if args.json:
+        logging.getLogger().addHandler(JsonLogHandler())
+        emit_json("start", command=args.command)
+    else:
+        console = logging.StreamHandler(sys.stderr)
+        console.setLevel(logging.WARNING)
+        logging.getLogger().addHandler(console)
+    from metrics import start_async_logging, stop_async_logging
+    listener = start_async_logging()
+    error = None
+    try:
+        result = args.handler(args)
+    except Exception as e:
+        logging.error(f"Ошибка при выполнении команды {args.command}: {e}")
+        error = e
+    finally:
+        # Записи журнала доставляются до итогового события
+        stop_async_logging(listener)
+    if error is not None:
+        if args.json:
+            emit_json("error", command=args.command, message=str(error))
+        return 1
+    if args.json:
+        emit_json("result", command=args.command, stats=result)
+    elif result and args.command != 'list':
+        print(", ".join(f"{key}={value}" for key, value in sorted(result.items())))
+    # Проверка, нашедшая поврежденные или отсутствующие файлы, бенчмарк с замедлениями и запуск
+    # наборов с неудавшимися заданиями завершаются с ошибкой
+    return 1 if result and any(result.get(key) for key in ('corrupt', 'missing', 'regressions', 'failed')) else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
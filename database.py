@@ -1,60 +1,278 @@
+import os
+import json
+import time
 import sqlite3
 import logging
-from typing import Optional, List, Tuple, Any
+from typing import Optional, Dict, Iterable, Iterator, List, Set, Tuple, Any
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
 
-def create_connection(db_file: str) -> Optional[sqlite3.Connection]:
+# Текущая версия схемы базы данных (хранится в PRAGMA user_version)
+SCHEMA_VERSION = 12
+# Режим журнала: WAL позволяет читать базу во время пакетной записи
+JOURNAL_MODE = 'WAL'
+# Сколько секунд ждать, пока другой запуск с тем же каталогом освободит блокировку записи
+DB_BUSY_TIMEOUT = 300
+# Сколько неиспользуемых фрагментов выбирается и удаляется из каталога за одну транзакцию
+ORPHAN_PAGE_SIZE = 1000
+
+
+def create_connection(db_file: str, check_same_thread: bool = True) -> Optional[sqlite3.Connection]:
     """
     Создает соединение с базой данных SQLite.
 
     :param db_file: Путь к файлу базы данных
+    :param check_same_thread: Запрещать использование соединения из других потоков
     :return: Объект соединения или None в случае ошибки
     """
     try:
-        return sqlite3.connect(db_file)
+        conn = sqlite3.connect(db_file, timeout=DB_BUSY_TIMEOUT, check_same_thread=check_same_thread)
+        conn.execute(f"PRAGMA journal_mode={JOURNAL_MODE}")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        return conn
     except Exception as e:
         logging.error(f"Ошибка подключения к базе данных: {e}")
         return None
 
 
+def _migrate_v1(c: sqlite3.Cursor) -> None:
+    """ Исходная схема: таблицы file_data и excluded_directories. """
+    # Таблица для данных о файлах
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS file_data (
+            path TEXT,
+            size INTEGER,
+            last_modified REAL,
+            hash TEXT,
+            backup_path TEXT,
+            mtime_ns INTEGER,
+            inode INTEGER,
+            ctime_ns INTEGER
+        )
+    ''')
+    # Базы, созданные до появления кэша метаданных, дополняются новыми колонками
+    c.execute("PRAGMA table_info(file_data)")
+    columns = {row[1] for row in c.fetchall()}
+    for column in ('mtime_ns', 'inode', 'ctime_ns'):
+        if column not in columns:
+            c.execute(f"ALTER TABLE file_data ADD COLUMN {column} INTEGER")
+    # Таблица для исключенных директорий
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS excluded_directories (
+            path TEXT UNIQUE
+        )
+    ''')
+
+
+def _migrate_v2(c: sqlite3.Cursor) -> None:
+    """ Индексы для поиска по хешу, пути и (размер, время изменения). """
+    # Старый код мог оставить несколько строк для одной пары (путь, хеш) - оставляем последнюю
+    c.execute('''
+        DELETE FROM file_data WHERE rowid NOT IN (
+            SELECT MAX(rowid) FROM file_data GROUP BY path, hash
+        )
+    ''')
+    c.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_file_data_path_hash ON file_data (path, hash)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_file_data_hash ON file_data (hash)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_file_data_size_mtime ON file_data (size, last_modified)")
+
+
+def _migrate_v3(c: sqlite3.Cursor) -> None:
+    """ Хранилище фрагментов: уникальные фрагменты и упорядоченный список фрагментов каждого файла. """
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS chunks (
+            hash TEXT PRIMARY KEY,
+            size INTEGER NOT NULL
+        )
+    ''')
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS file_chunks (
+            file_hash TEXT NOT NULL,
+            seq INTEGER NOT NULL,
+            chunk_hash TEXT NOT NULL,
+            PRIMARY KEY (file_hash, seq)
+        )
+    ''')
+    c.execute("CREATE INDEX IF NOT EXISTS idx_file_chunks_chunk ON file_chunks (chunk_hash)")
+
+
+def _migrate_v4(c: sqlite3.Cursor) -> None:
+    """ Хеш образцов (начало, середина, конец) для поэтапного сравнения больших файлов. """
+    c.execute("ALTER TABLE file_data ADD COLUMN sample_hash TEXT")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_file_data_size_sample ON file_data (size, sample_hash)")
+
+
+def _migrate_v5(c: sqlite3.Cursor) -> None:
+    """ Настройки репозитория; каталоги, уже содержащие хеши, помечаются как SHA-256. """
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS settings (
+            key TEXT PRIMARY KEY,
+            value TEXT
+        )
+    ''')
+    if c.execute("SELECT 1 FROM file_data LIMIT 1").fetchone():
+        c.execute("INSERT OR IGNORE INTO settings (key, value) VALUES ('hash_algorithm', 'sha256')")
+
+
+def _migrate_v6(c: sqlite3.Cursor) -> None:
+    """ Индекс директорий: время изменения и список дочерних имен на момент последнего обхода. """
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS dir_index (
+            path TEXT PRIMARY KEY,
+            mtime_ns INTEGER NOT NULL,
+            children TEXT NOT NULL
+        )
+    ''')
+
+
+def _migrate_v7(c: sqlite3.Cursor) -> None:
+    """ Вид правила исключения: путь, шаблон glob или регулярное выражение. """
+    c.execute("ALTER TABLE excluded_directories ADD COLUMN kind TEXT NOT NULL DEFAULT 'path'")
+
+
+def _migrate_v8(c: sqlite3.Cursor) -> None:
+    """ Снимки и их манифесты: список файлов каждого снимка с хешем, размером и временем изменения. """
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS snapshots (
+            id INTEGER PRIMARY KEY,
+            name TEXT UNIQUE NOT NULL,
+            path TEXT NOT NULL,
+            source TEXT,
+            backend TEXT,
+            started REAL,
+            finished REAL,
+            file_count INTEGER NOT NULL DEFAULT 0,
+            total_size INTEGER NOT NULL DEFAULT 0
+        )
+    ''')
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS manifest (
+            snapshot_id INTEGER NOT NULL,
+            rel_path TEXT NOT NULL,
+            hash TEXT NOT NULL,
+            size INTEGER NOT NULL,
+            mtime_ns INTEGER,
+            PRIMARY KEY (snapshot_id, rel_path)
+        ) WITHOUT ROWID
+    ''')
+    c.execute("CREATE INDEX IF NOT EXISTS idx_manifest_path ON manifest (rel_path, snapshot_id)")
+
+
+def _migrate_v9(c: sqlite3.Cursor) -> None:
+    """ Индекс пак-файлов: где лежит сжатое содержимое каждого упакованного файла. """
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS pack_objects (
+            hash TEXT PRIMARY KEY,
+            pack INTEGER NOT NULL,
+            offset INTEGER NOT NULL,
+            length INTEGER NOT NULL,
+            size INTEGER NOT NULL,
+            codec TEXT NOT NULL
+        ) WITHOUT ROWID
+    ''')
+    c.execute("CREATE INDEX IF NOT EXISTS idx_pack_objects_pack ON pack_objects (pack)")
+
+
+def _migrate_v10(c: sqlite3.Cursor) -> None:
+    """ Результаты проверки целостности: состояние и время последней проверки каждого объекта. """
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS scrub_results (
+            kind TEXT NOT NULL,
+            key TEXT NOT NULL,
+            hash TEXT,
+            path TEXT,
+            status TEXT NOT NULL,
+            verified REAL NOT NULL,
+            PRIMARY KEY (kind, key)
+        ) WITHOUT ROWID
+    ''')
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS scrub_runs (
+            id INTEGER PRIMARY KEY,
+            scope TEXT,
+            started REAL NOT NULL,
+            finished REAL,
+            stats TEXT
+        )
+    ''')
+
+
+def _migrate_v11(c: sqlite3.Cursor) -> None:
+    """ Наборы резервного копирования: именованные списки источников с общим каталогом. """
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS backup_sets (
+            name TEXT NOT NULL,
+            source TEXT NOT NULL,
+            PRIMARY KEY (name, source)
+        ) WITHOUT ROWID
+    ''')
+    c.execute("ALTER TABLE snapshots ADD COLUMN backup_set TEXT")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_snapshots_source ON snapshots (source, backup_set)")
+
+
+def _migrate_v12(c: sqlite3.Cursor) -> None:
+    """ Индекс по пути в резервной копии: выборки и удаление файлов одного снимка по диапазону путей. """
+    c.execute("CREATE INDEX IF NOT EXISTS idx_file_data_backup_path ON file_data (backup_path)")
+
+
+UPSERT_FILE_DATA = '''
+    INSERT INTO file_data (path, size, last_modified, hash, backup_path, mtime_ns, inode, ctime_ns, sample_hash)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+    ON CONFLICT (path, hash) DO UPDATE SET
+        size = excluded.size,
+        last_modified = excluded.last_modified,
+        backup_path = excluded.backup_path,
+        mtime_ns = excluded.mtime_ns,
+        inode = excluded.inode,
+        ctime_ns = excluded.ctime_ns,
+        sample_hash = COALESCE(excluded.sample_hash, sample_hash)
+'''
+
+# Миграции схемы: версия -> функция, переводящая базу из предыдущей версии в эту
+MIGRATIONS = {
+    1: _migrate_v1,
+    2: _migrate_v2,
+    3: _migrate_v3,
+    4: _migrate_v4,
+    5: _migrate_v5,
+    6: _migrate_v6,
+    7: _migrate_v7,
+    8: _migrate_v8,
+    9: _migrate_v9,
+    10: _migrate_v10,
+    11: _migrate_v11,
+    12: _migrate_v12,
+}
+
+
 def create_table(conn: sqlite3.Connection) -> None:
     """
-    Создает таблицу в базе данных.
+    Создает таблицы в базе данных и приводит схему к версии SCHEMA_VERSION.
 
     :param conn: Объект соединения с базой данных
     """
-    with conn:
-        try:
+    try:
+        with conn:
             c = conn.cursor()
-            # Таблица для данных о файлах
-            c.execute('''
-                CREATE TABLE IF NOT EXISTS file_data (
-                    path TEXT,
-                    size INTEGER,
-                    last_modified REAL,
-                    hash TEXT,
-                    backup_path TEXT
-                )
-            ''')
-            # Таблица для исключенных директорий
-            c.execute('''
-                CREATE TABLE IF NOT EXISTS excluded_directories (
-                    path TEXT UNIQUE
-                )
-            ''')
-            logging.info("Таблицы созданы успешно")
-        except Exception as e:
-            logging.error(f"Ошибка при создании таблиц: {e}")
+            # Блокировка записи берется до чтения версии: иначе два процесса могут прочитать одну
+            # версию и оба начать миграцию, а повышение отложенной блокировки не ждет busy timeout
+            c.execute("BEGIN IMMEDIATE")
+            version = c.execute("PRAGMA user_version").fetchone()[0]
+            for target in range(version + 1, SCHEMA_VERSION + 1):
+                MIGRATIONS[target](c)
+                c.execute(f"PRAGMA user_version = {target}")
+                logging.info(f"Схема базы данных обновлена до версии {target}")
+    except Exception as e:
+        logging.error(f"Ошибка при создании таблиц: {e}")
 
 
-def add_excluded_directory(conn: sqlite3.Connection, directory_path: str) -> None:
+def add_excluded_directory(conn: sqlite3.Connection, directory_path: str, kind: str = 'path') -> None:
     try:
         c = conn.cursor()
         c.execute('''
-            INSERT INTO excluded_directories (path) VALUES (?)
-        ''', (directory_path,))
+            INSERT INTO excluded_directories (path, kind) VALUES (?, ?)
+        ''', (directory_path, kind))
         conn.commit()
         logging.info(f"Директория {directory_path} добавлена в список исключений")
     except Exception as e:
@@ -72,6 +290,22 @@ def get_excluded_directories(conn: sqlite3.Connection) -> List[str]:
         return []
 
 
+def get_exclusion_rules(conn: sqlite3.Connection) -> List[Tuple[str, str]]:
+    """
+    Возвращает все правила исключения.
+
+    :param conn: Объект соединения с базой данных
+    :return: Список пар (путь или шаблон, вид правила: path, glob или regex)
+    """
+    try:
+        c = conn.cursor()
+        c.execute("SELECT path, kind FROM excluded_directories")
+        return c.fetchall()
+    except Exception as e:
+        logging.error(f"Ошибка при получении списка исключенных директорий: {e}")
+        return []
+
+
 def remove_excluded_directory(conn: sqlite3.Connection, directory_path: str) -> None:
     try:
         c = conn.cursor()
@@ -85,7 +319,10 @@ def remove_excluded_directory(conn: sqlite3.Connection, directory_path: str) ->
 
 
 def insert_file_data(conn: sqlite3.Connection, orig_path: str, size: int,
-                     last_modified: float, file_hash: str, backup_path: str) -> None:
+                     last_modified: float, file_hash: str, backup_path: str,
+                     mtime_ns: Optional[int] = None, inode: Optional[int] = None,
+                     ctime_ns: Optional[int] = None, sample_hash: Optional[str] = None,
+                     commit: bool = True) -> None:
     """
     Вставляет или обновляет данные о файле в базе данных.
 
@@ -95,31 +332,25 @@ def insert_file_data(conn: sqlite3.Connection, orig_path: str, size: int,
     :param last_modified: Время последнего изменения файла
     :param file_hash: Хеш файла
     :param backup_path: Путь к резервной копии файла
+    :param mtime_ns: Время последнего изменения файла в наносекундах
+    :param inode: Номер inode исходного файла
+    :param ctime_ns: Время изменения метаданных файла в наносекундах
+    :param sample_hash: Хеш образцов большого файла (см. file_utils.calculate_sample_hash)
+    :param commit: Зафиксировать транзакцию сразу; False - запись войдет в текущую пачку
     """
     try:
-        c = conn.cursor()
-        c.execute("SELECT path, hash FROM file_data WHERE path=? AND hash=?", (orig_path, file_hash))
-        existing_record = c.fetchone()
-
-        if existing_record:
-            c.execute('''
-                UPDATE file_data
-                SET size = ?, last_modified = ?, backup_path = ?
-                WHERE path = ? AND hash = ?
-            ''', (size, last_modified, backup_path, orig_path, file_hash))
-        else:
-            c.execute('''
-                INSERT INTO file_data (path, size, last_modified, hash, backup_path)
-                VALUES (?, ?, ?, ?, ?)
-            ''', (orig_path, size, last_modified, file_hash, backup_path))
-
-        conn.commit()
+        conn.execute(UPSERT_FILE_DATA,
+                     (orig_path, size, last_modified, file_hash, backup_path, mtime_ns, inode, ctime_ns,
+                      sample_hash))
+        if commit:
+            conn.commit()
     except Exception as e:
         logging.error(f"Ошибка при вставке или обновлении данных: {e}")
 
 
 def get_file_data(conn: sqlite3.Connection, file_hash: Optional[str] = None,
-                  size: Optional[int] = None, last_modified: Optional[float] = None) -> Optional[Tuple[Any, ...]]:
+                  size: Optional[int] = None, last_modified: Optional[float] = None,
+                  backup_dir: Optional[str] = None) -> Optional[Tuple[Any, ...]]:
     """
     Получает данные о файле из базы данных.
 
@@ -127,11 +358,19 @@ def get_file_data(conn: sqlite3.Connection, file_hash: Optional[str] = None,
     :param file_hash: Хеш файла (для поиска)
     :param size: Размер файла (для поиска)
     :param last_modified: Время последнего изменения файла (для поиска)
+    :param backup_dir: Искать по хешу только копии внутри этой директории (пункта назначения)
     :return: Кортеж с данными о файле или None, если данные не найдены
     """
     try:
         c = conn.cursor()
-        if file_hash:
+        if file_hash and backup_dir:
+            prefix = os.path.join(backup_dir, '')
+            upper = prefix[:-1] + chr(ord(prefix[-1]) + 1)
+            c.execute('''
+                SELECT path, size, last_modified, backup_path FROM file_data
+                WHERE hash=? AND backup_path >= ? AND backup_path < ?
+            ''', (file_hash, prefix, upper))
+        elif file_hash:
             c.execute("SELECT path, size, last_modified, backup_path FROM file_data WHERE hash=?", (file_hash,))
         elif size is not None and last_modified is not None:
             c.execute("SELECT path, hash, backup_path FROM file_data WHERE size=? AND last_modified=?",
@@ -143,3 +382,834 @@ def get_file_data(conn: sqlite3.Connection, file_hash: Optional[str] = None,
     except Exception as e:
         logging.error(f"Ошибка при получении данных: {e}")
         return None
+
+
+def has_sample_match(conn: sqlite3.Connection, size: int, sample_hash: str) -> bool:
+    """
+    Проверяет, есть ли в базе файл того же размера с тем же хешем образцов.
+
+    :param conn: Объект соединения с базой данных
+    :param size: Размер файла
+    :param sample_hash: Хеш образцов файла
+    :return: True, если такой файл есть и стоит вычислить полный хеш
+    """
+    try:
+        c = conn.cursor()
+        c.execute("SELECT 1 FROM file_data WHERE size=? AND sample_hash=? LIMIT 1", (size, sample_hash))
+        return c.fetchone() is not None
+    except Exception as e:
+        logging.error(f"Ошибка при получении данных: {e}")
+        return False
+
+
+def get_cached_file_data(conn: sqlite3.Connection, orig_path: str, size: int, mtime_ns: int,
+                         inode: int, ctime_ns: int) -> Optional[Tuple[str, str]]:
+    """
+    Ищет запись о неизмененном файле по пути и метаданным из stat.
+
+    :param conn: Объект соединения с базой данных
+    :param orig_path: Оригинальный путь к файлу
+    :param size: Размер файла
+    :param mtime_ns: Время последнего изменения файла в наносекундах
+    :param inode: Номер inode файла
+    :param ctime_ns: Время изменения метаданных файла в наносекундах
+    :return: Кортеж (хеш, путь к резервной копии) или None, если файл изменился
+    """
+    try:
+        c = conn.cursor()
+        c.execute('''
+            SELECT hash, backup_path FROM file_data INDEXED BY idx_file_data_path_hash
+            WHERE path=? AND size=? AND mtime_ns=? AND inode=? AND ctime_ns=? AND hash IS NOT NULL
+        ''', (orig_path, size, mtime_ns, inode, ctime_ns))
+        return c.fetchone()
+    except Exception as e:
+        logging.error(f"Ошибка при получении данных: {e}")
+        return None
+
+
+def insert_file_chunks(conn: sqlite3.Connection, file_hash: str, chunks: List[Tuple[str, int]],
+                       commit: bool = True) -> None:
+    """
+    Сохраняет упорядоченный список фрагментов файла.
+
+    :param conn: Объект соединения с базой данных
+    :param file_hash: Хеш файла
+    :param chunks: Список (хеш фрагмента, размер) по порядку
+    :param commit: Зафиксировать транзакцию сразу
+    """
+    try:
+        conn.executemany("INSERT OR IGNORE INTO chunks (hash, size) VALUES (?, ?)", chunks)
+        conn.executemany('''
+            INSERT OR IGNORE INTO file_chunks (file_hash, seq, chunk_hash) VALUES (?, ?, ?)
+        ''', [(file_hash, seq, chunk_hash) for seq, (chunk_hash, _) in enumerate(chunks)])
+        if commit:
+            conn.commit()
+    except Exception as e:
+        logging.error(f"Ошибка при сохранении фрагментов файла: {e}")
+
+
+def get_file_chunks(conn: sqlite3.Connection, file_hash: str) -> List[str]:
+    """
+    Возвращает хеши фрагментов файла по порядку.
+
+    :param conn: Объект соединения с базой данных
+    :param file_hash: Хеш файла
+    :return: Список хешей фрагментов (пустой, если файл не разбит на фрагменты)
+    """
+    try:
+        c = conn.cursor()
+        c.execute("SELECT chunk_hash FROM file_chunks WHERE file_hash=? ORDER BY seq", (file_hash,))
+        return [row[0] for row in c.fetchall()]
+    except Exception as e:
+        logging.error(f"Ошибка при получении фрагментов файла: {e}")
+        return []
+
+
+def insert_pack_object(conn: sqlite3.Connection, file_hash: str, pack: int, offset: int, length: int, size: int,
+                       codec: str, commit: bool = True) -> None:
+    """
+    Сохраняет положение упакованного содержимого в пак-файле.
+
+    :param conn: Объект соединения с базой данных
+    :param file_hash: Хеш содержимого
+    :param pack: Номер пак-файла
+    :param offset: Смещение сжатых данных в пак-файле
+    :param length: Длина сжатых данных
+    :param size: Размер исходного содержимого
+    :param codec: Способ сжатия
+    :param commit: Зафиксировать транзакцию сразу
+    """
+    try:
+        conn.execute('''
+            INSERT OR IGNORE INTO pack_objects (hash, pack, offset, length, size, codec) VALUES (?, ?, ?, ?, ?, ?)
+        ''', (file_hash, pack, offset, length, size, codec))
+        if commit:
+            conn.commit()
+    except Exception as e:
+        logging.error(f"Ошибка при сохранении записи пак-файла: {e}")
+
+
+def get_pack_object(conn: sqlite3.Connection, file_hash: str) -> Optional[Tuple[int, int, int, int, str]]:
+    """
+    Возвращает положение упакованного содержимого.
+
+    :param conn: Объект соединения с базой данных
+    :param file_hash: Хеш содержимого
+    :return: Кортеж (номер пак-файла, смещение, длина, размер, способ сжатия) или None
+    """
+    try:
+        c = conn.cursor()
+        c.execute("SELECT pack, offset, length, size, codec FROM pack_objects WHERE hash=?", (file_hash,))
+        return c.fetchone()
+    except Exception as e:
+        logging.error(f"Ошибка при получении записи пак-файла: {e}")
+        return None
+
+
+def delete_orphan_pack_objects(conn: sqlite3.Connection) -> Tuple[int, Optional[Set[int]]]:
+    """
+    Удаляет из индекса пак-файлов содержимое, которого нет ни в одном манифесте.
+
+    Сами данные остаются в пак-файлах; место освобождается, когда в пак-файле
+    не остается ни одного используемого объекта.
+
+    :param conn: Объект соединения с базой данных
+    :return: Кортеж (количество удаленных записей, номера пак-файлов с используемыми объектами
+             или None в случае ошибки)
+    """
+    try:
+        removed = conn.execute("DELETE FROM pack_objects WHERE hash NOT IN (SELECT hash FROM manifest)").rowcount
+        conn.commit()
+        live = {row[0] for row in conn.execute("SELECT DISTINCT pack FROM pack_objects")}
+        return removed, live
+    except Exception as e:
+        logging.error(f"Ошибка при удалении неиспользуемых записей пак-файлов: {e}")
+        return 0, None
+
+
+def get_backup_entries(conn: sqlite3.Connection, backup_dir: str) -> Dict[str, Tuple[str, int, Optional[int]]]:
+    """
+    Возвращает записи каталога для файлов, лежащих внутри директории резервной копии.
+
+    :param conn: Объект соединения с базой данных
+    :param backup_dir: Директория снимка
+    :return: Словарь путь в снимке -> (хеш, размер, mtime_ns исходного файла)
+    """
+    prefix = os.path.join(backup_dir, '')
+    # Диапазон строк с префиксом prefix: разделитель заменяется следующим за ним символом
+    upper = prefix[:-1] + chr(ord(prefix[-1]) + 1)
+    try:
+        c = conn.cursor()
+        c.execute('''
+            SELECT backup_path, hash, size, mtime_ns FROM file_data
+            WHERE backup_path >= ? AND backup_path < ? AND hash IS NOT NULL
+        ''', (prefix, upper))
+        return {row[0]: row[1:] for row in c.fetchall()}
+    except Exception as e:
+        logging.error(f"Ошибка при получении записей снимка {backup_dir}: {e}")
+        return {}
+
+
+def get_setting(conn: sqlite3.Connection, key: str, default: Optional[str] = None) -> Optional[str]:
+    """
+    Возвращает значение настройки репозитория.
+
+    :param conn: Объект соединения с базой данных
+    :param key: Название настройки
+    :param default: Значение по умолчанию
+    :return: Значение настройки или default, если она не задана
+    """
+    try:
+        row = conn.execute("SELECT value FROM settings WHERE key=?", (key,)).fetchone()
+        return row[0] if row else default
+    except Exception as e:
+        logging.error(f"Ошибка при получении настройки {key}: {e}")
+        return default
+
+
+def set_setting(conn: sqlite3.Connection, key: str, value: str) -> None:
+    """
+    Сохраняет значение настройки репозитория.
+
+    :param conn: Объект соединения с базой данных
+    :param key: Название настройки
+    :param value: Значение настройки
+    """
+    try:
+        conn.execute("INSERT OR REPLACE INTO settings (key, value) VALUES (?, ?)", (key, value))
+        conn.commit()
+    except Exception as e:
+        logging.error(f"Ошибка при сохранении настройки {key}: {e}")
+
+
+def resolve_hash_algorithm(conn: sqlite3.Connection, requested: Optional[str] = None,
+                           default: str = 'sha256') -> str:
+    """
+    Определяет алгоритм хеширования репозитория.
+
+    Алгоритм выбирается при первом копировании и сохраняется в базе: хеши в каталоге
+    сравнимы только между собой, поэтому сменить его у заполненного каталога нельзя.
+
+    :param conn: Объект соединения с базой данных
+    :param requested: Алгоритм, запрошенный пользователем, или None
+    :param default: Алгоритм для нового репозитория, если ничего не запрошено
+    :return: Алгоритм, которым нужно хешировать файлы этого репозитория
+    """
+    stored = get_setting(conn, 'hash_algorithm')
+    if stored is None:
+        stored = requested or default
+        set_setting(conn, 'hash_algorithm', stored)
+    elif requested and requested != stored:
+        logging.warning(f"Репозиторий использует алгоритм {stored}, запрошенный {requested} игнорируется")
+    return stored
+
+
+def get_dir_index(conn: sqlite3.Connection, dir_path: str) -> Optional[Tuple[int, List[str]]]:
+    """
+    Возвращает сохраненное состояние директории.
+
+    :param conn: Объект соединения с базой данных
+    :param dir_path: Путь к директории
+    :return: Кортеж (mtime_ns директории, список дочерних имен) или None
+    """
+    try:
+        row = conn.execute("SELECT mtime_ns, children FROM dir_index WHERE path=?", (dir_path,)).fetchone()
+        if row is None:
+            return None
+        return row[0], row[1].split('\0') if row[1] else []
+    except Exception as e:
+        logging.error(f"Ошибка при получении индекса директории {dir_path}: {e}")
+        return None
+
+
+def save_dir_index(conn: sqlite3.Connection, dir_path: str, mtime_ns: int, children: List[str],
+                   commit: bool = True) -> None:
+    """
+    Сохраняет состояние директории после ее обхода.
+
+    :param conn: Объект соединения с базой данных
+    :param dir_path: Путь к директории
+    :param mtime_ns: Время изменения директории в наносекундах
+    :param children: Дочерние имена (имена файлов не содержат нулевого байта)
+    :param commit: Зафиксировать транзакцию сразу
+    """
+    try:
+        conn.execute("INSERT OR REPLACE INTO dir_index (path, mtime_ns, children) VALUES (?, ?, ?)",
+                     (dir_path, mtime_ns, '\0'.join(children)))
+        if commit:
+            conn.commit()
+    except Exception as e:
+        logging.error(f"Ошибка при сохранении индекса директории {dir_path}: {e}")
+
+
+def save_snapshot(conn: sqlite3.Connection, name: str, path: str, source: str, backend: str,
+                  started: float, finished: float,
+                  carried: Optional[Iterable[Tuple[str, str, int, Optional[int]]]] = None,
+                  backup_set: Optional[str] = None) -> Optional[int]:
+    """
+    Регистрирует завершенный снимок и одним запросом записывает его манифест.
+
+    Манифест строится внутри SQLite из записей каталога, которые указывают в директорию
+    снимка, поэтому список файлов не держится в памяти. Файлы, перенесенные из предыдущего
+    снимка без обращения к источнику, передаются через carried и записываются потоком.
+
+    :param conn: Объект соединения с базой данных
+    :param name: Имя снимка (имя его директории)
+    :param path: Директория снимка
+    :param source: Исходный путь
+    :param backend: Способ хранения
+    :param started: Время начала копирования (Unix time)
+    :param finished: Время окончания копирования (Unix time) или None для прерванного снимка
+    :param carried: Итератор записей манифеста (относительный путь, хеш, размер, mtime_ns) перенесенных файлов
+    :param backup_set: Имя набора резервного копирования или None
+    :return: Идентификатор снимка или None в случае ошибки
+    """
+    prefix = os.path.join(path, '')
+    upper = prefix[:-1] + chr(ord(prefix[-1]) + 1)
+    try:
+        with conn:
+            c = conn.cursor()
+            # Продолженный снимок заменяет свою незавершенную запись
+            c.execute("DELETE FROM manifest WHERE snapshot_id IN (SELECT id FROM snapshots WHERE name=?)", (name,))
+            c.execute("DELETE FROM snapshots WHERE name=?", (name,))
+            c.execute('''
+                INSERT INTO snapshots (name, path, source, backend, started, finished, backup_set)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+            ''', (name, path, source, backend, started, finished, backup_set))
+            snapshot_id = c.lastrowid
+            if carried is not None:
+                c.executemany('''
+                    INSERT OR REPLACE INTO manifest (snapshot_id, rel_path, hash, size, mtime_ns)
+                    VALUES (?, ?, ?, ?, ?)
+                ''', ((snapshot_id,) + tuple(row) for row in carried))
+            c.execute('''
+                INSERT OR REPLACE INTO manifest (snapshot_id, rel_path, hash, size, mtime_ns)
+                SELECT ?, substr(backup_path, ?), hash, size, mtime_ns FROM file_data
+                WHERE backup_path >= ? AND backup_path < ? AND hash IS NOT NULL
+            ''', (snapshot_id, len(prefix) + 1, prefix, upper))
+            c.execute('''
+                UPDATE snapshots SET (file_count, total_size) =
+                    (SELECT COUNT(*), COALESCE(SUM(size), 0) FROM manifest WHERE snapshot_id=?)
+                WHERE id=?
+            ''', (snapshot_id, snapshot_id))
+        return snapshot_id
+    except Exception as e:
+        logging.error(f"Ошибка при сохранении снимка {name}: {e}")
+        return None
+
+
+def list_snapshots(conn: sqlite3.Connection) -> List[Tuple[Any, ...]]:
+    """
+    Возвращает список снимков от старых к новым.
+
+    :param conn: Объект соединения с базой данных
+    :return: Список кортежей (id, имя, путь, источник, способ хранения, начало, окончание,
+             количество файлов, общий размер, набор резервного копирования)
+    """
+    try:
+        c = conn.cursor()
+        c.execute('''
+            SELECT id, name, path, source, backend, started, finished, file_count, total_size, backup_set
+            FROM snapshots ORDER BY name
+        ''')
+        return c.fetchall()
+    except Exception as e:
+        logging.error(f"Ошибка при получении списка снимков: {e}")
+        return []
+
+
+def get_latest_snapshot(conn: sqlite3.Connection, source: str, finished: bool = False,
+                        backup_set: Optional[str] = None) -> Optional[Tuple[Any, ...]]:
+    """
+    Находит последний снимок источника.
+
+    :param conn: Объект соединения с базой данных
+    :param source: Исходный путь
+    :param finished: Искать только среди завершенных снимков (незавершенные - отмененные)
+    :param backup_set: Набор резервного копирования: снимки источника в другом наборе не учитываются
+    :return: Кортеж в формате list_snapshots или None, если снимков источника нет
+    """
+    try:
+        c = conn.cursor()
+        c.execute(f'''
+            SELECT id, name, path, source, backend, started, finished, file_count, total_size, backup_set
+            FROM snapshots WHERE source=? AND backup_set IS ? {"AND finished IS NOT NULL" if finished else ""}
+            ORDER BY id DESC LIMIT 1
+        ''', (source, backup_set))
+        return c.fetchone()
+    except Exception as e:
+        logging.error(f"Ошибка при получении последнего снимка {source}: {e}")
+        return None
+
+
+def get_snapshot(conn: sqlite3.Connection, name: str) -> Optional[Tuple[Any, ...]]:
+    """
+    Находит снимок по имени.
+
+    :param conn: Объект соединения с базой данных
+    :param name: Имя снимка
+    :return: Кортеж в формате list_snapshots или None, если снимок не зарегистрирован
+    """
+    try:
+        c = conn.cursor()
+        c.execute('''
+            SELECT id, name, path, source, backend, started, finished, file_count, total_size, backup_set
+            FROM snapshots WHERE name=?
+        ''', (name,))
+        return c.fetchone()
+    except Exception as e:
+        logging.error(f"Ошибка при получении снимка {name}: {e}")
+        return None
+
+
+def get_manifest(conn: sqlite3.Connection, snapshot_id: int,
+                 prefix: Optional[str] = None) -> Iterator[Tuple[str, str, int, Optional[int]]]:
+    """
+    Перебирает файлы снимка в порядке путей.
+
+    :param conn: Объект соединения с базой данных
+    :param snapshot_id: Идентификатор снимка
+    :param prefix: Относительный путь директории, содержимое которой нужно получить, или None
+    :return: Итератор кортежей (относительный путь, хеш, размер, mtime_ns исходного файла)
+    """
+    try:
+        c = conn.cursor()
+        if prefix:
+            prefix = os.path.join(prefix, '')
+            upper = prefix[:-1] + chr(ord(prefix[-1]) + 1)
+            c.execute('''
+                SELECT rel_path, hash, size, mtime_ns FROM manifest
+                WHERE snapshot_id=? AND rel_path >= ? AND rel_path < ? ORDER BY rel_path
+            ''', (snapshot_id, prefix, upper))
+        else:
+            c.execute('''
+                SELECT rel_path, hash, size, mtime_ns FROM manifest WHERE snapshot_id=? ORDER BY rel_path
+            ''', (snapshot_id,))
+        yield from c
+    except Exception as e:
+        logging.error(f"Ошибка при получении манифеста снимка {snapshot_id}: {e}")
+
+
+def get_manifest_entry(conn: sqlite3.Connection, snapshot_id: int,
+                       rel_path: str) -> Optional[Tuple[str, int, Optional[int]]]:
+    """
+    Находит файл в манифесте снимка.
+
+    :param conn: Объект соединения с базой данных
+    :param snapshot_id: Идентификатор снимка
+    :param rel_path: Путь файла относительно корня снимка
+    :return: Кортеж (хеш, размер, mtime_ns) или None, если такого файла в снимке нет
+    """
+    try:
+        c = conn.cursor()
+        c.execute("SELECT hash, size, mtime_ns FROM manifest WHERE snapshot_id=? AND rel_path=?",
+                  (snapshot_id, rel_path))
+        return c.fetchone()
+    except Exception as e:
+        logging.error(f"Ошибка при получении файла {rel_path} снимка {snapshot_id}: {e}")
+        return None
+
+
+def get_snapshot_children(conn: sqlite3.Connection, snapshot_id: int, dir_path: str = '',
+                          start: Optional[str] = None) -> Iterator[Tuple[str, bool, Optional[str], int,
+                                                                           Optional[int], str]]:
+    """
+    Перебирает содержимое директории снимка по манифесту: файлы и поддиректории первого уровня.
+
+    Поддиректория занимает в манифесте по строке на каждый свой файл, но перебор
+    перескакивает через них новым поиском по первичному ключу, поэтому стоимость зависит
+    от количества элементов директории, а не от размера ее поддеревьев. Элементы идут
+    в порядке путей манифеста.
+
+    :param conn: Объект соединения с базой данных
+    :param snapshot_id: Идентификатор снимка
+    :param dir_path: Путь директории относительно корня снимка ('' - корень)
+    :param start: Путь элемента, после которого продолжить перебор, или None - с начала
+    :return: Итератор (имя, директория ли, хеш, размер, mtime_ns, путь элемента);
+             у директорий хеш и mtime_ns - None, размер - 0
+    """
+    prefix = os.path.join(dir_path, '') if dir_path else ''
+    key, last = prefix, None
+    if start is not None and start.startswith(prefix):
+        key, last = start, start[len(prefix):]
+    bounds = "AND rel_path < ?" if prefix else ""
+    upper = (prefix[:-1] + chr(ord(prefix[-1]) + 1),) if prefix else ()
+    try:
+        while True:
+            c = conn.execute(f'''
+                SELECT rel_path, hash, size, mtime_ns FROM manifest
+                WHERE snapshot_id=? AND rel_path >= ? {bounds} ORDER BY rel_path
+            ''', (snapshot_id, key) + upper)
+            for rel_path, file_hash, size, mtime_ns in c:
+                name, sep, _ = rel_path[len(prefix):].partition(os.sep)
+                if sep:
+                    # Следующий поиск начнется сразу после всех путей этой поддиректории
+                    key = prefix + name + chr(ord(os.sep) + 1)
+                    if name != last:
+                        yield name, True, None, 0, None, prefix + name
+                    break
+                if name != last:
+                    yield name, False, file_hash, size, mtime_ns, rel_path
+            else:
+                return
+    except Exception as e:
+        logging.error(f"Ошибка при получении содержимого {dir_path or os.curdir} снимка {snapshot_id}: {e}")
+
+
+def get_path_versions(conn: sqlite3.Connection, rel_path: str) -> List[Tuple[str, str, int, Optional[int]]]:
+    """
+    Возвращает все сохраненные версии файла.
+
+    :param conn: Объект соединения с базой данных
+    :param rel_path: Путь файла относительно корня снимка
+    :return: Список кортежей (имя снимка, хеш, размер, mtime_ns) от старых снимков к новым
+    """
+    try:
+        c = conn.cursor()
+        c.execute('''
+            SELECT s.name, m.hash, m.size, m.mtime_ns FROM manifest m JOIN snapshots s ON s.id = m.snapshot_id
+            WHERE m.rel_path=? ORDER BY s.name
+        ''', (rel_path,))
+        return c.fetchall()
+    except Exception as e:
+        logging.error(f"Ошибка при получении версий файла {rel_path}: {e}")
+        return []
+
+
+def get_snapshot_growth(conn: sqlite3.Connection, snapshot_ids: List[int]) -> Dict[int, int]:
+    """
+    Распределяет уникальное содержимое набора снимков по снимкам, начиная с новых.
+
+    Каждый хеш засчитывается самому новому снимку набора, в котором он встречается, поэтому
+    сумма по первым k снимкам (от новых к старым) - объем данных, нужный для хранения этих k снимков.
+    Группировка выполняется в SQLite и при большом каталоге использует временные файлы, а не память.
+
+    :param conn: Объект соединения с базой данных
+    :param snapshot_ids: Идентификаторы снимков
+    :return: Словарь идентификатор снимка -> байты, впервые появившиеся в нем
+    """
+    if not snapshot_ids:
+        return {}
+    try:
+        c = conn.cursor()
+        placeholders = ','.join('?' * len(snapshot_ids))
+        c.execute(f'''
+            SELECT newest, SUM(size) FROM (
+                SELECT MAX(snapshot_id) AS newest, MAX(size) AS size FROM manifest
+                WHERE snapshot_id IN ({placeholders}) GROUP BY hash
+            ) GROUP BY newest
+        ''', snapshot_ids)
+        return dict(c.fetchall())
+    except Exception as e:
+        logging.error(f"Ошибка при подсчете объема снимков: {e}")
+        return {}
+
+
+def delete_snapshot(conn: sqlite3.Connection, snapshot_id: int, path: str) -> int:
+    """
+    Удаляет снимок из каталога: манифест, запись снимка и записи file_data, указывающие в его директорию.
+
+    Файлы, перенесенные в более новые снимки жесткими ссылками, по-прежнему указывают в каталоге
+    на снимок, где были скопированы впервые. Такие записи перенаправляются на самый новый
+    из оставшихся снимков с тем же путем и хешем; удаляются только записи без живой копии.
+
+    :param conn: Объект соединения с базой данных
+    :param snapshot_id: Идентификатор снимка
+    :param path: Директория снимка
+    :return: Количество удаленных записей file_data
+    """
+    prefix = os.path.join(path, '')
+    upper = prefix[:-1] + chr(ord(prefix[-1]) + 1)
+    try:
+        with conn:
+            c = conn.cursor()
+            c.execute('''
+                UPDATE file_data SET backup_path = COALESCE((
+                    SELECT s.path || ? || m.rel_path FROM manifest m JOIN snapshots s ON s.id = m.snapshot_id
+                    WHERE m.rel_path = substr(file_data.backup_path, ?) AND m.hash = file_data.hash
+                        AND m.snapshot_id != ?
+                    ORDER BY m.snapshot_id DESC LIMIT 1
+                ), backup_path)
+                WHERE backup_path >= ? AND backup_path < ?
+            ''', (os.sep, len(prefix) + 1, snapshot_id, prefix, upper))
+            c.execute("DELETE FROM manifest WHERE snapshot_id=?", (snapshot_id,))
+            c.execute("DELETE FROM snapshots WHERE id=?", (snapshot_id,))
+            c.execute("DELETE FROM file_data WHERE backup_path >= ? AND backup_path < ?", (prefix, upper))
+            return c.rowcount
+    except Exception as e:
+        logging.error(f"Ошибка при удалении снимка {path} из каталога: {e}")
+        return 0
+
+
+def delete_orphan_chunk_lists(conn: sqlite3.Connection) -> Optional[int]:
+    """
+    Удаляет списки фрагментов файлов, которых нет ни в одном манифесте.
+
+    После этого фрагменты без ссылок можно перебрать функцией get_orphan_chunks.
+
+    :param conn: Объект соединения с базой данных
+    :return: Количество удаленных записей или None в случае ошибки
+    """
+    try:
+        removed = conn.execute("DELETE FROM file_chunks WHERE file_hash NOT IN (SELECT hash FROM manifest)").rowcount
+        conn.commit()
+        return removed
+    except Exception as e:
+        logging.error(f"Ошибка при удалении списков фрагментов: {e}")
+        return None
+
+
+def get_orphan_chunks(conn: sqlite3.Connection, after: str = '',
+                      limit: int = ORPHAN_PAGE_SIZE) -> List[Tuple[str, int]]:
+    """
+    Возвращает страницу фрагментов, на которые не ссылается ни один файл.
+
+    Страницы идут по возрастанию хеша: фрагмент, который не удалось удалить с диска и который
+    остался в каталоге, не попадет в следующие страницы того же перебора.
+
+    :param conn: Объект соединения с базой данных
+    :param after: Хеш последнего фрагмента предыдущей страницы ('' - первая страница)
+    :param limit: Количество фрагментов на странице
+    :return: Список (хеш фрагмента, размер)
+    """
+    try:
+        c = conn.cursor()
+        c.execute('''
+            SELECT hash, size FROM chunks
+            WHERE hash > ? AND hash NOT IN (SELECT chunk_hash FROM file_chunks)
+            ORDER BY hash LIMIT ?
+        ''', (after, limit))
+        return c.fetchall()
+    except Exception as e:
+        logging.error(f"Ошибка при поиске неиспользуемых фрагментов: {e}")
+        return []
+
+
+def delete_chunks(conn: sqlite3.Connection, chunk_hashes: Iterable[str]) -> None:
+    """
+    Удаляет из каталога фрагменты, файлы которых уже удалены из хранилища.
+
+    :param conn: Объект соединения с базой данных
+    :param chunk_hashes: Хеши фрагментов
+    """
+    try:
+        conn.executemany("DELETE FROM chunks WHERE hash=?", ((chunk_hash,) for chunk_hash in chunk_hashes))
+        conn.commit()
+    except Exception as e:
+        logging.error(f"Ошибка при удалении фрагментов из каталога: {e}")
+
+
+def get_snapshot_files(conn: sqlite3.Connection,
+                       snapshot_id: Optional[int] = None) -> Iterator[Tuple[str, str, str, int]]:
+    """
+    Перебирает файлы снимков по манифестам, не загружая их в память.
+
+    :param conn: Объект соединения с базой данных
+    :param snapshot_id: Идентификатор снимка или None - все снимки
+    :return: Итератор (директория снимка, путь относительно снимка, хеш, размер)
+    """
+    try:
+        c = conn.cursor()
+        if snapshot_id is None:
+            c.execute('''
+                SELECT s.path, m.rel_path, m.hash, m.size FROM manifest m JOIN snapshots s ON s.id = m.snapshot_id
+            ''')
+        else:
+            c.execute('''
+                SELECT s.path, m.rel_path, m.hash, m.size FROM manifest m JOIN snapshots s ON s.id = m.snapshot_id
+                WHERE m.snapshot_id = ?
+            ''', (snapshot_id,))
+        yield from c
+    except Exception as e:
+        logging.error(f"Ошибка при получении файлов снимков: {e}")
+
+
+def get_scrub_chunks(conn: sqlite3.Connection, snapshot_id: Optional[int] = None) -> Iterator[Tuple[str, int]]:
+    """
+    Перебирает фрагменты хранилища для проверки.
+
+    :param conn: Объект соединения с базой данных
+    :param snapshot_id: Идентификатор снимка (только его фрагменты) или None - все фрагменты
+    :return: Итератор (хеш фрагмента, размер)
+    """
+    try:
+        c = conn.cursor()
+        if snapshot_id is None:
+            c.execute("SELECT hash, size FROM chunks")
+        else:
+            c.execute('''
+                SELECT DISTINCT c.hash, c.size FROM manifest m
+                JOIN file_chunks fc ON fc.file_hash = m.hash
+                JOIN chunks c ON c.hash = fc.chunk_hash
+                WHERE m.snapshot_id = ?
+            ''', (snapshot_id,))
+        yield from c
+    except Exception as e:
+        logging.error(f"Ошибка при получении фрагментов для проверки: {e}")
+
+
+def get_scrub_pack_objects(conn: sqlite3.Connection,
+                           snapshot_id: Optional[int] = None) -> Iterator[Tuple[str, int, int, int, int, str]]:
+    """
+    Перебирает упакованное содержимое для проверки.
+
+    :param conn: Объект соединения с базой данных
+    :param snapshot_id: Идентификатор снимка (только его содержимое) или None - все записи
+    :return: Итератор (хеш, номер пак-файла, смещение, длина, размер, способ сжатия)
+    """
+    try:
+        c = conn.cursor()
+        if snapshot_id is None:
+            c.execute("SELECT hash, pack, offset, length, size, codec FROM pack_objects ORDER BY pack, offset")
+        else:
+            c.execute('''
+                SELECT hash, pack, offset, length, size, codec FROM pack_objects
+                WHERE hash IN (SELECT hash FROM manifest WHERE snapshot_id = ?)
+                ORDER BY pack, offset
+            ''', (snapshot_id,))
+        yield from c
+    except Exception as e:
+        logging.error(f"Ошибка при получении записей пак-файлов для проверки: {e}")
+
+
+def start_scrub_run(conn: sqlite3.Connection, scope: Optional[str] = None,
+                    resume: bool = True) -> Optional[Tuple[int, float]]:
+    """
+    Начинает проверку целостности или продолжает прерванную.
+
+    :param conn: Объект соединения с базой данных
+    :param scope: Имя проверяемого снимка или None - весь репозиторий
+    :param resume: Продолжить последнюю незавершенную проверку той же области
+    :return: Кортеж (идентификатор проверки, время ее начала) или None в случае ошибки
+    """
+    try:
+        if resume:
+            row = conn.execute('''
+                SELECT id, started FROM scrub_runs WHERE scope IS ? AND finished IS NULL ORDER BY id DESC LIMIT 1
+            ''', (scope,)).fetchone()
+            if row:
+                return row
+        started = time.time()
+        run_id = conn.execute("INSERT INTO scrub_runs (scope, started) VALUES (?, ?)", (scope, started)).lastrowid
+        conn.commit()
+        return run_id, started
+    except Exception as e:
+        logging.error(f"Ошибка при начале проверки: {e}")
+        return None
+
+
+def finish_scrub_run(conn: sqlite3.Connection, run_id: int, stats: Dict[str, int]) -> None:
+    """
+    Отмечает проверку целостности завершенной.
+
+    :param conn: Объект соединения с базой данных
+    :param run_id: Идентификатор проверки
+    :param stats: Итоги проверки
+    """
+    try:
+        conn.execute("UPDATE scrub_runs SET finished=?, stats=? WHERE id=?",
+                     (time.time(), json.dumps(stats), run_id))
+        conn.commit()
+    except Exception as e:
+        logging.error(f"Ошибка при завершении проверки: {e}")
+
+
+def get_verified_keys(conn: sqlite3.Connection, since: float) -> Set[Tuple[str, str]]:
+    """
+    Возвращает объекты, проверенные не раньше указанного времени.
+
+    :param conn: Объект соединения с базой данных
+    :param since: Время (секунды от эпохи)
+    :return: Множество (вид объекта, ключ)
+    """
+    try:
+        return set(conn.execute("SELECT kind, key FROM scrub_results WHERE verified >= ?", (since,)))
+    except Exception as e:
+        logging.error(f"Ошибка при получении результатов проверки: {e}")
+        return set()
+
+
+def save_scrub_results(conn: sqlite3.Connection, results: List[Tuple[str, str, str, str, str, float]]) -> None:
+    """
+    Сохраняет результаты проверки целостности.
+
+    :param conn: Объект соединения с базой данных
+    :param results: Список (вид объекта, ключ, хеш, путь, состояние, время проверки)
+    """
+    try:
+        conn.executemany('''
+            INSERT OR REPLACE INTO scrub_results (kind, key, hash, path, status, verified) VALUES (?, ?, ?, ?, ?, ?)
+        ''', results)
+        conn.commit()
+    except Exception as e:
+        logging.error(f"Ошибка при сохранении результатов проверки: {e}")
+
+
+def get_scrub_problems(conn: sqlite3.Connection) -> List[Tuple[str, str, str, str, str, float]]:
+    """
+    Возвращает объекты, не прошедшие последнюю проверку.
+
+    :param conn: Объект соединения с базой данных
+    :return: Список (вид объекта, ключ, хеш, путь, состояние, время проверки)
+    """
+    try:
+        c = conn.cursor()
+        c.execute('''
+            SELECT kind, key, hash, path, status, verified FROM scrub_results WHERE status != 'ok' ORDER BY verified
+        ''')
+        return c.fetchall()
+    except Exception as e:
+        logging.error(f"Ошибка при получении результатов проверки: {e}")
+        return []
+
+
+def add_set_source(conn: sqlite3.Connection, name: str, source: str) -> None:
+    """
+    Добавляет источник в набор резервного копирования (набор создается с первым источником).
+
+    :param conn: Объект соединения с базой данных
+    :param name: Имя набора
+    :param source: Исходный путь
+    """
+    try:
+        conn.execute("INSERT OR IGNORE INTO backup_sets (name, source) VALUES (?, ?)", (name, source))
+        conn.commit()
+        logging.info(f"Источник {source} добавлен в набор {name}")
+    except Exception as e:
+        logging.error(f"Ошибка при добавлении источника в набор {name}: {e}")
+
+
+def remove_set_source(conn: sqlite3.Connection, name: str, source: Optional[str] = None) -> None:
+    """
+    Удаляет источник из набора резервного копирования. Снимки набора остаются в каталоге.
+
+    :param conn: Объект соединения с базой данных
+    :param name: Имя набора
+    :param source: Исходный путь или None - удалить весь набор
+    """
+    try:
+        if source is None:
+            conn.execute("DELETE FROM backup_sets WHERE name=?", (name,))
+        else:
+            conn.execute("DELETE FROM backup_sets WHERE name=? AND source=?", (name, source))
+        conn.commit()
+        logging.info(f"Из набора {name} удален {'источник ' + source if source else 'весь набор'}")
+    except Exception as e:
+        logging.error(f"Ошибка при удалении из набора {name}: {e}")
+
+
+def get_backup_sets(conn: sqlite3.Connection) -> Dict[str, List[str]]:
+    """
+    Возвращает наборы резервного копирования.
+
+    :param conn: Объект соединения с базой данных
+    :return: Словарь {имя набора: список источников}
+    """
+    try:
+        sets: Dict[str, List[str]] = {}
+        for name, source in conn.execute("SELECT name, source FROM backup_sets ORDER BY name, source"):
+            sets.setdefault(name, []).append(source)
+        return sets
+    except Exception as e:
+        logging.error(f"Ошибка при получении наборов резервного копирования: {e}")
+        return {}
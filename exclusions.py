@@ -0,0 +1,136 @@
+import fnmatch
+import logging
+import os
+import re
+from typing import Iterable, Optional, Tuple
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+# Виды правил исключения (колонка kind таблицы excluded_directories)
+EXCLUDE_PATH = 'path'
+EXCLUDE_GLOB = 'glob'
+EXCLUDE_REGEX = 'regex'
+EXCLUDE_KINDS = (EXCLUDE_PATH, EXCLUDE_GLOB, EXCLUDE_REGEX)
+
+# Ключ узла дерева, отмечающий исключенный путь (компоненты пути - всегда строки)
+_EXCLUDED = None
+
+
+def _components(path: str) -> list:
+    """ Разбивает абсолютный путь на компоненты с учетом регистра файловой системы. """
+    path = os.path.normcase(os.path.abspath(path))
+    drive, rest = os.path.splitdrive(path)
+    return [drive] + [part for part in rest.split(os.sep) if part]
+
+
+def _posix(path: str) -> str:
+    """ Приводит путь к виду с прямыми слешами для сопоставления с шаблонами. """
+    return os.path.normcase(os.path.abspath(path)).replace(os.sep, '/')
+
+
+class ExclusionRules:
+    """
+    Скомпилированные правила исключения для одного запуска.
+
+    Пути хранятся в дереве по компонентам: исключение /data/a не задевает /data/ab,
+    а проверка при обходе стоит O(1) на запись, потому что обходчик спускается по дереву
+    вместе с директориями. Шаблоны glob без слеша сравниваются с именем записи, со слешем -
+    с полным путем; регулярные выражения ищутся в полном пути. Все шаблоны одного вида
+    объединяются в одно регулярное выражение.
+    """
+
+    def __init__(self, rules: Iterable[Tuple[str, str]] = ()):
+        """
+        :param rules: Пары (шаблон или путь, вид правила из EXCLUDE_KINDS)
+        """
+        self.trie = {}
+        name_globs, path_patterns = [], []
+        for pattern, kind in rules:
+            if kind == EXCLUDE_PATH:
+                node = self.trie
+                for part in _components(pattern):
+                    node = node.setdefault(part, {})
+                node[_EXCLUDED] = {}
+            elif kind == EXCLUDE_GLOB:
+                pattern = os.path.normcase(pattern).replace(os.sep, '/')
+                if '/' in pattern:
+                    path_patterns.append(r'\A' + fnmatch.translate(pattern))
+                else:
+                    name_globs.append(fnmatch.translate(pattern))
+            elif kind == EXCLUDE_REGEX:
+                try:
+                    re.compile(pattern)
+                    path_patterns.append(f"(?:{pattern})")
+                except re.error as e:
+                    logging.error(f"Некорректное регулярное выражение исключения {pattern}: {e}")
+            else:
+                logging.warning(f"Неизвестный вид правила исключения {kind}: {pattern}")
+        self.name_re = re.compile('|'.join(name_globs)) if name_globs else None
+        # Шаблоны glob привязаны к началу и концу пути, регулярные выражения ищутся в любом месте
+        self.path_re = re.compile('|'.join(path_patterns)) if path_patterns else None
+
+    def resolve(self, path: str) -> Tuple[Optional[dict], bool]:
+        """
+        Находит узел дерева для начального пути обхода.
+
+        :param path: Путь
+        :return: Кортеж (узел дерева или None, исключен ли путь)
+        """
+        node = self.trie
+        for part in _components(path):
+            node = node.get(part)
+            if node is None:
+                break
+            if _EXCLUDED in node:
+                return None, True
+        return node, self.matches_pattern(path, os.path.basename(path))
+
+    def descend(self, node: Optional[dict], path: str, name: str) -> Tuple[Optional[dict], bool]:
+        """
+        Спускается из узла родителя к дочерней записи.
+
+        :param node: Узел дерева родительской директории или None
+        :param path: Полный путь дочерней записи
+        :param name: Имя дочерней записи
+        :return: Кортеж (узел дерева или None, исключена ли запись)
+        """
+        if node is not None:
+            node = node.get(os.path.normcase(name))
+            if node is not None and _EXCLUDED in node:
+                return None, True
+        return node, self.matches_pattern(path, name)
+
+    def matches_pattern(self, path: str, name: str) -> bool:
+        """
+        Проверяет запись по шаблонам glob и регулярным выражениям.
+
+        :param path: Полный путь записи
+        :param name: Имя записи
+        :return: True, если запись исключена шаблоном
+        """
+        if self.name_re is not None and self.name_re.match(os.path.normcase(name)):
+            return True
+        return self.path_re is not None and self.path_re.search(_posix(path)) is not None
+
+    def is_excluded(self, path: str) -> bool:
+        """
+        Проверяет произвольный путь целиком, без обхода.
+
+        :param path: Путь
+        :return: True, если путь или одна из его родительских директорий исключены
+        """
+        node = self.trie
+        for part in _components(path):
+            node = node.get(part)
+            if node is None:
+                break
+            if _EXCLUDED in node:
+                return True
+        path = os.path.abspath(path)
+        while True:
+            if self.matches_pattern(path, os.path.basename(path)):
+                return True
+            parent = os.path.dirname(path)
+            if parent == path:
+                return False
+            path = parent
@@ -1,12 +1,166 @@
+import errno
 import hashlib
 import os
+import shutil
 import logging
-from typing import Optional
+import threading
+import time
+from typing import Any, Dict, Optional, Sequence, Tuple
+
+try:
+    import blake3
+except ImportError:  # blake3 - необязательная зависимость
+    blake3 = None
+
+try:
+    import fcntl
+except ImportError:  # на Windows доступно только буферизованное копирование
+    fcntl = None
+
+from metrics import METRICS
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
+# Алгоритм хеширования по умолчанию: с ним созданы все существующие каталоги
+DEFAULT_HASH_ALGORITHM = 'sha256'
+# Алгоритмы, которые можно выбрать для репозитория
+HASH_ALGORITHMS = ('sha256', 'blake2b', 'blake3')
+# Размер буфера чтения при хешировании
+HASH_BUFFER_SIZE = 1024 * 1024
+# Размер каждого из образцов (начало, середина, конец) для быстрого сравнения больших файлов
+SAMPLE_BLOCK_SIZE = 1024 * 1024
+# Размер блока при копировании с одновременным хешированием
+COPY_BLOCK_SIZE = 1024 * 1024
+
+# Способы копирования, от самого дешевого к самому дорогому
+COPY_REFLINK = 'reflink'
+COPY_FILE_RANGE = 'copy_file_range'
+COPY_SENDFILE = 'sendfile'
+COPY_BUFFERED = 'buffered'
+COPY_STRATEGIES = (COPY_REFLINK, COPY_FILE_RANGE, COPY_SENDFILE, COPY_BUFFERED)
+# ioctl FICLONE из linux/fs.h: клонирование экстентов файла (Btrfs, XFS)
+FICLONE = 0x40049409
+# Ошибки, означающие, что способ копирования не поддерживается для этой пары файловых систем.
+# EPERM и EBADF сюда не входят: это ошибки отдельного файла (неизменяемый файл, O_APPEND),
+# и из-за них нельзя отказываться от способа для всей пары устройств
+UNSUPPORTED_COPY_ERRORS = {errno.EXDEV, errno.EINVAL, errno.ENOSYS, errno.EOPNOTSUPP, errno.ENOTTY}
+
+# Первый рабочий способ копирования для пары (устройство источника, устройство назначения)
+_copy_strategy_index: Dict[Tuple[int, int], int] = {}
+_copy_strategy_lock = threading.Lock()
 
-def calculate_sha256(file_path: str, block_size: int = 4096) -> Optional[str]:
+
+class RateLimiter:
+    """
+    Ограничение скорости по принципу маркерной корзины.
+
+    consume списывает единицы (байты, файлы) из корзины, которая пополняется со скоростью
+    rate в секунду; если корзина ушла в минус, вызывающий поток спит, пока долг не
+    погасится. Одна корзина может быть общей для нескольких потоков.
+    """
+
+    def __init__(self, rate: float, burst: Optional[float] = None):
+        """
+        :param rate: Единиц в секунду (0 - без ограничения)
+        :param burst: Емкость корзины - сколько можно потратить разом после простоя (по умолчанию rate)
+        """
+        self.rate = rate
+        self.capacity = burst or rate
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def consume(self, amount: float) -> None:
+        """
+        Списывает единицы и при необходимости ждет.
+
+        :param amount: Количество единиц
+        """
+        if self.rate <= 0:
+            return
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= amount
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0.0
+        if wait > 0:
+            time.sleep(wait)
+
+    def set_rate(self, rate: float, burst: Optional[float] = None) -> None:
+        """
+        Меняет скорость на ходу; накопленный запас не превышает новой емкости.
+
+        :param rate: Единиц в секунду (0 - без ограничения)
+        :param burst: Емкость корзины (по умолчанию rate)
+        """
+        with self.lock:
+            self.rate = rate
+            self.capacity = burst or rate
+            self.tokens = min(self.tokens, self.capacity)
+            self.updated = time.monotonic()
+
+
+def new_hasher(algorithm: str = DEFAULT_HASH_ALGORITHM) -> Any:
+    """
+    Создает объект хеширования для выбранного алгоритма.
+
+    :param algorithm: Название алгоритма из HASH_ALGORITHMS
+    :return: Объект с методами update() и hexdigest()
+    """
+    if algorithm == 'blake3':
+        if blake3 is None:
+            raise ValueError("Алгоритм blake3 недоступен: установите пакет blake3")
+        return blake3.blake3()
+    if algorithm not in HASH_ALGORITHMS:
+        raise ValueError(f"Неизвестный алгоритм хеширования: {algorithm}")
+    return hashlib.new(algorithm)
+
+
+def available_hash_algorithms() -> tuple:
+    """
+    Возвращает алгоритмы хеширования, доступные в текущем окружении.
+
+    :return: Кортеж названий алгоритмов
+    """
+    return tuple(a for a in HASH_ALGORITHMS if a != 'blake3' or blake3 is not None)
+
+
+def calculate_hash(file_path: str, algorithm: str = DEFAULT_HASH_ALGORITHM,
+                   buffer_size: int = HASH_BUFFER_SIZE, limiter: Optional[RateLimiter] = None) -> Optional[str]:
+    """
+    Вычисляет хеш файла, читая его через readinto в один переиспользуемый буфер.
+
+    :param file_path: Путь к файлу
+    :param algorithm: Название алгоритма из HASH_ALGORITHMS
+    :param buffer_size: Размер буфера чтения
+    :param limiter: Ограничение скорости чтения в байтах в секунду или None
+    :return: Хеш файла или None в случае ошибки
+    """
+    try:
+        started = time.perf_counter()
+        hasher = new_hasher(algorithm)
+        buf = bytearray(buffer_size)
+        view = memoryview(buf)
+        total = 0
+        with open(file_path, "rb", buffering=0) as f:
+            while True:
+                n = f.readinto(buf)
+                if not n:
+                    break
+                hasher.update(view[:n])
+                total += n
+                if limiter is not None:
+                    limiter.consume(n)
+        METRICS.add('bytes_hashed', total)
+        METRICS.observe('hash', time.perf_counter() - started)
+        return hasher.hexdigest()
+    except Exception as e:
+        logging.error(f"Ошибка при вычислении хеша {algorithm} для файла {file_path}: {e}")
+        return None
+
+
+def calculate_sha256(file_path: str, block_size: int = HASH_BUFFER_SIZE) -> Optional[str]:
     """
     Вычисляет SHA-256 хеш файла.
 
@@ -14,28 +168,196 @@ def calculate_sha256(file_path: str, block_size: int = 4096) -> Optional[str]:
     :param block_size: Размер блока для чтения файла
     :return: Хеш SHA-256 файла или None в случае ошибки
     """
-    hash_sha256 = hashlib.sha256()
+    return calculate_hash(file_path, 'sha256', block_size)
+
+
+def calculate_sample_hash(file_path: str, block_size: int = SAMPLE_BLOCK_SIZE,
+                          algorithm: str = DEFAULT_HASH_ALGORITHM,
+                          limiter: Optional[RateLimiter] = None) -> Optional[str]:
+    """
+    Вычисляет хеш размера файла и трех образцов: начала, середины и конца.
+
+    Совпадение хеша образцов не доказывает совпадение содержимого - это лишь фильтр,
+    после которого имеет смысл считать полный хеш.
+
+    :param file_path: Путь к файлу
+    :param block_size: Размер каждого образца
+    :param algorithm: Название алгоритма из HASH_ALGORITHMS
+    :param limiter: Ограничение скорости чтения в байтах в секунду или None
+    :return: Хеш образцов или None в случае ошибки
+    """
     try:
+        hash_sample = new_hasher(algorithm)
+        size = os.path.getsize(file_path)
+        hash_sample.update(str(size).encode('ascii'))
         with open(file_path, "rb") as f:
-            for chunk in iter(lambda: f.read(block_size), b""):
-                hash_sha256.update(chunk)
-        return hash_sha256.hexdigest()
+            for offset in (0, max(0, size // 2 - block_size // 2), max(0, size - block_size)):
+                f.seek(offset)
+                block = f.read(block_size)
+                hash_sample.update(block)
+                METRICS.add('bytes_hashed', len(block))
+                if limiter is not None:
+                    limiter.consume(len(block))
+        return hash_sample.hexdigest()
     except Exception as e:
-        logging.error(f"Ошибка при вычислении SHA-256 для файла {file_path}: {e}")
+        logging.error(f"Ошибка при вычислении хеша образцов для файла {file_path}: {e}")
         return None
 
 
-def create_hard_link(source: str, link_name: str) -> None:
+def copy_with_hash(source: str, destination: str, block_size: int = COPY_BLOCK_SIZE,
+                   algorithm: str = DEFAULT_HASH_ALGORITHM, limiter: Optional[RateLimiter] = None) -> str:
+    """
+    Копирует файл и вычисляет его хеш за один проход чтения.
+
+    :param source: Исходный файл
+    :param destination: Путь копии
+    :param block_size: Размер блока чтения
+    :param algorithm: Название алгоритма из HASH_ALGORITHMS
+    :param limiter: Ограничение скорости чтения в байтах в секунду или None
+    :return: Хеш скопированного содержимого
+    """
+    hasher = new_hasher(algorithm)
+    buf = bytearray(block_size)
+    view = memoryview(buf)
+    total = 0
+    with open(source, "rb", buffering=0) as fsrc, open(destination, "wb") as fdst:
+        while True:
+            n = fsrc.readinto(buf)
+            if not n:
+                break
+            hasher.update(view[:n])
+            fdst.write(view[:n])
+            total += n
+            if limiter is not None:
+                limiter.consume(n)
+    shutil.copymode(source, destination)
+    METRICS.add('bytes_hashed', total)
+    METRICS.add('bytes_copied', total)
+    return hasher.hexdigest()
+
+
+def _copy_reflink(fsrc, fdst, size: int, limiter: Optional[RateLimiter] = None) -> None:
+    if fcntl is None:
+        raise OSError(errno.ENOSYS, "FICLONE недоступен")
+    fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+
+
+def _copy_file_range(fsrc, fdst, size: int, limiter: Optional[RateLimiter] = None) -> None:
+    if not hasattr(os, 'copy_file_range'):
+        raise OSError(errno.ENOSYS, "copy_file_range недоступен")
+    # С ограничением скорости копируем блоками, чтобы чтение шло равномерно
+    step = COPY_BLOCK_SIZE if limiter is not None else 1 << 30
+    copied = 0
+    while copied < size:
+        n = os.copy_file_range(fsrc.fileno(), fdst.fileno(), min(size - copied, step))
+        if n == 0:
+            break
+        copied += n
+        if limiter is not None:
+            limiter.consume(n)
+
+
+def _copy_sendfile(fsrc, fdst, size: int, limiter: Optional[RateLimiter] = None) -> None:
+    if not hasattr(os, 'sendfile') or os.name == 'nt':
+        raise OSError(errno.ENOSYS, "sendfile недоступен")
+    step = COPY_BLOCK_SIZE if limiter is not None else 1 << 30
+    copied = 0
+    while copied < size:
+        n = os.sendfile(fdst.fileno(), fsrc.fileno(), copied, min(size - copied, step))
+        if n == 0:
+            break
+        copied += n
+        if limiter is not None:
+            limiter.consume(n)
+
+
+def _copy_buffered(fsrc, fdst, size: int, limiter: Optional[RateLimiter] = None) -> None:
+    if limiter is None:
+        shutil.copyfileobj(fsrc, fdst, COPY_BLOCK_SIZE)
+        return
+    while True:
+        data = fsrc.read(COPY_BLOCK_SIZE)
+        if not data:
+            break
+        fdst.write(data)
+        limiter.consume(len(data))
+
+
+_COPY_FUNCTIONS = {
+    COPY_REFLINK: _copy_reflink,
+    COPY_FILE_RANGE: _copy_file_range,
+    COPY_SENDFILE: _copy_sendfile,
+    COPY_BUFFERED: _copy_buffered,
+}
+
+
+def copy_file(source: str, destination: str, strategies: Sequence[str] = COPY_STRATEGIES,
+              limiter: Optional[RateLimiter] = None) -> Optional[str]:
+    """
+    Копирует содержимое и права файла самым дешевым способом, доступным для пары файловых систем.
+
+    Способы перебираются в порядке COPY_STRATEGIES: клонирование экстентов (FICLONE),
+    copy_file_range, sendfile и обычное копирование через буфер. Первый сработавший способ
+    запоминается для пары устройств, и следующие файлы копируются им сразу. Если не
+    сработал ни один способ, недописанная копия удаляется, а последняя ошибка передается
+    вызывающему.
+
+    :param source: Исходный файл
+    :param destination: Путь копии
+    :param strategies: Допустимые способы (например, только COPY_REFLINK)
+    :param limiter: Ограничение скорости в байтах в секунду или None (клонирование экстентов не ограничивается)
+    :return: Использованный способ или None, если ни один из допустимых не подходит
+    """
+    src_dev = os.stat(source).st_dev
+    dst_dev = os.stat(os.path.dirname(os.path.abspath(destination))).st_dev
+    key = (src_dev, dst_dev)
+    with open(source, 'rb') as fsrc, open(destination, 'wb') as fdst:
+        size = os.fstat(fsrc.fileno()).st_size
+        index = _copy_strategy_index.get(key, 0)
+        try:
+            while True:
+                strategy = COPY_STRATEGIES[index]
+                if strategy not in strategies:
+                    return None
+                try:
+                    _COPY_FUNCTIONS[strategy](fsrc, fdst, size, limiter)
+                    break
+                except OSError as e:
+                    # После буферного копирования пробовать нечего: запоминаемый способ не уходит за него
+                    if e.errno not in UNSUPPORTED_COPY_ERRORS or strategy == COPY_BUFFERED:
+                        raise
+                    fsrc.seek(0)
+                    fdst.seek(0)
+                    fdst.truncate()
+                    index += 1
+                    with _copy_strategy_lock:
+                        if _copy_strategy_index.get(key, 0) < index:
+                            _copy_strategy_index[key] = index
+                    logging.info(f"Способ копирования {strategy} недоступен для {destination}: {e}")
+        except OSError:
+            fdst.close()
+            os.unlink(destination)
+            raise
+    shutil.copymode(source, destination)
+    # Клонированные экстенты не читаются и не записываются: их объем учитывается отдельно
+    METRICS.add('bytes_cloned' if strategy == COPY_REFLINK else 'bytes_copied', size)
+    return strategy
+
+
+def create_hard_link(source: str, link_name: str) -> bool:
     """
     Создает жесткую ссылку.
 
     :param source: Исходный файл
     :param link_name: Имя жесткой ссылки
+    :return: True, если ссылка создана; False, если имя занято или ссылку создать нельзя
+             (другая файловая система, предел количества ссылок на inode)
     """
     try:
         if not os.path.exists(link_name):
             os.link(source, link_name)
-        else:
-            logging.warning(f"Жесткая ссылка уже существует: {link_name}")
+            return True
+        logging.warning(f"Жесткая ссылка уже существует: {link_name}")
     except Exception as e:
-        logging.error(f"Ошибка при создании жесткой ссылки {link_name} из {source}: {e}")
+        logging.warning(f"Не удалось создать жесткую ссылку {link_name} на {source}: {e}")
+    return False
@@ -1,8 +1,11 @@
 import os
+import re
+import queue
 import threading
 import schedule
 import time
 import logging
+from contextlib import closing
 
 import tkinter as tk
 from tkinter import filedialog, messagebox, scrolledtext
@@ -11,24 +14,65 @@ import tkinter.ttk as ttk
 import pystray
 from PIL import Image
 
-from database import create_connection, create_table, add_excluded_directory, get_excluded_directories, \
-    remove_excluded_directory
-from backup_manager import backup_files, restore_backup
+from database import create_connection, create_table, add_excluded_directory, get_exclusion_rules, \
+    remove_excluded_directory, list_snapshots
+from exclusions import EXCLUDE_PATH, EXCLUDE_GLOB, EXCLUDE_REGEX
+from backup_manager import restore_backup
+from jobs import JobManager, JOB_BACKUP
+from watcher import watch_available, watch_backup
+from metrics import LogBuffer, start_async_logging, stop_async_logging
+
+
+# Как часто окно забирает события заданий копирования, в миллисекундах
+JOB_POLL_INTERVAL_MS = 200
+# Как часто окно журнала забирает новые строки, в миллисекундах
+LOG_POLL_INTERVAL_MS = 500
+# Сколько последних строк хранит окно журнала
+LOG_VIEW_MAX_LINES = 2000
 
 
 def scan_backups(backup_dir):
     """
     Сканирует заданную директорию и возвращает список директорий резервных копий.
     """
-    return [d for d in os.listdir(backup_dir) if os.path.isdir(os.path.join(backup_dir, d))]
+    return [d for d in os.listdir(backup_dir)
+            if not d.startswith('.') and os.path.isdir(os.path.join(backup_dir, d))]
+
+
+def list_backups(backup_dir):
+    """
+    Возвращает имена снимков из каталога вместе с директориями резервных копий, созданными
+    до появления таблицы снимков и потому в ней не зарегистрированными.
+    """
+    names = set(scan_backups(backup_dir))
+    db_path = os.path.join(backup_dir, 'backup_db.sqlite')
+    if os.path.exists(db_path):
+        with closing(create_connection(db_path)) as conn:
+            create_table(conn)
+            names.update(snapshot[1] for snapshot in list_snapshots(conn))
+    return sorted(names)
 
 
 def update_backup_options(backup_combobox, backup_dir):
     """
-    Сканирует заданную директорию и обновляет выпадающий список с резервными копиями.
+    Обновляет выпадающий список с резервными копиями.
     """
-    backup_options = [d for d in os.listdir(backup_dir) if os.path.isdir(os.path.join(backup_dir, d))]
-    backup_combobox['values'] = backup_options
+    backup_combobox['values'] = list_backups(backup_dir)
+
+
+def format_job_event(event):
+    """
+    Строка состояния для события задания копирования.
+    """
+    if event['event'] == 'progress':
+        text = (f"Копирование {event['snapshot']}: файлов {event['files']}, "
+                f"{event['bytes'] / 1024 ** 2:.0f} МБ, {event['rate'] / 1024 ** 2:.1f} МБ/с")
+        if event['eta'] is not None:
+            text += f", осталось ~{int(event['eta']) // 60} мин {int(event['eta']) % 60} с"
+        return text
+    titles = {'queued': "в очереди", 'coalesced': "объединено с ожидающим", 'started': "начато",
+              'finished': "завершено", 'cancelled': "отменено", 'failed': "ошибка"}
+    return f"Задание {event['job']} ({event['source']}): {titles.get(event['event'], event['event'])}"
 
 
 def start_schedule():
@@ -37,17 +81,22 @@ def start_schedule():
         time.sleep(1)
 
 
-class TextHandler(logging.Handler):
-    def __init__(self, text):
-        super().__init__()
-        self.text = text
+def flush_log_view(text, log_buffer):
+    """
+    Переносит накопленные строки журнала в окно одной вставкой и обрезает окно до LOG_VIEW_MAX_LINES.
 
-    def emit(self, record):
-        msg = self.format(record)
-        self.text.configure(state='normal')
-        self.text.insert(tk.END, msg + '\n')
-        self.text.configure(state='disabled')
-        self.text.yview(tk.END)
+    Вызывается только из главного потока Tk.
+    """
+    lines = log_buffer.drain()
+    if not lines:
+        return
+    text.configure(state='normal')
+    text.insert(tk.END, '\n'.join(lines) + '\n')
+    excess = int(text.index('end-1c').split('.')[0]) - 1 - LOG_VIEW_MAX_LINES
+    if excess > 0:
+        text.delete('1.0', f'{excess + 1}.0')
+    text.configure(state='disabled')
+    text.yview(tk.END)
 
 
 def setup_gui():
@@ -60,12 +109,20 @@ def setup_gui():
     # Установка иконки
     window.iconbitmap('icon.ico')
 
-    # Настройка логгера
+    # Настройка логгера: записи доставляются отдельным потоком в кольцевой буфер,
+    # а окно журнала забирает их пачкой по таймеру
     log_text = scrolledtext.ScrolledText(window, height=10, state='disabled')
-    text_handler = TextHandler(log_text)
+    log_buffer = LogBuffer()
     logging.basicConfig(filename='backup_log.log', level=logging.INFO,
                         format='%(asctime)s - %(levelname)s - %(message)s')
-    logging.getLogger().addHandler(text_handler)
+    logging.getLogger().addHandler(log_buffer)
+    log_listener = start_async_logging()
+
+    def poll_log():
+        flush_log_view(log_text, log_buffer)
+        window.after(LOG_POLL_INTERVAL_MS, poll_log)
+
+    window.after(LOG_POLL_INTERVAL_MS, poll_log)
 
     def select_source_path():
         path = filedialog.askdirectory()
@@ -91,21 +148,49 @@ def setup_gui():
     interval_entry = tk.Entry(window, width=50)
     interval_entry.grid(row=2, column=1)
 
+    watch_var = tk.BooleanVar(value=False)
+    watch_stop = threading.Event()
+    tk.Checkbutton(window, text="Отслеживать изменения", variable=watch_var).grid(row=2, column=2)
+
+    # Все копирования идут через очередь заданий: окно не блокируется, а запуски в один
+    # пункт назначения не пересекаются. События заданий приходят из рабочих потоков и
+    # разбираются в главном потоке Tk.
+    job_manager = JobManager()
+    job_events = queue.Queue()
+    job_manager.subscribe(job_events.put)
+    status_var = tk.StringVar(value="Нет активных заданий")
+    tray_status = [status_var.get()]
+    tk.Label(window, textvariable=status_var, anchor='w').grid(row=6, column=0, columnspan=4, sticky="ew")
+
+    def poll_job_events():
+        while True:
+            try:
+                event = job_events.get_nowait()
+            except queue.Empty:
+                break
+            status_var.set(format_job_event(event))
+            # Меню значка в трее читает состояние из своего потока, не обращаясь к Tk
+            tray_status[0] = status_var.get()
+        window.after(JOB_POLL_INTERVAL_MS, poll_job_events)
+
+    window.after(JOB_POLL_INTERVAL_MS, poll_job_events)
+    threading.Thread(target=start_schedule, name="capsule-schedule", daemon=True).start()
+
     def create_backup_now():
         try:
             source = source_path_entry.get()
             destination = destination_path_entry.get()
-            db_path = os.path.join(destination, 'backup_db.sqlite')
-
-            with create_connection(db_path) as db_conn:
-                create_table(db_conn)
-                backup_files(source, destination, db_path)
-
+            job_manager.submit(JOB_BACKUP, source, destination)
         except Exception as e:
             logging.error(f'"Ошибка", {str(e)}')
             messagebox.showerror("Ошибка", str(e))
 
+    def cancel_backup():
+        if not job_manager.cancel():
+            status_var.set("Нет активных заданий")
+
     tk.Button(window, text="Создать Копию", command=create_backup_now).grid(row=4, column=1)
+    tk.Button(window, text="Отменить", command=cancel_backup).grid(row=4, column=3)
 
     def set_schedule():
         try:
@@ -114,14 +199,17 @@ def setup_gui():
             interval = int(interval_entry.get())
 
             db_path = os.path.join(destination, 'backup_db.sqlite')
-            with create_connection(db_path) as db_conn:
-                create_table(db_conn)
-                backup_files(source, destination, db_path)
-
-                schedule.every(interval).minutes.do(backup_files, source, destination, db_path)
-
-                schedule_thread = threading.Thread(target=start_schedule)
-                schedule_thread.start()
+            if watch_var.get() and watch_available():
+                # Снимки по изменениям: базовый снимок и обход только измененных путей
+                watch_stop.clear()
+                threading.Thread(target=watch_backup, args=(source, destination, db_path, interval * 60, watch_stop),
+                                 kwargs=dict(manager=job_manager), daemon=True).start()
+                logging.info("Расписание было установлено")
+                return
+            if watch_var.get():
+                logging.warning("Отслеживание изменений недоступно в этой системе, используется полный обход")
+            job_manager.submit(JOB_BACKUP, source, destination, db_file=db_path)
+            schedule.every(interval).minutes.do(job_manager.submit, JOB_BACKUP, source, destination, db_file=db_path)
         except ValueError:
             messagebox.showerror("Ошибка", "Интервал должен быть числом.")
         except Exception as e:
@@ -132,6 +220,7 @@ def setup_gui():
     def delete_schedule():
         logging.info("Расписание было удалено")
         schedule.clear()
+        watch_stop.set()
         messagebox.showinfo("Информация", "Расписание удалено.")
 
     def create_or_delete_schedule():
@@ -161,10 +250,26 @@ def setup_gui():
               command=lambda: update_backup_options(backup_combobox, destination_path_entry.get())).grid(row=3,
                                                                                                          column=0)
 
+    def restore_selected_backup():
+        """ Показывает план восстановления и восстанавливает копию после подтверждения. """
+        try:
+            backup_path = os.path.join(destination_path_entry.get(), backup_var.get())
+            restore_path = source_path_entry.get()
+            plan = restore_backup(backup_path, restore_path, dry_run=True)
+            message = (f"Будет записано файлов: {plan.get('write', 0)} "
+                       f"({plan.get('write_bytes', 0) / 1024 ** 2:.1f} МБ)\n"
+                       f"Будет проверено по хешу: {plan.get('check', 0)} "
+                       f"({plan.get('check_bytes', 0) / 1024 ** 2:.1f} МБ)\n"
+                       f"Будет удалено записей: {plan.get('deleted', 0)}\n"
+                       f"Без изменений: {plan.get('unchanged', 0)}\n\nВосстановить?")
+            if messagebox.askyesno("Восстановление", message):
+                restore_backup(backup_path, restore_path)
+        except Exception as e:
+            logging.error(f'"Ошибка", {str(e)}')
+            messagebox.showerror("Ошибка", str(e))
+
     # Кнопка для восстановления
-    tk.Button(window, text="Восстановить из копии",
-              command=lambda: restore_backup(os.path.join(destination_path_entry.get(), backup_var.get()),
-                                             source_path_entry.get())).grid(row=3, column=2)
+    tk.Button(window, text="Восстановить из копии", command=restore_selected_backup).grid(row=3, column=2)
 
     def manage_excluded_directories():
         """
@@ -182,14 +287,15 @@ def setup_gui():
 
         excluded_listbox = tk.Listbox(excluded_window, width=50, height=10)
         excluded_listbox.pack(pady=10, padx=10)
+        excluded_rules = []
 
         def refresh_excluded_list():
-            """ Обновляет список исключенных директорий в ListBox. """
+            """ Обновляет список исключенных директорий и шаблонов в ListBox. """
             excluded_listbox.delete(0, tk.END)
             with create_connection(db_path) as _conn:
-                dirs = get_excluded_directories(_conn)
-                for _dir in dirs:
-                    excluded_listbox.insert(tk.END, _dir)
+                excluded_rules[:] = get_exclusion_rules(_conn)
+                for pattern, kind in excluded_rules:
+                    excluded_listbox.insert(tk.END, pattern if kind == EXCLUDE_PATH else f"[{kind}] {pattern}")
 
         def add_directory():
             """ Добавляет новую директорию в список исключенных. """
@@ -199,11 +305,27 @@ def setup_gui():
                     add_excluded_directory(_conn, directory)
                     refresh_excluded_list()
 
+        def add_pattern():
+            """ Добавляет шаблон glob или регулярное выражение в список исключенных. """
+            pattern = pattern_entry.get()
+            if not pattern:
+                return
+            if pattern_kind.get() == EXCLUDE_REGEX:
+                try:
+                    re.compile(pattern)
+                except re.error as e:
+                    messagebox.showerror("Ошибка", f"Некорректное регулярное выражение: {e}")
+                    return
+            with create_connection(db_path) as _conn:
+                add_excluded_directory(_conn, pattern, pattern_kind.get())
+                refresh_excluded_list()
+            pattern_entry.delete(0, tk.END)
+
         def remove_directory():
-            """ Удаляет выбранную директорию из списка исключенных. """
+            """ Удаляет выбранную директорию или шаблон из списка исключенных. """
             selection = excluded_listbox.curselection()
             if selection:
-                selected_directory = excluded_listbox.get(selection[0])
+                selected_directory = excluded_rules[selection[0]][0]
                 with create_connection(db_path) as _conn:
                     remove_excluded_directory(_conn, selected_directory)
                     refresh_excluded_list()
@@ -218,6 +340,19 @@ def setup_gui():
         remove_button = tk.Button(button_frame, text="Удалить", command=remove_directory)
         remove_button.pack(side=tk.LEFT, padx=5, pady=5)
 
+        # Шаблоны: glob (*.tmp, node_modules, /data/*/cache) или регулярное выражение по полному пути
+        pattern_frame = tk.Frame(excluded_window)
+        pattern_frame.pack(fill=tk.X, padx=10, pady=(0, 10))
+
+        pattern_entry = tk.Entry(pattern_frame, width=30)
+        pattern_entry.pack(side=tk.LEFT, padx=5)
+
+        pattern_kind = tk.StringVar(value=EXCLUDE_GLOB)
+        ttk.Combobox(pattern_frame, textvariable=pattern_kind, values=(EXCLUDE_GLOB, EXCLUDE_REGEX),
+                     state='readonly', width=6).pack(side=tk.LEFT, padx=5)
+
+        tk.Button(pattern_frame, text="Добавить шаблон", command=add_pattern).pack(side=tk.LEFT, padx=5)
+
         refresh_excluded_list()  # Загружаем список при открытии окна
 
     # Добавление кнопки для управления исключенными директориями в основном окне
@@ -226,6 +361,8 @@ def setup_gui():
     def exit_application(icon):
         icon.stop()
         delete_schedule()
+        job_manager.shutdown()
+        stop_async_logging(log_listener)
         window.destroy()
 
     def on_clicked(icon):
@@ -241,7 +378,9 @@ def setup_gui():
         icon_image = Image.open('icon.ico')
         menu = (
             pystray.MenuItem('Восстановить', on_clicked),
+            pystray.MenuItem(lambda item: tray_status[0], None, enabled=False),
             pystray.MenuItem('Старт Резервной Копии', create_backup_now),
+            pystray.MenuItem('Отменить Копирование', cancel_backup),
             pystray.MenuItem('Выход', exit_application),
         )
         icon = pystray.Icon("name", icon_image, "title", menu)
@@ -0,0 +1,230 @@
+import os
+import itertools
+import logging
+import threading
+from collections import deque
+from contextlib import closing
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+from backup_manager import backup_files, incremental_backup
+from database import create_connection, create_table, get_backup_sets
+
+logging.basicConfig(filename='backup_log.log', level=logging.INFO,
+                    format='%(asctime)s:%(levelname)s:%(message)s')
+
+# Виды заданий
+JOB_BACKUP = 'backup'
+JOB_INCREMENTAL = 'incremental'
+
+
+class Job:
+    """ Задание копирования в очереди пункта назначения. """
+
+    def __init__(self, job_id: int, kind: str, source: str, destination: str, options: Dict,
+                 dirty_paths: Optional[Iterable[str]] = None):
+        """
+        :param job_id: Номер задания
+        :param kind: Вид задания (JOB_BACKUP или JOB_INCREMENTAL)
+        :param source: Исходный путь
+        :param destination: Путь назначения
+        :param options: Параметры backup_files / incremental_backup
+        :param dirty_paths: Измененные пути для инкрементного задания
+        """
+        self.id = job_id
+        self.kind = kind
+        self.source = source
+        self.destination = destination
+        self.options = options
+        self.dirty_paths = set(dirty_paths or ())
+        self.cancel = threading.Event()
+
+
+class JobManager:
+    """
+    Очереди заданий копирования: по одному рабочему потоку на пункт назначения и на набор.
+
+    Задания одного пункта назначения выполняются строго по очереди. Исключение - наборы
+    резервного копирования (см. submit_set): у каждого набора своя очередь, и наборы с
+    общим каталогом копируют одновременно; каталог выдерживает это за счет ожидания
+    блокировки записи (database.DB_BUSY_TIMEOUT) и коротких транзакций
+    (backup_manager.DB_BATCH_SECONDS). Повторный запуск для уже ожидающего задания с тем же
+    источником не ставится в очередь, а объединяется с ним: полное копирование поглощает
+    инкрементное, инкрементные объединяют измененные пути. Отмененное полное копирование
+    продолжается следующим полным заданием того же источника (см. backup_files, resume).
+
+    Подписчики получают события-словари с полем event: queued, coalesced, started, progress,
+    finished, cancelled, failed. События отправляются из рабочих потоков.
+    """
+
+    def __init__(self):
+        self.listeners: List[Callable[[Dict], None]] = []
+        # Подписчики вызываются и под блокировкой: повторный вход из обработчика не должен зависать
+        self.lock = threading.RLock()
+        self.queues: Dict[Tuple[str, Optional[str]], deque] = {}
+        self.running: Dict[Tuple[str, Optional[str]], Job] = {}
+        self.workers: Dict[Tuple[str, Optional[str]], threading.Thread] = {}
+        self.ids = itertools.count(1)
+
+    def subscribe(self, listener: Callable[[Dict], None]) -> None:
+        """ Добавляет получателя событий заданий. """
+        self.listeners.append(listener)
+
+    def publish(self, event: str, job: Job, **fields) -> None:
+        """ Отправляет событие задания всем подписчикам. """
+        message = dict(event=event, job=job.id, kind=job.kind, source=job.source, destination=job.destination,
+                       **fields)
+        for listener in list(self.listeners):
+            try:
+                listener(message)
+            except Exception as e:
+                logging.error(f"Ошибка в обработчике событий заданий: {e}")
+
+    def submit(self, kind: str, source: str, destination: str, dirty_paths: Optional[Iterable[str]] = None,
+               **options) -> int:
+        """
+        Ставит задание в очередь пункта назначения или объединяет его с ожидающим.
+
+        :param kind: Вид задания (JOB_BACKUP или JOB_INCREMENTAL)
+        :param source: Исходный путь
+        :param destination: Путь назначения
+        :param dirty_paths: Измененные пути для инкрементного задания
+        :param options: Параметры копирования (db_file, paranoid, backend, hash_workers, backup_set, progress и т. д.)
+        :return: Номер задания, в которое попал запуск
+        """
+        destination = os.path.abspath(destination)
+        with self.lock:
+            key = (destination, options.get('backup_set'))
+            queue = self.queues.setdefault(key, deque())
+            for job in queue:
+                if job.source != source or job.options != options:
+                    continue
+                if job.kind == JOB_INCREMENTAL:
+                    if kind == JOB_BACKUP:
+                        job.kind = JOB_BACKUP
+                        job.dirty_paths.clear()
+                    else:
+                        job.dirty_paths.update(dirty_paths or ())
+                self.publish('coalesced', job)
+                return job.id
+            job = Job(next(self.ids), kind, source, destination, options, dirty_paths)
+            queue.append(job)
+            self.publish('queued', job, position=len(queue))
+            if key not in self.workers:
+                worker = threading.Thread(target=self.work, args=(key,), name="capsule-job", daemon=True)
+                self.workers[key] = worker
+                worker.start()
+        return job.id
+
+    def submit_set(self, name: str, destination: str, db_file: Optional[str] = None, **options) -> List[int]:
+        """
+        Ставит в очередь набора полное копирование каждого его источника.
+
+        Источники набора копируются по очереди, разные наборы - одновременно. Все они пишут
+        в один каталог и одно хранилище, поэтому одинаковые файлы разных источников
+        сохраняются один раз.
+
+        :param name: Имя набора в каталоге (см. database.add_set_source)
+        :param destination: Путь назначения
+        :param db_file: Путь к файлу общего каталога (по умолчанию - в пункте назначения)
+        :param options: Параметры копирования
+        :return: Номера заданий; пустой список, если в наборе нет источников
+        """
+        db_file = db_file or os.path.join(destination, 'backup_db.sqlite')
+        with closing(create_connection(db_file)) as conn:
+            create_table(conn)
+            sources = get_backup_sets(conn).get(name, [])
+        if not sources:
+            logging.error(f"Набор {name} не найден в каталоге {db_file} или в нем нет источников")
+        return [self.submit(JOB_BACKUP, source, destination, db_file=db_file, backup_set=name, **options)
+                for source in sources]
+
+    def cancel(self, destination: Optional[str] = None, job_id: Optional[int] = None) -> int:
+        """
+        Отменяет задания: выполняемое прерывается, ожидающие убираются из очереди.
+
+        :param destination: Пункт назначения или None - все
+        :param job_id: Номер задания или None - все задания пункта назначения
+        :return: Количество отмененных заданий
+        """
+        cancelled = 0
+        with self.lock:
+            for key, queue in self.queues.items():
+                if destination is not None and key[0] != os.path.abspath(destination):
+                    continue
+                for job in [job for job in queue if job_id is None or job.id == job_id]:
+                    queue.remove(job)
+                    self.publish('cancelled', job)
+                    cancelled += 1
+                running = self.running.get(key)
+                if running is not None and (job_id is None or running.id == job_id):
+                    running.cancel.set()
+                    cancelled += 1
+        return cancelled
+
+    def busy(self, destination: Optional[str] = None) -> bool:
+        """ Проверяет, есть ли выполняемые или ожидающие задания. """
+        with self.lock:
+            if destination is not None:
+                destination = os.path.abspath(destination)
+                return (any(key[0] == destination for key in self.running)
+                        or any(queue for key, queue in self.queues.items() if key[0] == destination))
+            return bool(self.running) or any(self.queues.values())
+
+    def wait(self) -> None:
+        """ Ждет завершения всех заданий. """
+        while True:
+            with self.lock:
+                workers = list(self.workers.values())
+            if not workers:
+                return
+            for worker in workers:
+                worker.join()
+
+    def shutdown(self) -> None:
+        """ Отменяет все задания и ждет остановки рабочих потоков. """
+        self.cancel()
+        self.wait()
+
+    def work(self, key: Tuple[str, Optional[str]]) -> None:
+        """ Рабочий поток очереди: выполняет задания, пока очередь не опустеет. """
+        while True:
+            with self.lock:
+                queue = self.queues.get(key)
+                if not queue:
+                    self.workers.pop(key, None)
+                    self.running.pop(key, None)
+                    return
+                job = queue.popleft()
+                self.running[key] = job
+            self.run(job)
+            with self.lock:
+                self.running.pop(key, None)
+
+    def run(self, job: Job) -> None:
+        """ Выполняет одно задание и публикует его события. """
+        self.publish('started', job)
+        options = dict(job.options)
+        db_file = options.pop('db_file', None) or os.path.join(job.destination, 'backup_db.sqlite')
+        # Получатель хода копирования из параметров задания вызывается вместе с подписчиками
+        callback = options.pop('progress', None)
+
+        def on_progress(fields):
+            self.publish('progress', job, **fields)
+            if callback is not None:
+                callback(fields)
+
+        try:
+            os.makedirs(job.destination, exist_ok=True)
+            if job.kind == JOB_INCREMENTAL:
+                options.pop('hash_workers', None)
+                options.pop('copy_workers', None)
+                stats = incremental_backup(job.source, job.destination, db_file, sorted(job.dirty_paths),
+                                           progress=on_progress, cancel=job.cancel, **options)
+            else:
+                stats = backup_files(job.source, job.destination, db_file, progress=on_progress,
+                                     cancel=job.cancel, resume=True, **options)
+        except Exception as e:
+            logging.error(f"Ошибка задания {job.id}: {e}")
+            self.publish('failed', job, message=str(e))
+            return
+        self.publish('cancelled' if job.cancel.is_set() else 'finished', job, stats=stats)
@@ -1,7 +1,12 @@
-from gui import setup_gui
+import sys
 
 
 def main():
+    # С аргументами запускается командная строка (см. cli.py), без них - графический интерфейс
+    if len(sys.argv) > 1:
+        from cli import main as cli_main
+        sys.exit(cli_main(sys.argv[1:]))
+    from gui import setup_gui
     setup_gui()
 
 
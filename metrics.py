@@ -0,0 +1,225 @@
+import json
+import time
+import queue
+import bisect
+import logging
+import logging.handlers
+import threading
+from collections import deque
+from contextlib import contextmanager
+from typing import Dict, Iterator, List, Optional
+
+# Верхние границы корзин гистограмм задержек, в секундах: степени двойки от ~30 мкс до ~17 мин
+LATENCY_BUCKETS = tuple(2.0 ** power for power in range(-15, 11))
+# Сколько строк журнала хранит кольцевой буфер окна журнала
+LOG_BUFFER_LINES = 1000
+
+
+class Histogram:
+    """ Распределение значений по корзинам LATENCY_BUCKETS: количество, сумма и максимум. """
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        # Последняя корзина - значения больше последней границы
+        self.buckets = [0] * (len(LATENCY_BUCKETS) + 1)
+
+    def observe(self, value: float) -> None:
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+        self.buckets[bisect.bisect_left(LATENCY_BUCKETS, value)] += 1
+
+    def as_dict(self) -> Dict:
+        return dict(count=self.count, total=self.total, max=self.max, buckets=list(self.buckets))
+
+
+class Metrics:
+    """
+    Счетчики и гистограммы задержек горячего пути копирования.
+
+    Запись - это прибавление к числу под блокировкой, без форматирования и ввода-вывода,
+    поэтому ее можно делать для каждого файла. Счетчики общие для процесса: отчет одного
+    запуска строится как разность двух снимков (см. diff_metrics), и при одновременных
+    запусках в разные пункты назначения в него попадает и работа соседних запусков.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters: Dict[str, int] = {}
+        self.histograms: Dict[str, Histogram] = {}
+
+    def add(self, name: str, value: int = 1) -> None:
+        """
+        Увеличивает счетчик.
+
+        :param name: Имя счетчика, например bytes_hashed
+        :param value: Прибавляемое значение
+        """
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def observe(self, name: str, seconds: float) -> None:
+        """
+        Добавляет измерение длительности в гистограмму.
+
+        :param name: Имя гистограммы, например db.record
+        :param seconds: Длительность в секундах
+        """
+        with self.lock:
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                histogram = self.histograms[name] = Histogram()
+            histogram.observe(seconds)
+
+    @contextmanager
+    def timer(self, name: str) -> Iterator[None]:
+        """ Измеряет длительность блока with и добавляет ее в гистограмму name. """
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - started)
+
+    def snapshot(self) -> Dict:
+        """
+        Возвращает копию текущих значений.
+
+        :return: Словарь {'counters': {имя: значение}, 'histograms': {имя: Histogram.as_dict()}}
+        """
+        with self.lock:
+            return dict(counters=dict(self.counters),
+                        histograms={name: histogram.as_dict() for name, histogram in self.histograms.items()})
+
+    def reset(self) -> None:
+        """ Обнуляет все счетчики и гистограммы. """
+        with self.lock:
+            self.counters.clear()
+            self.histograms.clear()
+
+
+# Метрики процесса: их пополняют file_utils и backup_manager
+METRICS = Metrics()
+
+
+def diff_metrics(before: Dict, after: Dict) -> Dict:
+    """
+    Вычисляет изменение метрик между двумя снимками Metrics.snapshot.
+
+    Максимум гистограммы не вычитается: берется значение из второго снимка.
+
+    :param before: Снимок в начале запуска
+    :param after: Снимок в конце запуска
+    :return: Словарь того же вида с приращениями; в гистограммах добавлено среднее mean
+    """
+    counters = {name: value - before['counters'].get(name, 0) for name, value in after['counters'].items()}
+    histograms = {}
+    for name, histogram in after['histograms'].items():
+        previous = before['histograms'].get(name)
+        count, total, buckets = histogram['count'], histogram['total'], histogram['buckets']
+        if previous is not None:
+            count -= previous['count']
+            total -= previous['total']
+            buckets = [n - m for n, m in zip(buckets, previous['buckets'])]
+        if count:
+            histograms[name] = dict(count=count, total=total, mean=total / count, max=histogram['max'],
+                                    buckets=buckets)
+    return dict(counters={name: value for name, value in counters.items() if value}, histograms=histograms)
+
+
+def write_report(report_file: str, report: Dict) -> bool:
+    """
+    Сохраняет отчет запуска в файл JSON.
+
+    :param report_file: Путь к файлу отчета
+    :param report: Данные отчета
+    :return: True, если отчет записан
+    """
+    try:
+        with open(report_file, 'w', encoding='utf-8') as f:
+            json.dump(dict(report, buckets=LATENCY_BUCKETS), f, ensure_ascii=False, indent=2)
+        return True
+    except Exception as e:
+        logging.error(f"Ошибка при записи отчета {report_file}: {e}")
+        return False
+
+
+def start_async_logging() -> Optional[logging.handlers.QueueListener]:
+    """
+    Переводит корневой журнал на асинхронную доставку.
+
+    Обработчики корневого журнала (файл, консоль, окно журнала) переносятся в поток
+    QueueListener, а потоки копирования только кладут запись в очередь и не ждут записи
+    в файл или окно. Обработчики, нужные приложению, добавляются до вызова. Повторный
+    вызов ничего не меняет.
+
+    :return: Запущенный поток доставки (см. stop_async_logging) или None, если он уже запущен
+    """
+    root = logging.getLogger()
+    if any(isinstance(handler, logging.handlers.QueueHandler) for handler in root.handlers):
+        return None
+    handlers = list(root.handlers)
+    records = queue.SimpleQueue()
+    listener = logging.handlers.QueueListener(records, *handlers, respect_handler_level=True)
+    for handler in handlers:
+        root.removeHandler(handler)
+    root.addHandler(logging.handlers.QueueHandler(records))
+    listener.start()
+    return listener
+
+
+def stop_async_logging(listener: Optional[logging.handlers.QueueListener]) -> None:
+    """
+    Доставляет оставшиеся записи и возвращает обработчики корневому журналу.
+
+    :param listener: Поток доставки из start_async_logging или None
+    """
+    if listener is None:
+        return
+    listener.stop()
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        if isinstance(handler, logging.handlers.QueueHandler) and handler.queue is listener.queue:
+            root.removeHandler(handler)
+    for handler in listener.handlers:
+        root.addHandler(handler)
+
+
+class LogBuffer(logging.Handler):
+    """
+    Кольцевой буфер последних строк журнала для окна журнала.
+
+    emit только добавляет строку в deque ограниченной длины и может вызываться из любого
+    потока; окно само забирает накопленные строки пачкой по таймеру (см. drain). Если за
+    период опроса пришло больше LOG_BUFFER_LINES строк, старые вытесняются и учитываются
+    в счетчике dropped.
+    """
+
+    def __init__(self, capacity: int = LOG_BUFFER_LINES):
+        super().__init__()
+        self.lines = deque(maxlen=capacity)
+        self.dropped = 0
+
+    def emit(self, record):
+        try:
+            if len(self.lines) == self.lines.maxlen:
+                self.dropped += 1
+            self.lines.append(self.format(record))
+        except Exception:
+            self.handleError(record)
+
+    def drain(self) -> List[str]:
+        """
+        Забирает накопленные строки.
+
+        :return: Строки в порядке поступления; если часть вытеснена, первой идет строка о пропуске
+        """
+        lines = []
+        while self.lines:
+            lines.append(self.lines.popleft())
+        if self.dropped:
+            lines.insert(0, f"... пропущено строк журнала: {self.dropped}")
+            self.dropped = 0
+        return lines
@@ -0,0 +1,270 @@
+import os
+import re
+import mmap
+import lzma
+import zlib
+import threading
+from typing import BinaryIO, Callable, Dict, NamedTuple, Optional, Tuple
+
+try:
+    import fcntl
+except ImportError:  # блокировка пак-файлов есть только в POSIX
+    fcntl = None
+
+# Имя директории пак-файлов внутри пункта назначения
+PACK_DIR_NAME = '.packs'
+# Файлы меньше этого размера упаковываются; большие сохраняются в снимке как обычно
+PACK_FILE_THRESHOLD = 256 * 1024
+# После этого размера пак-файл закрывается и начинается следующий
+PACK_MAX_SIZE = 256 * 1024 * 1024
+# Способы сжатия содержимого; если сжатие не уменьшает размер, данные хранятся как есть
+PACK_CODEC_NONE = 'none'
+PACK_CODEC_ZLIB = 'zlib'
+PACK_CODEC_LZMA = 'lzma'
+PACK_CODECS = (PACK_CODEC_ZLIB, PACK_CODEC_LZMA)
+ZLIB_LEVEL = 6
+LZMA_PRESET = 6
+# Заголовок в начале каждого пак-файла
+PACK_MAGIC = b'CAPSULE-PACK 1\n'
+PACK_NAME_RE = re.compile(r'(\d{8})\.pack')
+# По сколько байт сжатого содержимого распаковывается при потоковом чтении
+STREAM_BLOCK_SIZE = 64 * 1024
+
+
+class PackEntry(NamedTuple):
+    """ Положение сжатого содержимого в пак-файле (строка таблицы pack_objects). """
+    pack: int
+    offset: int
+    length: int
+    size: int
+    codec: str
+
+
+def pack_path(pack_root: str, pack: int) -> str:
+    """
+    Возвращает путь к пак-файлу.
+
+    :param pack_root: Директория пак-файлов
+    :param pack: Номер пак-файла
+    :return: Путь к пак-файлу
+    """
+    return os.path.join(pack_root, f"{pack:08d}.pack")
+
+
+def compress(data: bytes, codec: str = PACK_CODEC_ZLIB) -> Tuple[str, bytes]:
+    """
+    Сжимает содержимое файла.
+
+    :param data: Содержимое
+    :param codec: Способ сжатия из PACK_CODECS
+    :return: Кортеж (фактический способ сжатия, сжатые данные)
+    """
+    if codec == PACK_CODEC_ZLIB:
+        payload = zlib.compress(data, ZLIB_LEVEL)
+    elif codec == PACK_CODEC_LZMA:
+        payload = lzma.compress(data, preset=LZMA_PRESET)
+    else:
+        raise ValueError(f"Неизвестный способ сжатия: {codec}")
+    if len(payload) >= len(data):
+        return PACK_CODEC_NONE, data
+    return codec, payload
+
+
+def decompress(payload: bytes, codec: str) -> bytes:
+    """
+    Распаковывает содержимое файла.
+
+    :param payload: Сжатые данные
+    :param codec: Способ сжатия, записанный в индексе
+    :return: Исходное содержимое
+    """
+    if codec == PACK_CODEC_NONE:
+        return payload
+    if codec == PACK_CODEC_ZLIB:
+        return zlib.decompress(payload)
+    if codec == PACK_CODEC_LZMA:
+        return lzma.decompress(payload)
+    raise ValueError(f"Неизвестный способ сжатия: {codec}")
+
+
+def read_object(pack_root: str, entry: PackEntry) -> bytes:
+    """
+    Читает содержимое файла из пак-файла по записи индекса.
+
+    :param pack_root: Директория пак-файлов
+    :param entry: Положение содержимого
+    :return: Исходное содержимое
+    """
+    with open(pack_path(pack_root, entry.pack), 'rb') as f:
+        f.seek(entry.offset)
+        payload = f.read(entry.length)
+    if len(payload) != entry.length:
+        raise ValueError(f"Пак-файл {entry.pack} обрезан")
+    data = decompress(payload, entry.codec)
+    if len(data) != entry.size:
+        raise ValueError(f"Размер содержимого в пак-файле {entry.pack} не совпадает с индексом")
+    return data
+
+
+def stream_object(pack_root: str, entry: PackEntry, out: BinaryIO) -> int:
+    """
+    Пишет содержимое файла из пак-файла в открытый файл, распаковывая его по частям.
+
+    Пак-файл отображается в память (mmap), сжатое содержимое читается и распаковывается
+    блоками по STREAM_BLOCK_SIZE, поэтому целиком в памяти оно не собирается.
+
+    :param pack_root: Директория пак-файлов
+    :param entry: Положение содержимого
+    :param out: Файл, открытый для записи в двоичном режиме
+    :return: Количество записанных байт
+    """
+    if entry.codec == PACK_CODEC_ZLIB:
+        decompressor = zlib.decompressobj()
+    elif entry.codec == PACK_CODEC_LZMA:
+        decompressor = lzma.LZMADecompressor()
+    elif entry.codec == PACK_CODEC_NONE:
+        decompressor = None
+    else:
+        raise ValueError(f"Неизвестный способ сжатия: {entry.codec}")
+    written = 0
+    with open(pack_path(pack_root, entry.pack), 'rb') as f, \
+            mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        end = entry.offset + entry.length
+        if end > len(data):
+            raise ValueError(f"Пак-файл {entry.pack} обрезан")
+        for start in range(entry.offset, end, STREAM_BLOCK_SIZE):
+            block = data[start:min(start + STREAM_BLOCK_SIZE, end)]
+            if decompressor is not None:
+                block = decompressor.decompress(block)
+            written += out.write(block)
+    if entry.codec == PACK_CODEC_ZLIB:
+        written += out.write(decompressor.flush())
+    if written != entry.size:
+        raise ValueError(f"Размер содержимого в пак-файле {entry.pack} не совпадает с индексом")
+    return written
+
+
+class PackWriter:
+    """
+    Дописывает сжатое содержимое небольших файлов в пак-файлы пункта назначения.
+
+    Каждое содержимое сжимается отдельно, поэтому читается по смещению без распаковки
+    соседних. Одинаковое содержимое записывается один раз: уже упакованное находится
+    среди записанных в этом запуске или через lookup в индексе каталога. Данные пишутся
+    без буферизации, а перед фиксацией пачки записей каталога, которые на них ссылаются,
+    сбрасываются на диск (sync): после сбоя питания индекс не укажет на потерянные данные.
+    Методы можно вызывать из нескольких потоков. Открытый пак-файл заблокирован (flock),
+    поэтому одновременные запуски с тем же пунктом назначения пишут в разные пак-файлы.
+    """
+
+    def __init__(self, pack_root: str, codec: str = PACK_CODEC_ZLIB,
+                 lookup: Optional[Callable[[str], Optional[tuple]]] = None,
+                 on_close: Optional[Callable[[], None]] = None, max_size: int = PACK_MAX_SIZE):
+        """
+        :param pack_root: Директория пак-файлов
+        :param codec: Способ сжатия из PACK_CODECS
+        :param lookup: Поиск содержимого в индексе по хешу (см. database.get_pack_object)
+        :param on_close: Вызывается при закрытии, например чтобы закрыть соединение для lookup
+        :param max_size: Размер, после которого начинается следующий пак-файл
+        """
+        if codec not in PACK_CODECS:
+            raise ValueError(f"Неизвестный способ сжатия: {codec}")
+        self.pack_root = pack_root
+        self.codec = codec
+        self.lookup = lookup
+        self.on_close = on_close
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        self.written: Dict[str, PackEntry] = {}
+        self.file = None
+        self.pack = None
+        # Есть ли в открытом пак-файле данные, еще не сброшенные на диск
+        self.dirty = False
+
+    def find(self, file_hash: str) -> Optional[PackEntry]:
+        """
+        Ищет уже упакованное содержимое.
+
+        :param file_hash: Хеш содержимого
+        :return: Положение содержимого или None
+        """
+        with self.lock:
+            entry = self.written.get(file_hash)
+            if entry is None and self.lookup is not None:
+                row = self.lookup(file_hash)
+                if row:
+                    entry = self.written[file_hash] = PackEntry(*row)
+            return entry
+
+    def add(self, file_hash: str, data: bytes) -> Tuple[PackEntry, bool]:
+        """
+        Упаковывает содержимое, если его еще нет среди записанных в этом запуске.
+
+        :param file_hash: Хеш содержимого
+        :param data: Содержимое
+        :return: Кортеж (положение содержимого, было ли оно записано сейчас)
+        """
+        codec, payload = compress(data, self.codec)
+        with self.lock:
+            entry = self.written.get(file_hash)
+            if entry is not None:
+                return entry, False
+            f = self._current()
+            offset = f.tell()
+            f.write(payload)
+            self.dirty = True
+            entry = self.written[file_hash] = PackEntry(self.pack, offset, len(payload), len(data), codec)
+            if offset + len(payload) >= self.max_size:
+                self._finish()
+        return entry, True
+
+    def _current(self):
+        """ Открытый пак-файл: последний, если в нем есть место и в него никто не пишет, иначе следующий. """
+        if self.file is None:
+            os.makedirs(self.pack_root, exist_ok=True)
+            packs = sorted(int(match.group(1)) for match in map(PACK_NAME_RE.fullmatch, os.listdir(self.pack_root))
+                           if match)
+            self.pack = packs[-1] if packs else 1
+            while True:
+                f = open(pack_path(self.pack_root, self.pack), 'ab', buffering=0)
+                if self._lock(f) and f.seek(0, os.SEEK_END) < self.max_size:
+                    break
+                f.close()
+                self.pack += 1
+            self.file = f
+            if self.file.tell() == 0:
+                self.file.write(PACK_MAGIC)
+        return self.file
+
+    @staticmethod
+    def _lock(f) -> bool:
+        """ Пытается заблокировать пак-файл для записи; блокировка снимается при закрытии. """
+        if fcntl is None:
+            return True
+        try:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            return True
+        except BlockingIOError:
+            return False
+
+    def sync(self) -> None:
+        """ Сбрасывает на диск записанное в текущий пак-файл; вызывается перед фиксацией индекса в каталоге. """
+        with self.lock:
+            if self.dirty:
+                os.fsync(self.file.fileno())
+                self.dirty = False
+
+    def _finish(self) -> None:
+        """ Сбрасывает текущий пак-файл на диск и закрывает его. """
+        if self.file is not None:
+            os.fsync(self.file.fileno())
+            self.file.close()
+            self.file = None
+            self.dirty = False
+
+    def close(self) -> None:
+        """ Сбрасывает данные на диск и закрывает пак-файл. """
+        with self.lock:
+            self._finish()
+        if self.on_close is not None:
+            self.on_close()
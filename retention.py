@@ -0,0 +1,228 @@
+import os
+import re
+import logging
+from collections import Counter
+from contextlib import closing
+from datetime import datetime
+from typing import Callable, Dict, List, Optional, Set, Tuple
+
+from database import create_connection, create_table, list_snapshots, get_snapshot_growth, delete_snapshot, \
+    delete_orphan_chunk_lists, get_orphan_chunks, delete_chunks, delete_orphan_pack_objects
+from chunk_store import CHUNK_DIR_NAME, chunk_path
+from pack_store import PACK_DIR_NAME, PACK_NAME_RE
+from backup_manager import format_stats
+
+logging.basicConfig(filename='backup_log.log', level=logging.INFO,
+                    format='%(asctime)s:%(levelname)s:%(message)s')
+
+# Имена директорий снимков, создаваемых backup_files: время, у снимков наборов - метка набора и источника
+SNAPSHOT_NAME_RE = re.compile(r'\d{8}-\d{6}(-.+)?')
+
+# Корзины правил хранения: из каждой корзины сохраняется самый новый снимок
+BUCKETS: Dict[str, Callable[[datetime], Tuple]] = {
+    'hourly': lambda t: (t.year, t.month, t.day, t.hour),
+    'daily': lambda t: (t.year, t.month, t.day),
+    'weekly': lambda t: tuple(t.isocalendar()[:2]),
+}
+
+
+def select_snapshots(snapshots: List[tuple], keep_last: int = 0, keep_hourly: int = 0, keep_daily: int = 0,
+                     keep_weekly: int = 0) -> Set[int]:
+    """
+    Выбирает снимки, которые нужно сохранить по правилам хранения.
+
+    Снимок сохраняется, если он входит в keep_last последних или оказался самым новым в одной
+    из последних keep_hourly часовых, keep_daily дневных или keep_weekly недельных корзин.
+    Правила применяются к снимкам каждого источника (в каждом наборе) отдельно и учитывают
+    только завершенные снимки; самый новый завершенный снимок источника сохраняется всегда.
+    Незавершенный (отмененный) снимок сохраняется, только если он новее всех завершенных:
+    его продолжит следующий запуск (см. backup_manager.backup_files, resume); более старые
+    незавершенные снимки удаляются. Если ни одно правило не задано, сохраняются все.
+
+    :param snapshots: Снимки в формате database.list_snapshots
+    :param keep_last: Сколько последних снимков сохранить
+    :param keep_hourly: Сколько часов сохранять по одному снимку
+    :param keep_daily: Сколько дней сохранять по одному снимку
+    :param keep_weekly: Сколько недель сохранять по одному снимку
+    :return: Идентификаторы сохраняемых снимков
+    """
+    if not any((keep_last, keep_hourly, keep_daily, keep_weekly)):
+        return {snapshot[0] for snapshot in snapshots}
+    groups: Dict[Tuple, List[tuple]] = {}
+    for snapshot in snapshots:
+        groups.setdefault((snapshot[9], snapshot[3]), []).append(snapshot)
+    keep = set()
+    for group in groups.values():
+        newest_first = sorted(group, key=lambda snapshot: snapshot[0], reverse=True)
+        if newest_first[0][6] is None:
+            keep.add(newest_first[0][0])
+        finished = [snapshot for snapshot in newest_first if snapshot[6] is not None]
+        keep.update(snapshot[0] for snapshot in finished[:max(1, keep_last)])
+        for bucket, limit in (('hourly', keep_hourly), ('daily', keep_daily), ('weekly', keep_weekly)):
+            seen = set()
+            for snapshot in finished:
+                if len(seen) >= limit:
+                    break
+                key = BUCKETS[bucket](datetime.fromtimestamp(snapshot[5] or 0))
+                if key not in seen:
+                    seen.add(key)
+                    keep.add(snapshot[0])
+    return keep
+
+
+def apply_size_limit(conn, keep: Set[int], max_total_size: int) -> Set[int]:
+    """
+    Убирает из сохраняемых самые старые снимки, пока их общий объем превышает предел.
+
+    Объем считается по уникальному содержимому (см. database.get_snapshot_growth):
+    данные, общие для нескольких снимков, учитываются один раз.
+
+    :param conn: Объект соединения с базой данных
+    :param keep: Идентификаторы сохраняемых снимков
+    :param max_total_size: Предельный объем в байтах
+    :return: Идентификаторы снимков, укладывающихся в предел (самый новый - всегда)
+    """
+    growth = get_snapshot_growth(conn, sorted(keep))
+    total = 0
+    within = set()
+    for snapshot_id in sorted(keep, reverse=True):
+        total += growth.get(snapshot_id, 0)
+        if within and total > max_total_size:
+            break
+        within.add(snapshot_id)
+    return within
+
+
+def remove_tree(path: str) -> Tuple[int, int]:
+    """
+    Удаляет директорию снимка и считает действительно освобожденное место.
+
+    Файл освобождает место, только если на его inode больше нет других ссылок: количество
+    ссылок проверяется непосредственно перед удалением, поэтому данные, общие для двух
+    удаляемых снимков, засчитываются при удалении последней копии.
+
+    :param path: Директория снимка
+    :return: Кортеж (количество удаленных файлов, освобожденные байты)
+    """
+    files = reclaimed = 0
+    for dirpath, dirnames, filenames in os.walk(path, topdown=False):
+        for name in filenames:
+            file_path = os.path.join(dirpath, name)
+            try:
+                st = os.lstat(file_path)
+                os.unlink(file_path)
+                files += 1
+                if st.st_nlink <= 1:
+                    reclaimed += getattr(st, 'st_blocks', 0) * 512 or st.st_size
+            except OSError as e:
+                logging.error(f"Ошибка при удалении {file_path}: {e}")
+        for name in dirnames:
+            try:
+                os.rmdir(os.path.join(dirpath, name))
+            except OSError as e:
+                logging.error(f"Ошибка при удалении {os.path.join(dirpath, name)}: {e}")
+    try:
+        os.rmdir(path)
+    except OSError as e:
+        logging.error(f"Ошибка при удалении {path}: {e}")
+    return files, reclaimed
+
+
+def prune_backups(destination: str, db_file: Optional[str] = None, keep_last: int = 0, keep_hourly: int = 0,
+                  keep_daily: int = 0, keep_weekly: int = 0, max_total_size: int = 0,
+                  dry_run: bool = False) -> Dict[str, int]:
+    """
+    Удаляет снимки, не попадающие под правила хранения, и очищает каталог.
+
+    Удаляются директории снимков, их манифесты и записи file_data, указывающие в эти
+    директории; затем - фрагменты хранилища, на которые больше не ссылается ни один снимок,
+    записи индекса пак-файлов без ссылок и пак-файлы, в которых не осталось используемых
+    записей. Пак-файлы не перепаковываются: место неиспользуемых записей в пак-файле с
+    используемыми освобождается, только когда из него уйдет последняя используемая.
+    Все операции с каталогом выполняются запросами и потоковым перебором, без загрузки
+    каталога в память. Снимки, созданные до появления таблицы снимков, не удаляются, и пока
+    они есть, неиспользуемые фрагменты не ищутся: их ссылки не записаны в манифестах.
+    Запускать очистку одновременно с копированием в тот же пункт назначения нельзя.
+
+    :param destination: Путь назначения резервных копий
+    :param db_file: Путь к файлу базы данных (по умолчанию - рядом с резервными копиями)
+    :param keep_last: Сколько последних снимков сохранить
+    :param keep_hourly: Сколько часов сохранять по одному снимку
+    :param keep_daily: Сколько дней сохранять по одному снимку
+    :param keep_weekly: Сколько недель сохранять по одному снимку
+    :param max_total_size: Предельный объем сохраняемых снимков в байтах (0 - без предела)
+    :param dry_run: Только определить удаляемые снимки
+    :return: Статистика: удаленные снимки, файлы, записи каталога, фрагменты, пак-файлы и освобожденные байты
+    """
+    db_file = db_file or os.path.join(destination, 'backup_db.sqlite')
+    stats = Counter()
+    with closing(create_connection(db_file)) as conn:
+        create_table(conn)
+        snapshots = list_snapshots(conn)
+        keep = select_snapshots(snapshots, keep_last, keep_hourly, keep_daily, keep_weekly)
+        if max_total_size:
+            # Предел объема считается по завершенным снимкам, продолжаемые сохраняются всегда
+            resumable = {snapshot[0] for snapshot in snapshots if snapshot[0] in keep and snapshot[6] is None}
+            keep = apply_size_limit(conn, keep - resumable, max_total_size) | resumable
+        expired = [snapshot for snapshot in snapshots if snapshot[0] not in keep]
+        logging.info(f"Очистка {destination}: сохраняется снимков {len(keep)}, удаляется {len(expired)}")
+        if dry_run:
+            for snapshot in expired:
+                logging.info(f"Снимок {snapshot[1]} будет удален")
+            stats['snapshots'] = len(expired)
+            stats['snapshot_bytes'] = sum(snapshot[8] for snapshot in expired)
+            return dict(stats)
+
+        for snapshot_id, name, path, *_ in expired:
+            stats['catalog_rows'] += delete_snapshot(conn, snapshot_id, path)
+            if os.path.isdir(path):
+                files, reclaimed = remove_tree(path)
+                stats['files'] += files
+                stats['bytes_reclaimed'] += reclaimed
+            stats['snapshots'] += 1
+            logging.info(f"Снимок {name} удален")
+
+        chunk_root = os.path.join(destination, CHUNK_DIR_NAME)
+        pack_root = os.path.join(destination, PACK_DIR_NAME)
+        registered = {snapshot[1] for snapshot in snapshots}
+        unregistered = [name for name in os.listdir(destination)
+                        if SNAPSHOT_NAME_RE.fullmatch(name) and name not in registered]
+        if unregistered and (os.path.isdir(chunk_root) or os.path.isdir(pack_root)):
+            logging.warning(f"Неиспользуемые фрагменты не удаляются: есть снимки без манифеста "
+                            f"({len(unregistered)})")
+        if not unregistered and os.path.isdir(chunk_root) and delete_orphan_chunk_lists(conn) is not None:
+            page = get_orphan_chunks(conn)
+            while page:
+                # Строка каталога удаляется, только когда файла фрагмента уже нет: иначе фрагмент,
+                # который не удалось удалить, следующая очистка уже не нашла бы
+                removed = []
+                for chunk_hash, size in page:
+                    try:
+                        os.unlink(chunk_path(chunk_root, chunk_hash))
+                        stats['chunks'] += 1
+                        stats['bytes_reclaimed'] += size
+                    except FileNotFoundError:
+                        pass
+                    except OSError as e:
+                        logging.error(f"Ошибка при удалении фрагмента {chunk_hash}: {e}")
+                        continue
+                    removed.append(chunk_hash)
+                delete_chunks(conn, removed)
+                page = get_orphan_chunks(conn, page[-1][0])
+        if not unregistered and os.path.isdir(pack_root):
+            stats['pack_objects'], live = delete_orphan_pack_objects(conn)
+            for name in sorted(os.listdir(pack_root)) if live is not None else []:
+                match = PACK_NAME_RE.fullmatch(name)
+                if match is None or int(match.group(1)) in live:
+                    continue
+                path = os.path.join(pack_root, name)
+                try:
+                    size = os.path.getsize(path)
+                    os.unlink(path)
+                    stats['packs'] += 1
+                    stats['bytes_reclaimed'] += size
+                except OSError as e:
+                    logging.error(f"Ошибка при удалении пак-файла {path}: {e}")
+
+    logging.info(f"Очистка завершена: {format_stats(stats)}")
+    return dict(stats)
@@ -0,0 +1,230 @@
+import os
+import lzma
+import zlib
+import time
+import logging
+import threading
+from collections import Counter, deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import closing
+from typing import Dict, Iterator, NamedTuple, Optional
+
+from database import create_connection, create_table, get_setting, get_snapshot, get_pack_object, \
+    get_snapshot_files, get_scrub_chunks, get_scrub_pack_objects, start_scrub_run, finish_scrub_run, \
+    get_verified_keys, save_scrub_results
+from file_utils import DEFAULT_HASH_ALGORITHM, RateLimiter, calculate_hash, new_hasher
+from chunk_store import CHUNK_DIR_NAME, POINTER_MAX_SIZE, chunk_path, read_pointer
+from pack_store import PACK_DIR_NAME, PackEntry, pack_path, read_object
+from backup_manager import format_stats
+
+logging.basicConfig(filename='backup_log.log', level=logging.INFO,
+                    format='%(asctime)s:%(levelname)s:%(message)s')
+
+# Виды проверяемых объектов: inode файла снимка, фрагмент хранилища, упакованное содержимое
+SCRUB_FILE = 'file'
+SCRUB_CHUNK = 'chunk'
+SCRUB_PACK = 'pack'
+# Результаты проверки
+SCRUB_OK = 'ok'
+SCRUB_MISSING = 'missing'
+SCRUB_CORRUPT = 'corrupt'
+# Количество потоков проверки по умолчанию
+DEFAULT_SCRUB_WORKERS = 4
+# Сколько объектов на поток может ждать проверки одновременно
+SCRUB_QUEUE_FACTOR = 4
+# Через сколько проверенных объектов результаты фиксируются в базе (точка продолжения)
+SCRUB_BATCH_SIZE = 500
+
+
+class ScrubUnit(NamedTuple):
+    """ Объект, проверяемый один раз за проход. """
+    kind: str
+    # Ключ результата: устройство и inode для файла, путь для отсутствующего файла, хеш для остальных
+    key: str
+    hash: str
+    path: str
+    size: int
+    # Количество жестких ссылок: повреждение inode затрагивает все снимки, ссылающиеся на него
+    nlink: int = 1
+    entry: Optional[PackEntry] = None
+
+
+def collect_units(conn, destination: str, snapshot_id: Optional[int] = None) -> Iterator[ScrubUnit]:
+    """
+    Перебирает уникальные объекты репозитория или снимка.
+
+    Файлы снимков, связанные жесткими ссылками, дают один объект на inode. Файлы, которых
+    нет в директории снимка, но чье содержимое упаковано, проверяются как упакованное
+    содержимое; остальные отсутствующие файлы возвращаются по пути и окажутся отсутствующими.
+
+    :param conn: Соединение с базой данных для чтения
+    :param destination: Путь назначения резервных копий
+    :param snapshot_id: Идентификатор снимка или None - весь репозиторий
+    :return: Итератор объектов: сначала файлы, затем фрагменты, затем упакованное содержимое
+    """
+    chunk_root = os.path.join(destination, CHUNK_DIR_NAME)
+    pack_root = os.path.join(destination, PACK_DIR_NAME)
+    use_packs = os.path.isdir(pack_root)
+    seen = set()
+    for snapshot_path, rel_path, file_hash, size in get_snapshot_files(conn, snapshot_id):
+        path = os.path.join(snapshot_path, rel_path)
+        try:
+            st = os.stat(path)
+        except FileNotFoundError:
+            if not (use_packs and get_pack_object(conn, file_hash)):
+                yield ScrubUnit(SCRUB_FILE, path, file_hash, path, size)
+            continue
+        inode = (st.st_dev, st.st_ino)
+        if inode in seen:
+            continue
+        seen.add(inode)
+        yield ScrubUnit(SCRUB_FILE, f"{st.st_dev}:{st.st_ino}", file_hash, path, st.st_size, st.st_nlink)
+    if os.path.isdir(chunk_root):
+        for chunk_hash, size in get_scrub_chunks(conn, snapshot_id):
+            yield ScrubUnit(SCRUB_CHUNK, chunk_hash, chunk_hash, chunk_path(chunk_root, chunk_hash), size)
+    if use_packs:
+        for file_hash, *entry in get_scrub_pack_objects(conn, snapshot_id):
+            entry = PackEntry(*entry)
+            yield ScrubUnit(SCRUB_PACK, file_hash, file_hash, pack_path(pack_root, entry.pack), entry.size,
+                            entry=entry)
+
+
+def check_unit(unit: ScrubUnit, algorithm: str, use_pointers: bool = False,
+               limiter: Optional[RateLimiter] = None) -> str:
+    """
+    Проверяет один объект по хешу.
+
+    :param unit: Проверяемый объект
+    :param algorithm: Алгоритм хеширования репозитория
+    :param use_pointers: Распознавать файлы-указатели хранилища фрагментов (их фрагменты проверяются отдельно)
+    :param limiter: Ограничение скорости чтения или None
+    :return: SCRUB_OK, SCRUB_MISSING или SCRUB_CORRUPT
+    """
+    if unit.kind == SCRUB_PACK:
+        if limiter is not None:
+            limiter.consume(unit.entry.length)
+        try:
+            data = read_object(os.path.dirname(unit.path), unit.entry)
+        except FileNotFoundError:
+            return SCRUB_MISSING
+        except (OSError, ValueError, zlib.error, lzma.LZMAError):
+            return SCRUB_CORRUPT
+        hasher = new_hasher(algorithm)
+        hasher.update(data)
+        return SCRUB_OK if hasher.hexdigest() == unit.hash else SCRUB_CORRUPT
+    if not os.path.exists(unit.path):
+        return SCRUB_MISSING
+    if unit.kind == SCRUB_FILE and use_pointers and unit.size <= POINTER_MAX_SIZE:
+        pointer = read_pointer(unit.path)
+        if pointer:
+            return SCRUB_OK if pointer[0] == unit.hash else SCRUB_CORRUPT
+    return SCRUB_OK if calculate_hash(unit.path, algorithm, limiter=limiter) == unit.hash else SCRUB_CORRUPT
+
+
+def scrub_repository(destination: str, db_file: Optional[str] = None, snapshot: Optional[str] = None,
+                     workers: int = DEFAULT_SCRUB_WORKERS, max_rate: int = 0, max_age: float = 0,
+                     resume: bool = True, cancel: Optional[threading.Event] = None) -> Optional[Dict[str, int]]:
+    """
+    Проверяет целостность резервных копий по хешам из каталога.
+
+    Каждый уникальный объект проверяется один раз: inode файла снимков (сколько бы снимков
+    на него ни ссылалось), фрагмент хранилища, упакованное содержимое. Объекты проверяются
+    пулом потоков, чтение ограничивается max_rate байтами в секунду. Результат и время
+    проверки каждого объекта записываются в таблицу scrub_results пачками по
+    SCRUB_BATCH_SIZE; прерванная проверка при следующем запуске продолжается: объекты,
+    проверенные после ее начала, пропускаются. С max_age пропускаются и объекты,
+    проверенные не раньше max_age секунд назад, - так полную проверку можно растянуть
+    на несколько запусков.
+
+    :param destination: Путь назначения резервных копий
+    :param db_file: Путь к файлу базы данных (по умолчанию - рядом с резервными копиями)
+    :param snapshot: Имя снимка - проверить только его объекты; None - весь репозиторий
+    :param workers: Количество потоков проверки
+    :param max_rate: Предельная скорость чтения в байтах в секунду (0 - без ограничения)
+    :param max_age: Не проверять объекты, проверенные не раньше этого количества секунд назад (0 - проверять все)
+    :param resume: Продолжить последнюю незавершенную проверку той же области
+    :param cancel: Событие отмены: проверенное сохраняется, проверка продолжится при следующем запуске
+    :return: Количество объектов: ok, missing, corrupt, skipped и проверенные байты; None, если снимка нет в каталоге
+    """
+    db_file = db_file or os.path.join(destination, 'backup_db.sqlite')
+    stats = Counter()
+    with closing(create_connection(db_file)) as reader, closing(create_connection(db_file)) as writer:
+        create_table(writer)
+        snapshot_id = None
+        if snapshot is not None:
+            row = get_snapshot(reader, snapshot)
+            if row is None:
+                logging.error(f"Снимок {snapshot} не зарегистрирован в каталоге, проверять не с чем")
+                return None
+            snapshot_id = row[0]
+        algorithm = get_setting(reader, 'hash_algorithm', DEFAULT_HASH_ALGORITHM)
+        run = start_scrub_run(writer, snapshot, resume)
+        if run is None:
+            return None
+        run_id, since = run
+        if max_age:
+            since = min(since, time.time() - max_age)
+        skip = get_verified_keys(reader, since)
+        use_pointers = os.path.isdir(os.path.join(destination, CHUNK_DIR_NAME))
+        limiter = RateLimiter(max_rate) if max_rate else None
+        logging.info(f"Проверка целостности {snapshot or destination}: потоков {workers}, "
+                     f"ранее проверенных объектов пропускается {len(skip)}")
+
+        results = []
+        pending = deque()
+
+        def record(unit: ScrubUnit, future: Future) -> None:
+            try:
+                status = future.result()
+            except Exception as e:
+                logging.error(f"Ошибка при проверке {unit.path}: {e}")
+                status = SCRUB_CORRUPT
+            stats[status] += 1
+            stats['bytes'] += unit.size
+            if status != SCRUB_OK:
+                shared = f", общий для {unit.nlink} файлов снимков" if unit.nlink > 1 else ""
+                where = f"{unit.path}:{unit.entry.offset}" if unit.entry is not None else unit.path
+                logging.error(f"Объект {unit.kind} {where} не прошел проверку: {status}{shared}")
+            results.append((unit.kind, unit.key, unit.hash, unit.path, status, time.time()))
+            if len(results) >= SCRUB_BATCH_SIZE:
+                save_scrub_results(writer, results)
+                results.clear()
+
+        with ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix="capsule-scrub") as pool:
+            for unit in collect_units(reader, destination, snapshot_id):
+                if cancel is not None and cancel.is_set():
+                    break
+                if (unit.kind, unit.key) in skip:
+                    stats['skipped'] += 1
+                    continue
+                pending.append((unit, pool.submit(check_unit, unit, algorithm, use_pointers, limiter)))
+                if len(pending) >= max(1, workers) * SCRUB_QUEUE_FACTOR:
+                    record(*pending.popleft())
+            while pending:
+                record(*pending.popleft())
+        save_scrub_results(writer, results)
+        cancelled = cancel is not None and cancel.is_set()
+        if not cancelled:
+            finish_scrub_run(writer, run_id, dict(stats))
+    logging.info(f"Проверка целостности {snapshot or destination} {'прервана' if cancelled else 'завершена'}: "
+                 f"{format_stats(stats)}")
+    return dict(stats)
+
+
+def verify_snapshot(backup_path: str, db_file: Optional[str] = None, workers: int = DEFAULT_SCRUB_WORKERS,
+                    max_rate: int = 0, resume: bool = True,
+                    cancel: Optional[threading.Event] = None) -> Optional[Dict[str, int]]:
+    """
+    Проверяет объекты одного снимка (см. scrub_repository).
+
+    :param backup_path: Путь до папки резервной копии
+    :param db_file: Путь к файлу базы данных (по умолчанию - рядом с резервными копиями)
+    :param workers: Количество потоков проверки
+    :param max_rate: Предельная скорость чтения в байтах в секунду (0 - без ограничения)
+    :param resume: Продолжить прерванную проверку этого снимка
+    :param cancel: Событие отмены
+    :return: Количество объектов: ok, missing, corrupt, skipped; None, если снимка нет в каталоге
+    """
+    backup_path = os.path.normpath(backup_path)
+    return scrub_repository(os.path.dirname(backup_path), db_file, os.path.basename(backup_path), workers,
+                            max_rate, resume=resume, cancel=cancel)
@@ -0,0 +1,8 @@
+import logging
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# Модули настраивают журнал в backup_log.log текущей директории при импорте; в тестах журнал не пишется
+logging.basicConfig(handlers=[logging.NullHandler()], level=logging.INFO)
@@ -0,0 +1,99 @@
+import errno
+import os
+import threading
+
+import pytest
+
+import backup_manager
+import file_utils
+from backup_manager import backup_files, incremental_backup
+
+
+def make_source(tmp_path):
+    source = tmp_path / "src"
+    source.mkdir()
+    (source / "f.txt").write_text("content")
+    (source / "same.txt").write_text("content")
+    return source
+
+
+def snapshot_files(destination):
+    snapshot = next(entry for entry in os.scandir(destination) if entry.is_dir() and not entry.name.startswith('.'))
+    return {name: os.path.join(snapshot.path, name) for name in os.listdir(snapshot.path)}
+
+
+def test_shared_catalog_links_only_within_destination(tmp_path):
+    source = make_source(tmp_path)
+    db_file = str(tmp_path / "db.sqlite")
+    backup_files(str(source), str(tmp_path / "one"), db_file)
+    backup_files(str(source), str(tmp_path / "two"), db_file)
+
+    first, second = snapshot_files(tmp_path / "one"), snapshot_files(tmp_path / "two")
+    assert sorted(second) == ['f.txt', 'same.txt']
+    for name, path in second.items():
+        assert open(path).read() == "content"
+        assert not os.path.samefile(path, first[name])
+
+
+def test_failed_link_falls_back_to_copy(tmp_path, monkeypatch):
+    source = make_source(tmp_path)
+    destination = tmp_path / "dst"
+    db_file = str(tmp_path / "db.sqlite")
+
+    def no_link(src, dst, **kwargs):
+        raise OSError(errno.EMLINK, "Too many links")
+
+    monkeypatch.setattr(os, 'link', no_link)
+    stats = backup_files(str(source), str(destination), db_file)
+
+    assert 'link' not in stats
+    for path in snapshot_files(destination).values():
+        assert open(path).read() == "content"
+
+
+def test_unavailable_algorithm_ignored_for_existing_repository(tmp_path, monkeypatch):
+    source = make_source(tmp_path)
+    destination = str(tmp_path / "dst")
+    db_file = str(tmp_path / "db.sqlite")
+    backup_files(str(source), destination, db_file, hash_algorithm='sha256')
+    monkeypatch.setattr(file_utils, 'blake3', None)
+
+    backup_files(str(source), destination, db_file, hash_algorithm='blake3')
+    incremental_backup(str(source), destination, db_file, [str(source / "f.txt")], hash_algorithm='blake3')
+
+    # Новый репозиторий с недоступным алгоритмом по-прежнему отклоняется
+    with pytest.raises(ValueError):
+        backup_files(str(source), str(tmp_path / "new"), str(tmp_path / "new.sqlite"), hash_algorithm='blake3')
+
+
+def test_pipeline_db_failure_raises(tmp_path, monkeypatch):
+    source = tmp_path / "src"
+    source.mkdir()
+    for i in range(200):
+        (source / f"{i}.txt").write_text(str(i))
+    calls = []
+
+    def commit_batch(db_conn, packs):
+        calls.append(db_conn)
+        if len(calls) == 1:
+            raise OSError(errno.ENOSPC, "No space left on device")
+        real_commit_batch(db_conn, packs)
+
+    real_commit_batch = backup_manager.commit_batch
+    monkeypatch.setattr(backup_manager, 'commit_batch', commit_batch)
+    monkeypatch.setattr(backup_manager, 'PIPELINE_QUEUE_FACTOR', 1)
+    errors = []
+
+    def run():
+        try:
+            backup_files(str(source), str(tmp_path / "dst"), str(tmp_path / "db.sqlite"), batch_size=10,
+                         hash_workers=1, copy_workers=1)
+        except OSError as e:
+            errors.append(e)
+
+    # Поток-демон: если конвейер зависнет, тест упадет по таймауту, а не повиснет сам
+    worker = threading.Thread(target=run, daemon=True)
+    worker.start()
+    worker.join(timeout=30)
+    assert not worker.is_alive()
+    assert errors and errors[0].errno == errno.ENOSPC
@@ -0,0 +1,38 @@
+import io
+import random
+
+import pytest
+
+import chunk_store
+from chunk_store import MAX_CHUNK_SIZE, MIN_CHUNK_SIZE, iter_chunks
+
+
+def chunk_list(data):
+    return list(iter_chunks(io.BytesIO(data)))
+
+
+def test_chunk_sizes_within_bounds():
+    data = random.Random(1).randbytes(12 * 1024 * 1024)
+    chunks = chunk_list(data)
+    assert b''.join(chunks) == data
+    assert len(chunks) > 3
+    assert all(MIN_CHUNK_SIZE <= len(chunk) <= MAX_CHUNK_SIZE for chunk in chunks[:-1])
+
+
+def test_inserted_byte_keeps_most_chunks():
+    data = random.Random(2).randbytes(12 * 1024 * 1024)
+    edited = data[:len(data) // 2] + b'x' + data[len(data) // 2:]
+    before, after = chunk_list(data), chunk_list(edited)
+    assert b''.join(after) == edited
+    # Меняется только фрагмент со вставкой (и, возможно, следующий за ним)
+    survived = set(before) & set(after)
+    assert len(survived) >= len(before) - 2
+    assert len(survived) >= 0.7 * len(before)
+
+
+def test_fallback_matches_fastcdc(monkeypatch):
+    pytest.importorskip('fastcdc.fastcdc_cy')
+    data = random.Random(3).randbytes(12 * 1024 * 1024)
+    compiled = chunk_list(data)
+    monkeypatch.setattr(chunk_store, 'fastcdc_cy', None)
+    assert chunk_list(data) == compiled
@@ -0,0 +1,76 @@
+import json
+
+import cli
+import jobs
+
+
+def run_json(capsys, *argv):
+    code = cli.main(['--json', *argv])
+    events = [json.loads(line) for line in capsys.readouterr().out.splitlines()]
+    return code, events
+
+
+def test_backup_emits_progress(tmp_path, capsys):
+    source = tmp_path / "src"
+    source.mkdir()
+    (source / "a.txt").write_text("a")
+
+    code, events = run_json(capsys, 'backup', str(source), str(tmp_path / "dst"))
+
+    assert code == 0
+    progress = [event for event in events if event['event'] == 'progress']
+    assert progress and progress[-1]['state'] == 'finished'
+    assert events[-1]['event'] == 'result'
+
+
+def test_failed_backup_exits_non_zero(tmp_path, capsys):
+    source = tmp_path / "src"
+    source.mkdir()
+    # Каталог недоступен для записи: его родитель - обычный файл
+    blocker = tmp_path / "blocker"
+    blocker.write_text("")
+
+    code, events = run_json(capsys, '--db', str(blocker / "db.sqlite"), 'backup', str(source), str(tmp_path / "dst"))
+
+    assert code == 1
+    assert events[-1]['event'] == 'error'
+
+
+def test_set_run(tmp_path, capsys):
+    source = tmp_path / "src"
+    source.mkdir()
+    (source / "a.txt").write_text("a")
+    destination = str(tmp_path / "dst")
+    assert cli.main(['set', 'add', destination, 'docs', str(source)]) == 0
+    capsys.readouterr()
+
+    code, events = run_json(capsys, 'set', 'run', destination, 'docs')
+
+    assert code == 0
+    assert any(event['event'] == 'progress' for event in events)
+    assert events[-1]['event'] == 'result'
+    assert events[-1]['stats']['finished'] == 1
+    assert 'failed' not in events[-1]['stats']
+
+
+def test_set_run_with_failed_job(tmp_path, capsys, monkeypatch):
+    good, bad = tmp_path / "good", tmp_path / "bad"
+    good.mkdir()
+    bad.mkdir()
+    destination = str(tmp_path / "dst")
+    assert cli.main(['set', 'add', destination, 'docs', str(good), str(bad)]) == 0
+    capsys.readouterr()
+
+    def backup_files(source, *args, **kwargs):
+        if source == str(bad):
+            raise OSError("источник недоступен")
+        return real_backup_files(source, *args, **kwargs)
+
+    real_backup_files = jobs.backup_files
+    monkeypatch.setattr(jobs, 'backup_files', backup_files)
+    code, events = run_json(capsys, 'set', 'run', destination, 'docs')
+
+    assert code == 1
+    states = sorted(event['job']['event'] for event in events if event['event'] == 'job')
+    assert states == ['failed', 'finished']
+    assert events[-1]['stats']['failed'] == 1
@@ -0,0 +1,29 @@
+import threading
+from contextlib import closing
+
+from database import SCHEMA_VERSION, create_connection, create_table
+
+
+def test_backup_path_range_uses_index(tmp_path):
+    with closing(create_connection(str(tmp_path / "db.sqlite"))) as conn:
+        create_table(conn)
+        plan = conn.execute("EXPLAIN QUERY PLAN DELETE FROM file_data WHERE backup_path >= ? AND backup_path < ?",
+                            ('a', 'b')).fetchall()
+    assert 'idx_file_data_backup_path' in plan[0][3]
+
+
+def test_concurrent_create_table(tmp_path):
+    db_file = str(tmp_path / "db.sqlite")
+    versions = []
+
+    def migrate():
+        with closing(create_connection(db_file, check_same_thread=False)) as conn:
+            create_table(conn)
+            versions.append(conn.execute("PRAGMA user_version").fetchone()[0])
+
+    threads = [threading.Thread(target=migrate) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert versions == [SCHEMA_VERSION] * len(threads)
@@ -0,0 +1,49 @@
+import errno
+
+import pytest
+
+import file_utils
+from file_utils import COPY_BUFFERED, COPY_STRATEGIES, copy_file
+
+
+def failing(code):
+    def copy(fsrc, fdst, size, limiter=None):
+        fdst.write(b'partial')
+        raise OSError(code, "сбой копирования")
+    return copy
+
+
+@pytest.fixture
+def strategy_cache(monkeypatch):
+    cache = {}
+    monkeypatch.setattr(file_utils, '_copy_strategy_index', cache)
+    return cache
+
+
+def test_copy_fails_when_no_strategy_works(tmp_path, monkeypatch, strategy_cache):
+    source = tmp_path / "src.txt"
+    source.write_bytes(b'data')
+    destination = tmp_path / "dst.txt"
+    originals = dict(file_utils._COPY_FUNCTIONS)
+    for strategy in COPY_STRATEGIES:
+        monkeypatch.setitem(file_utils._COPY_FUNCTIONS, strategy, failing(errno.EINVAL))
+
+    with pytest.raises(OSError):
+        copy_file(str(source), str(destination))
+    assert not destination.exists()
+    assert set(strategy_cache.values()) == {COPY_STRATEGIES.index(COPY_BUFFERED)}
+
+    # Следующий файл той же пары устройств снова пробует буферное копирование
+    monkeypatch.setitem(file_utils._COPY_FUNCTIONS, COPY_BUFFERED, originals[COPY_BUFFERED])
+    assert copy_file(str(source), str(destination)) == COPY_BUFFERED
+    assert destination.read_bytes() == b'data'
+
+
+def test_per_file_error_does_not_demote_strategy(tmp_path, monkeypatch, strategy_cache):
+    source = tmp_path / "src.txt"
+    source.write_bytes(b'data')
+    monkeypatch.setitem(file_utils._COPY_FUNCTIONS, COPY_STRATEGIES[0], failing(errno.EPERM))
+
+    with pytest.raises(PermissionError):
+        copy_file(str(source), str(tmp_path / "dst.txt"))
+    assert strategy_cache == {}
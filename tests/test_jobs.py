@@ -0,0 +1,20 @@
+from jobs import JOB_BACKUP, JobManager
+
+
+def test_failed_backup_publishes_failed(tmp_path):
+    source = tmp_path / "src"
+    source.mkdir()
+    (source / "a.txt").write_text("a")
+    # Каталог недоступен для записи: его родитель - обычный файл (под root chmod не мешает записи)
+    blocker = tmp_path / "blocker"
+    blocker.write_text("")
+
+    events = []
+    manager = JobManager()
+    manager.subscribe(lambda message: events.append(message['event']))
+    manager.submit(JOB_BACKUP, str(source), str(tmp_path / "dst"), db_file=str(blocker / "db.sqlite"))
+    manager.wait()
+    manager.shutdown()
+
+    assert events[-1] == 'failed'
+    assert 'finished' not in events
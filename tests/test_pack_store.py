@@ -0,0 +1,22 @@
+import os
+
+import pack_store
+from pack_store import PackWriter, read_object
+
+
+def test_sync_flushes_only_new_data(tmp_path, monkeypatch):
+    synced = []
+    real_fsync = os.fsync
+    monkeypatch.setattr(pack_store.os, 'fsync', lambda fd: synced.append(fd) or real_fsync(fd))
+    writer = PackWriter(str(tmp_path))
+
+    writer.sync()
+    assert synced == []
+    entry, added = writer.add('h1', b'data' * 100)
+    assert added
+    writer.sync()
+    writer.sync()
+    assert len(synced) == 1
+    writer.close()
+    assert len(synced) == 2
+    assert read_object(str(tmp_path), entry) == b'data' * 100
@@ -0,0 +1,82 @@
+import filecmp
+import os
+import time
+
+import pytest
+
+from backup_manager import BACKEND_CHUNK, BACKEND_LINK, BACKEND_PACK, RESTORE_MKDIR, backup_files, \
+    incremental_backup, restore_backup
+from database import create_connection, list_snapshots
+
+
+def make_tree(root):
+    for rel_path, data in (('a/f.txt', 'x'), ('c/deep/g.txt', 'y'), ('top.txt', 'z')):
+        path = os.path.join(root, rel_path)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'w') as f:
+            f.write(data)
+    os.makedirs(os.path.join(root, 'empty', 'nested'))
+
+
+def latest_snapshot(db_file):
+    conn = create_connection(db_file)
+    try:
+        return max(list_snapshots(conn))[2]
+    finally:
+        conn.close()
+
+
+def assert_same_tree(left, right):
+    comparison = filecmp.dircmp(left, right)
+    assert not comparison.left_only and not comparison.right_only and not comparison.diff_files
+    for name in comparison.common_dirs:
+        assert_same_tree(os.path.join(left, name), os.path.join(right, name))
+
+
+@pytest.mark.parametrize('backend', [BACKEND_LINK, BACKEND_CHUNK, BACKEND_PACK])
+@pytest.mark.parametrize('workers', [0, 2])
+def test_restore_keeps_empty_directories(tmp_path, backend, workers):
+    source, destination = str(tmp_path / 'src'), str(tmp_path / 'dst')
+    make_tree(source)
+    os.makedirs(destination)
+    db_file = os.path.join(destination, 'backup_db.sqlite')
+    backup_files(source, destination, db_file, hash_workers=workers, copy_workers=workers, backend=backend)
+    snapshot = latest_snapshot(db_file)
+
+    target = str(tmp_path / 'out')
+    plan = restore_backup(snapshot, target, dry_run=True)
+    assert plan[RESTORE_MKDIR] == 6
+    restore_backup(snapshot, target)
+    assert_same_tree(source, target)
+
+
+def test_restore_of_incremental_snapshot_keeps_emptied_directory(tmp_path):
+    source, destination = str(tmp_path / 'src'), str(tmp_path / 'dst')
+    make_tree(source)
+    os.makedirs(destination)
+    db_file = os.path.join(destination, 'backup_db.sqlite')
+    backup_files(source, destination, db_file)
+    time.sleep(1.1)
+    os.unlink(os.path.join(source, 'c', 'deep', 'g.txt'))
+    os.rmdir(os.path.join(source, 'c', 'deep'))
+    incremental_backup(source, destination, db_file, [os.path.join(source, 'c')])
+
+    target = str(tmp_path / 'out')
+    restore_backup(latest_snapshot(db_file), target)
+    assert_same_tree(source, target)
+
+
+def test_incremental_snapshot_keeps_directory_emptied_by_deleted_file(tmp_path):
+    source, destination = str(tmp_path / 'src'), str(tmp_path / 'dst')
+    make_tree(source)
+    os.makedirs(destination)
+    db_file = os.path.join(destination, 'backup_db.sqlite')
+    backup_files(source, destination, db_file)
+    time.sleep(1.1)
+    deleted = os.path.join(source, 'c', 'deep', 'g.txt')
+    os.unlink(deleted)
+    incremental_backup(source, destination, db_file, [deleted])
+
+    target = str(tmp_path / 'out')
+    restore_backup(latest_snapshot(db_file), target)
+    assert_same_tree(source, target)
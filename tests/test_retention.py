@@ -0,0 +1,91 @@
+import errno
+import os
+import threading
+import time
+from contextlib import closing
+
+from backup_manager import backup_files
+from chunk_store import CHUNK_DIR_NAME, chunk_path
+from database import create_connection, create_table, list_snapshots
+from retention import prune_backups, select_snapshots
+
+
+def snapshot(snapshot_id, started, finished=True, source='/src'):
+    return (snapshot_id, f's{snapshot_id}', f'/dst/s{snapshot_id}', source, 'link', started,
+            started + 1 if finished else None, 1, 1, None)
+
+
+def test_unfinished_snapshots_do_not_count_as_newest():
+    hour = 3600
+    snapshots = [snapshot(1, 0), snapshot(2, hour, finished=False), snapshot(3, 2 * hour),
+                 snapshot(4, 3 * hour, finished=False)]
+    assert select_snapshots(snapshots, keep_last=1) == {3, 4}
+    assert select_snapshots(snapshots, keep_hourly=2) == {1, 3, 4}
+
+
+def test_only_unfinished_snapshot_is_kept_until_resumed():
+    assert select_snapshots([snapshot(1, 0, finished=False), snapshot(2, 10, finished=False)], keep_last=1) == {2}
+
+
+def run_backup(source, destination, cancelled=False):
+    cancel = threading.Event()
+    if cancelled:
+        cancel.set()
+    backup_files(source, destination, os.path.join(destination, 'backup_db.sqlite'), cancel=cancel)
+    time.sleep(1.1)
+
+
+def test_prune_keeps_complete_snapshot_when_newest_is_cancelled(tmp_path):
+    source, destination = str(tmp_path / 'src'), str(tmp_path / 'dst')
+    os.makedirs(source)
+    os.makedirs(destination)
+    with open(os.path.join(source, 'f.txt'), 'w') as f:
+        f.write('data')
+    run_backup(source, destination, cancelled=True)
+    run_backup(source, destination)
+    run_backup(source, destination, cancelled=True)
+
+    prune_backups(destination, keep_last=1)
+
+    conn = create_connection(os.path.join(destination, 'backup_db.sqlite'))
+    try:
+        left = sorted(list_snapshots(conn))
+    finally:
+        conn.close()
+    assert [row[6] is not None for row in left] == [True, False]
+    assert os.path.isfile(os.path.join(left[0][2], 'f.txt'))
+
+
+def test_gc_keeps_catalog_row_when_chunk_unlink_fails(tmp_path, monkeypatch):
+    destination = tmp_path / 'dst'
+    db_file = str(destination / 'backup_db.sqlite')
+    destination.mkdir()
+    paths = {}
+    with closing(create_connection(db_file)) as conn:
+        create_table(conn)
+        for chunk_hash in ('aa01', 'bb02', 'cc03'):
+            conn.execute("INSERT INTO chunks (hash, size) VALUES (?, 4)", (chunk_hash,))
+            paths[chunk_hash] = chunk_path(str(destination / CHUNK_DIR_NAME), chunk_hash)
+        conn.commit()
+    for chunk_hash in ('aa01', 'bb02'):
+        os.makedirs(os.path.dirname(paths[chunk_hash]), exist_ok=True)
+        with open(paths[chunk_hash], 'wb') as f:
+            f.write(b'data')
+
+    real_unlink = os.unlink
+
+    def unlink(path, *args, **kwargs):
+        if path == paths['bb02']:
+            raise PermissionError(errno.EACCES, "Permission denied", path)
+        real_unlink(path, *args, **kwargs)
+
+    monkeypatch.setattr(os, 'unlink', unlink)
+    assert prune_backups(str(destination), keep_last=1)['chunks'] == 1
+    assert os.path.exists(paths['bb02'])
+
+    # Следующая очистка находит фрагмент, который не удалось удалить
+    monkeypatch.setattr(os, 'unlink', real_unlink)
+    assert prune_backups(str(destination), keep_last=1)['chunks'] == 1
+    assert not os.path.exists(paths['bb02'])
+    with closing(create_connection(db_file)) as conn:
+        assert conn.execute("SELECT COUNT(*) FROM chunks").fetchone()[0] == 0
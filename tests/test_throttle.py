@@ -0,0 +1,30 @@
+import shutil
+import threading
+
+import pytest
+
+from backup_manager import backup_files
+from throttle import IONICE_IDLE_CLASS, Throttle, get_io_priority, set_io_priority
+
+
+@pytest.mark.skipif(shutil.which('ionice') is None, reason="нужна утилита ionice")
+def test_idle_priority_restored_after_backup(tmp_path):
+    source = tmp_path / "src"
+    source.mkdir()
+    (source / "a.txt").write_text("a")
+    seen = {}
+
+    def job():
+        # Поток задания, как у jobs.JobManager: после копирования он выполняет следующие задания
+        set_io_priority(2, 5)
+        throttle = Throttle(idle_io=True)
+        backup_files(str(source), str(tmp_path / "dst"), str(tmp_path / "db.sqlite"), throttle=throttle,
+                     progress=lambda fields: seen.setdefault('during', get_io_priority()))
+        seen['after'] = get_io_priority()
+
+    worker = threading.Thread(target=job)
+    worker.start()
+    worker.join()
+
+    assert seen['during'][0] == IONICE_IDLE_CLASS
+    assert seen['after'] == (2, 5)
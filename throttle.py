@@ -0,0 +1,253 @@
+import os
+import sys
+import json
+import time
+import logging
+import subprocess
+import threading
+from typing import Dict, Iterable, NamedTuple, Optional, Tuple
+
+from database import get_setting, set_setting
+from file_utils import RateLimiter
+
+logging.basicConfig(filename='backup_log.log', level=logging.INFO,
+                    format='%(asctime)s:%(levelname)s:%(message)s')
+
+# Как часто (в секундах) сверяться с часами, не начался ли другой профиль
+PROFILE_CHECK_SECONDS = 30
+# Класс приоритета ввода-вывода idle для ionice: поток читает диск, только когда он никому не нужен
+IONICE_IDLE_CLASS = 3
+# Классы приоритета ввода-вывода по именам, которые печатает ionice
+IONICE_CLASSES = {'none': 0, 'realtime': 1, 'best-effort': 2, 'idle': IONICE_IDLE_CLASS}
+
+
+class ThrottleProfile(NamedTuple):
+    """ Ограничения, действующие в определенное время суток. """
+    # Начало и конец интервала в минутах от полуночи; конец раньше начала - интервал через полночь
+    start: int
+    end: int
+    # Байт в секунду и файлов в секунду (0 - без ограничения)
+    max_rate: float
+    max_files: float = 0
+
+    def covers(self, minute: int) -> bool:
+        """ Проверяет, попадает ли минута суток в интервал профиля. """
+        if self.start <= self.end:
+            return self.start <= minute < self.end
+        return minute >= self.start or minute < self.end
+
+
+class Throttle(RateLimiter):
+    """
+    Ограничение нагрузки резервного копирования на диск источника.
+
+    Сам объект - маркерная корзина байтов, общая для этапов хеширования и копирования:
+    ее можно передавать как limiter в функции file_utils и chunk_store. Вторая корзина
+    ограничивает количество файлов в секунду. Пределы по умолчанию можно переопределить
+    профилями по времени суток (действует первый подходящий). Дополнительно прочитанные
+    файлы источника вытесняются из страничного кэша (posix_fadvise DONTNEED), а поток
+    копирования может перейти в класс приоритета ввода-вывода idle (ionice).
+    """
+
+    def __init__(self, max_rate: float = 0, max_files: float = 0, profiles: Iterable[ThrottleProfile] = (),
+                 drop_cache: bool = False, idle_io: bool = False):
+        """
+        :param max_rate: Байт в секунду вне профилей (0 - без ограничения)
+        :param max_files: Файлов в секунду вне профилей (0 - без ограничения)
+        :param profiles: Профили по времени суток
+        :param drop_cache: Вытеснять прочитанные файлы источника из страничного кэша
+        :param idle_io: Копировать с приоритетом ввода-вывода idle
+        """
+        super().__init__(max_rate)
+        self.max_rate = max_rate
+        self.max_files = max_files
+        self.profiles = [ThrottleProfile(*profile) for profile in profiles]
+        self.drop_cache = drop_cache
+        self.idle_io = idle_io
+        self.files = RateLimiter(max_files)
+        self.checked = 0.0
+        self.refresh()
+
+    @property
+    def active(self) -> bool:
+        """ Задано ли хоть одно ограничение. """
+        return bool(self.max_rate or self.max_files or self.profiles or self.drop_cache or self.idle_io)
+
+    def limits(self, now: Optional[float] = None) -> Tuple[float, float]:
+        """
+        Возвращает пределы, действующие в указанный момент.
+
+        :param now: Время (по умолчанию - текущее)
+        :return: Кортеж (байт в секунду, файлов в секунду)
+        """
+        local = time.localtime(now)
+        minute = local.tm_hour * 60 + local.tm_min
+        for profile in self.profiles:
+            if profile.covers(minute):
+                return profile.max_rate, profile.max_files
+        return self.max_rate, self.max_files
+
+    def refresh(self) -> None:
+        """ Переключает пределы корзин, если начался другой профиль. """
+        now = time.monotonic()
+        if self.checked and now - self.checked < PROFILE_CHECK_SECONDS:
+            return
+        self.checked = now
+        max_rate, max_files = self.limits()
+        if max_rate != self.rate:
+            logging.info(f"Ограничение скорости копирования: {max_rate or 'нет'} байт/с")
+            self.set_rate(max_rate)
+        if max_files != self.files.rate:
+            self.files.set_rate(max_files)
+
+    def consume(self, amount: float) -> None:
+        """ Списывает прочитанные байты и при необходимости ждет. """
+        self.refresh()
+        super().consume(amount)
+
+    def consume_files(self, count: int = 1) -> None:
+        """ Списывает обработанные файлы и при необходимости ждет. """
+        self.refresh()
+        self.files.consume(count)
+
+    def release(self, path: str) -> None:
+        """
+        Вытесняет файл из страничного кэша, если это включено.
+
+        Вызывается после последнего чтения файла копированием: данные источника, прочитанные
+        один раз, не должны вытеснять из кэша то, с чем работают другие программы.
+
+        :param path: Путь к прочитанному файлу
+        """
+        if not self.drop_cache or not hasattr(os, 'posix_fadvise'):
+            return
+        try:
+            fd = os.open(path, os.O_RDONLY)
+            try:
+                os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+            finally:
+                os.close(fd)
+        except OSError as e:
+            logging.debug("Не удалось вытеснить %s из страничного кэша: %s", path, e)
+
+    def lower_priority(self) -> Optional[Tuple[int, int]]:
+        """
+        Переводит текущий поток в класс приоритета ввода-вывода idle, если это включено.
+
+        Приоритет наследуют потоки, созданные после вызова (пулы хеширования и копирования),
+        поэтому вызывать нужно до их запуска. Поток задания переиспользуется следующими
+        заданиями (jobs.JobManager), поэтому после копирования прежний приоритет нужно вернуть
+        (restore_priority). Класс учитывается планировщиками BFQ и CFQ.
+
+        :return: Прежний приоритет потока или None, если он не менялся
+        """
+        if not self.idle_io:
+            return None
+        previous = get_io_priority()
+        # Приоритет, который не удастся вернуть, не понижаем
+        if previous is None or not set_idle_io_priority():
+            return None
+        return previous
+
+    @staticmethod
+    def restore_priority(previous: Optional[Tuple[int, int]]) -> None:
+        """
+        Возвращает текущему потоку приоритет ввода-вывода, сохраненный lower_priority.
+
+        :param previous: Результат lower_priority
+        """
+        if previous is not None:
+            set_io_priority(*previous)
+
+    def to_dict(self) -> Dict:
+        """ Настройки ограничения для сохранения в каталоге. """
+        return dict(max_rate=self.max_rate, max_files=self.max_files,
+                    profiles=[list(profile) for profile in self.profiles],
+                    drop_cache=self.drop_cache, idle_io=self.idle_io)
+
+
+def run_ionice(*args: str) -> Optional[str]:
+    """
+    Запускает ionice для текущего потока.
+
+    :param args: Параметры ionice перед -p
+    :return: Вывод ionice или None в случае ошибки
+    """
+    if not sys.platform.startswith('linux'):
+        logging.warning("Приоритет ввода-вывода поддерживается только в Linux")
+        return None
+    try:
+        return subprocess.run(['ionice', *args, '-p', str(threading.get_native_id())],
+                              check=True, capture_output=True, text=True).stdout
+    except (OSError, subprocess.CalledProcessError) as e:
+        logging.warning(f"Ошибка ionice: {e}")
+        return None
+
+
+def get_io_priority() -> Optional[Tuple[int, int]]:
+    """
+    Читает приоритет ввода-вывода текущего потока.
+
+    :return: Кортеж (класс, уровень) или None в случае ошибки
+    """
+    output = run_ionice()
+    if output is None:
+        return None
+    # Вывод вида "best-effort: prio 4" или "idle" (у класса idle нет уровня)
+    name, _, level = output.strip().partition(': prio ')
+    if name not in IONICE_CLASSES:
+        logging.warning(f"Неизвестный приоритет ввода-вывода: {output.strip()}")
+        return None
+    return IONICE_CLASSES[name], int(level or 0)
+
+
+def set_io_priority(io_class: int, level: int = 0) -> bool:
+    """
+    Задает приоритет ввода-вывода текущего потока.
+
+    :param io_class: Класс приоритета (IONICE_CLASSES)
+    :param level: Уровень внутри класса (учитывается у классов realtime и best-effort)
+    :return: True, если приоритет изменен
+    """
+    args = ['-c', str(io_class)]
+    if io_class in (IONICE_CLASSES['realtime'], IONICE_CLASSES['best-effort']):
+        args += ['-n', str(level)]
+    return run_ionice(*args) is not None
+
+
+def set_idle_io_priority() -> bool:
+    """
+    Переводит текущий поток в класс приоритета ввода-вывода idle.
+
+    :return: True, если приоритет изменен
+    """
+    return set_io_priority(IONICE_IDLE_CLASS)
+
+
+def load_throttle(conn) -> Optional[Throttle]:
+    """
+    Читает ограничение нагрузки репозитория из каталога.
+
+    :param conn: Объект соединения с базой данных
+    :return: Ограничение или None, если оно не задано
+    """
+    value = get_setting(conn, 'throttle')
+    if not value:
+        return None
+    try:
+        throttle = Throttle(**json.loads(value))
+    except (TypeError, ValueError) as e:
+        logging.error(f"Неверные настройки ограничения нагрузки в каталоге: {e}")
+        return None
+    return throttle if throttle.active else None
+
+
+def save_throttle(conn, throttle: Throttle) -> None:
+    """
+    Сохраняет ограничение нагрузки репозитория в каталоге: его применяют все запуски,
+    в том числе по расписанию. Ограничение без пределов отключает его.
+
+    :param conn: Объект соединения с базой данных
+    :param throttle: Ограничение
+    """
+    set_setting(conn, 'throttle', json.dumps(throttle.to_dict()))
@@ -0,0 +1,259 @@
+import ctypes
+import ctypes.util
+import errno
+import os
+import select
+import struct
+import logging
+import threading
+from contextlib import closing
+from typing import List, Optional, Set, Tuple
+
+from database import create_connection, create_table, get_exclusion_rules
+from exclusions import ExclusionRules
+from backup_manager import backup_files, incremental_backup
+from jobs import JOB_BACKUP, JOB_INCREMENTAL
+
+logging.basicConfig(filename='backup_log.log', level=logging.INFO,
+                    format='%(asctime)s:%(levelname)s:%(message)s')
+
+try:
+    _libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+    _libc.inotify_init1
+    _libc.inotify_add_watch
+except (OSError, AttributeError, TypeError):  # inotify есть только в Linux
+    _libc = None
+
+# Флаги inotify из <sys/inotify.h>
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_DONT_FOLLOW = 0x02000000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = getattr(os, 'O_CLOEXEC', 0)
+
+WATCH_MASK = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+              | IN_ONLYDIR | IN_DONT_FOLLOW)
+# Заголовок события: wd, mask, cookie, len
+EVENT_HEADER = struct.Struct('iIII')
+# Как часто поток наблюдателя проверяет флаг остановки, в секундах
+POLL_INTERVAL = 0.5
+
+
+def watch_available() -> bool:
+    """ Проверяет, доступен ли inotify в этой системе. """
+    return _libc is not None
+
+
+class ChangeWatcher:
+    """
+    Поток, записывающий измененные пути дерева с помощью inotify.
+
+    Наблюдение ставится на каждую директорию дерева, кроме исключенных. Новые директории
+    берутся под наблюдение по мере появления и целиком считаются измененными. Если очередь
+    событий ядра переполнилась или не хватило лимита наблюдений, изменения могли быть
+    потеряны, и измененным считается весь корень.
+    """
+
+    def __init__(self, root: str, exclusions: Optional[ExclusionRules] = None):
+        """
+        :param root: Наблюдаемая директория
+        :param exclusions: Скомпилированные правила исключения
+        """
+        self.root = root
+        self.exclusions = exclusions or ExclusionRules()
+        self.watches = {}
+        self.dirty: Set[str] = set()
+        self.lost = False
+        self.lock = threading.Lock()
+        self.stop_event = threading.Event()
+        self.fd = -1
+        self.thread = None
+
+    def start(self) -> None:
+        """ Ставит наблюдение на дерево и запускает поток чтения событий. """
+        if _libc is None:
+            raise OSError(errno.ENOSYS, "inotify недоступен")
+        self.fd = _libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "Ошибка inotify_init1")
+        self.add_tree(self.root)
+        self.thread = threading.Thread(target=self.run, name="capsule-watch", daemon=True)
+        self.thread.start()
+        logging.info(f"Наблюдение за {self.root}: директорий {len(self.watches)}")
+
+    def stop(self) -> None:
+        """ Останавливает поток и закрывает дескриптор inotify. """
+        self.stop_event.set()
+        if self.thread is not None:
+            self.thread.join()
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1
+
+    def add_watch(self, path: str) -> bool:
+        """
+        Ставит наблюдение на одну директорию.
+
+        :param path: Путь к директории
+        :return: True, если наблюдение поставлено
+        """
+        wd = _libc.inotify_add_watch(self.fd, os.fsencode(path), WATCH_MASK)
+        if wd < 0:
+            err = ctypes.get_errno()
+            if err == errno.ENOSPC:
+                logging.warning(f"Исчерпан лимит наблюдений inotify (fs.inotify.max_user_watches): {path}")
+                self.lost = True
+            elif err not in (errno.ENOENT, errno.ENOTDIR):
+                logging.error(f"Ошибка при наблюдении за {path}: {os.strerror(err)}")
+            return False
+        self.watches[wd] = path
+        return True
+
+    def add_tree(self, path: str) -> None:
+        """
+        Ставит наблюдение на директорию и все ее поддиректории.
+
+        :param path: Путь к директории
+        """
+        stack = [path]
+        while stack:
+            dir_path = stack.pop()
+            if self.exclusions.is_excluded(dir_path) or not self.add_watch(dir_path):
+                continue
+            try:
+                with os.scandir(dir_path) as it:
+                    stack.extend(entry.path for entry in it if entry.is_dir(follow_symlinks=False))
+            except OSError:
+                pass
+
+    def mark(self, path: str) -> None:
+        """ Добавляет путь в набор измененных. """
+        with self.lock:
+            self.dirty.add(path)
+
+    def take_changes(self) -> Tuple[bool, List[str]]:
+        """
+        Забирает накопленные изменения.
+
+        :return: Кортеж (потеряны ли события - нужен полный обход, измененные пути)
+        """
+        with self.lock:
+            lost, dirty = self.lost, self.dirty
+            self.lost, self.dirty = False, set()
+        return lost, sorted(dirty)
+
+    def run(self) -> None:
+        """ Читает события inotify до остановки. """
+        while not self.stop_event.is_set():
+            ready, _, _ = select.select([self.fd], [], [], POLL_INTERVAL)
+            if not ready:
+                continue
+            try:
+                data = os.read(self.fd, 64 * 1024)
+            except BlockingIOError:
+                continue
+            offset = 0
+            while offset < len(data):
+                wd, mask, _, length = EVENT_HEADER.unpack_from(data, offset)
+                offset += EVENT_HEADER.size
+                name = os.fsdecode(data[offset:offset + length].rstrip(b'\0'))
+                offset += length
+                self.handle(wd, mask, name)
+
+    def handle(self, wd: int, mask: int, name: str) -> None:
+        """
+        Обрабатывает одно событие inotify.
+
+        :param wd: Дескриптор наблюдения
+        :param mask: Флаги события
+        :param name: Имя записи внутри наблюдаемой директории (пусто для событий самой директории)
+        """
+        if mask & IN_Q_OVERFLOW:
+            logging.warning("Очередь событий inotify переполнена, будет выполнен полный обход")
+            with self.lock:
+                self.lost = True
+            return
+        dir_path = self.watches.get(wd)
+        if dir_path is None:
+            return
+        if mask & IN_IGNORED:
+            del self.watches[wd]
+            return
+        if not name:
+            return
+        path = os.path.join(dir_path, name)
+        if mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO):
+            # Для перемещенной директории inotify возвращает прежний wd, и его путь обновляется
+            self.add_tree(path)
+        self.mark(path)
+
+
+def watch_backup(source: str, destination: str, db_file: str, interval: float,
+                 stop_event: Optional[threading.Event] = None, manager=None, **options) -> None:
+    """
+    Непрерывное резервное копирование по изменениям файловой системы.
+
+    Наблюдение начинается до базового полного снимка, поэтому изменения, сделанные во время
+    его создания, попадут в следующий снимок. Затем раз в interval секунд создается
+    инкрементный снимок измененных путей (см. backup_manager.incremental_backup); если
+    изменений не было, снимок не создается.
+
+    :param source: Исходный путь для копирования
+    :param destination: Путь назначения для сохранения копий
+    :param db_file: Путь к файлу базы данных
+    :param interval: Интервал между снимками в секундах
+    :param stop_event: Событие остановки наблюдения
+    :param manager: Очередь заданий (jobs.JobManager): снимки ставятся в нее, а не выполняются здесь
+    :param options: Параметры копирования (paranoid, batch_size, backend, hash_algorithm)
+    """
+    stop_event = stop_event or threading.Event()
+    with closing(create_connection(db_file)) as conn:
+        create_table(conn)
+        exclusions = ExclusionRules(get_exclusion_rules(conn))
+    watcher = ChangeWatcher(source, exclusions)
+    watcher.start()
+    # Изменения неудавшегося снимка уже забраны у наблюдателя: следующий снимок - полный
+    failed = False
+
+    def run_full():
+        nonlocal failed
+        if manager is not None:
+            manager.submit(JOB_BACKUP, source, destination, db_file=db_file, **options)
+            return
+        try:
+            backup_files(source, destination, db_file, **options)
+            failed = False
+        except Exception:
+            failed = True
+
+    def run_incremental(dirty):
+        nonlocal failed
+        if manager is not None:
+            manager.submit(JOB_INCREMENTAL, source, destination, dirty, db_file=db_file, **options)
+            return
+        try:
+            incremental_backup(source, destination, db_file, dirty, **options)
+        except Exception:
+            failed = True
+
+    try:
+        run_full()
+        while not stop_event.wait(interval):
+            lost, dirty = watcher.take_changes()
+            if lost or failed:
+                run_full()
+            elif dirty:
+                run_incremental(dirty)
+            else:
+                logging.info(f"Изменений в {source} нет, снимок не создается")
+    finally:
+        watcher.stop()